@@ -1,14 +1,17 @@
 from typing import Callable
+from collections import deque
 from pathlib import Path
-from time import time
+from time import perf_counter, time
+import os
 import json
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox, filedialog
 from enum import Enum
-from pngunit import WorkOrder, PngUnit
+from pngunit import WorkOrder, PngUnit, Schedule, FILTER_NAMES, nice_size
+from pngcache import DEFAULT_CACHE_PATH
 import pngthreads as pt
-from custom_widgets import ScrollableFrame, UnitFrame
+from custom_widgets import UnitModel, VirtualUnitList
 
 
 _LAYOUT = {}
@@ -30,39 +33,43 @@ class App(tk.Tk):
         RUNNING = 1
         STOPPING = 2
 
-    FILTERS = [
-        'None',
-        'Sub',
-        'Up',
-        'Average',
-        'Paeth',
-        'Mixed',
-        'Reuse'
-    ]
+    FILTERS = FILTER_NAMES
 
     CONFIG_PATH = Path.cwd() / 'config.json'
+    CACHE_PATH = DEFAULT_CACHE_PATH
     THREAD_CHECK_TIME = 200
+    #used instead while events are arriving faster than one check can handle
+    BACKLOG_CHECK_TIME = 20
+    #seconds of event handling per check, the rest waits for the next one
+    HANDLE_BUDGET = 0.03
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.manager: pt.Manager
         self.current_state = self.STATE.IDLE
         self.work_path: Path = Path.cwd()
+        #prefix cut from queued paths for display, None when a single file was chosen
+        self.work_prefix: str | None = None
         self.files_done: int = 0
         self.files_total: int = 0
         self.error_count: int = 0
-        self.units: dict[int, UnitFrame] = {}
+        self.skip_count: int = 0
+        self.units = UnitModel()
         self.start_time: float = 0
         self.end_time: float = 0
         self.size_savings: int = 0
+        self.event_batcher = pt.EventBatcher(pt.Manager.EVENT_QUEUE)
+        #drained but not yet handled
+        self.pending_events: deque[pt.BaseEvent] = deque()
 
         #these are not Tk events, but custom ones in the pngthreads module
         self.event_map = {
             pt.SessionStartEvent: self.handle_start,
             pt.SessionEndEvent: self.handle_end,
-            pt.SessionQueueEvent: self.handle_queued,
+            pt.SessionQueueBatchEvent: self.handle_queued_batch,
             pt.PngUpdateEvent: self.handle_unit_update,
             pt.PngErrorEvent: self.handle_unit_error,
+            pt.PngSkipEvent: self.handle_unit_skip,
             pt.PngDoneEvent: self.handle_unit_done,
         }
 
@@ -72,6 +79,9 @@ class App(tk.Tk):
         self.recursive = tk.BooleanVar()
         self.filter_bools: list[tk.BooleanVar] = []
         self.keep_pal = tk.BooleanVar()
+        self.parallel_filters = tk.BooleanVar()
+        self.use_cache = tk.BooleanVar()
+        self.largest_first = tk.BooleanVar()
 
         #region widget creation and layout
         #tk layout sucks...
@@ -101,6 +111,12 @@ class App(tk.Tk):
         self.recursive_check.grid(row=0, column=2, padx=default_padding, pady=default_padding)
         self.threads_box = tk.Spinbox(opt_frame, from_=1, to=99, width=3, textvariable=self.thread_count)
         self.threads_box.grid(row=0, column=1, padx=default_padding, pady=default_padding)
+        self.parallel_check = tk.Checkbutton(opt_frame, text='Run filters in parallel', variable=self.parallel_filters)
+        self.parallel_check.grid(row=0, column=3, padx=default_padding, pady=default_padding)
+        self.cache_check = tk.Checkbutton(opt_frame, text='Skip previously optimized files', variable=self.use_cache)
+        self.cache_check.grid(row=0, column=4, padx=default_padding, pady=default_padding)
+        self.largest_check = tk.Checkbutton(opt_frame, text='Largest files first', variable=self.largest_first)
+        self.largest_check.grid(row=0, column=5, padx=default_padding, pady=default_padding)
         tk.Label(opt_frame, text='Threads:').grid(row=0, column=0, padx=default_padding, pady=default_padding)
         opt_frame.grid(row=lv('mr'), column=lv('mc'), columnspan=3, sticky='w')
         lr('mc')
@@ -155,9 +171,7 @@ class App(tk.Tk):
         li('mr')
 
         #work window
-        self.png_parent = ScrollableFrame(self, borderwidth=1, relief='sunken')
-        self.png_parent.canvas['borderwidth'] = 0
-        self.png_parent.canvas['highlightthickness'] = 0
+        self.png_parent = VirtualUnitList(self, self.units)
         self.png_parent.grid(row=lv('mr'), column=0, columnspan=3, sticky='news', padx=2, pady=2)
         self.grid_rowconfigure(lv('mr'), weight=1)
         self.grid_columnconfigure(1, weight=1)
@@ -210,13 +224,24 @@ class App(tk.Tk):
         self.update_time()
         #call again until we finish
         if self.current_state != self.STATE.IDLE:
-            self.after(self.THREAD_CHECK_TIME, self.thread_check)
+            wait = self.BACKLOG_CHECK_TIME if self.event_batcher.backlog or len(self.pending_events) else self.THREAD_CHECK_TIME
+            self.after(wait, self.thread_check)
 
     def process_thread_events(self):
         if not hasattr(self, 'manager'):
             return
-        while not self.manager.EVENT_QUEUE.empty():
-            self.handle_event(self.manager.EVENT_QUEUE.get())
+        if not len(self.pending_events):
+            self.pending_events.extend(self.event_batcher.drain())
+        #handling is bounded too, a drained backlog can take longer to handle than to read
+        deadline = perf_counter() + self.HANDLE_BUDGET
+        while len(self.pending_events) and perf_counter() < deadline:
+            self.handle_event(self.pending_events.popleft())
+        #only the visible rows are redrawn, once per check
+        self.png_parent.refresh()
+        if (self.current_state != self.STATE.IDLE and not self.manager.is_alive() and self.manager.EVENT_QUEUE.empty()
+                and not len(self.pending_events)):
+            #died without ending the session
+            self.handle_end(pt.SessionEndEvent('Session stopped unexpectedly'))
 
     #params not annotated because pylance complains, 
     #event is any child class of pngthreads.BaseEvent
@@ -237,43 +262,55 @@ class App(tk.Tk):
         self.end_time = time()
         self.update_time()
         self.finish()
+        if event.error:
+            self.error_message(f'The session failed: {event.error}')
 
-    def handle_queued(self, event: pt.SessionQueueEvent):
-        self.add_unit(event.id, event.path)
-        self.files_total += 1
+    def handle_queued_batch(self, event: pt.SessionQueueBatchEvent):
+        for id, path in zip(event.ids, event.paths):
+            self.add_unit(id, path)
+        self.files_total += len(event.ids)
         self.update_job_progress()
 
     def handle_unit_error(self, event: pt.PngErrorEvent):
         self.error_count += 1
         self.update_job_progress()
-        uf = self.get_unit_frame(event.id)
-        if uf is None:
+        row = self.get_unit_row(event.id)
+        if row is None:
             return
         text = event.error
         if len(event.detail):
             text += f"\n{event.detail}"
-        uf.set_detail(text)
-        uf.set_status('Error')
+        self.units.set_detail(row, text)
+        self.units.set_status(row, 'Error')
+
+    def handle_unit_skip(self, event: pt.PngSkipEvent):
+        self.skip_count += 1
+        self.update_job_progress()
+        row = self.get_unit_row(event.id)
+        if row is None:
+            return
+        self.units.set_detail(row, event.reason)
+        self.units.set_status(row, 'Skipped')
 
     def handle_unit_done(self, event: pt.PngDoneEvent):
         self.size_savings += event.size_change
         self.files_done += 1
         self.update_job_progress()
-        uf = self.get_unit_frame(event.id)
-        if uf is None:
+        row = self.get_unit_row(event.id)
+        if row is None:
             return
         if event.size_change == 0:
-            uf.set_detail(f'No change in {event.time:0.2f} sec')
+            self.units.set_detail(row, f'No change in {event.time:0.2f} sec')
         else:
-            uf.set_detail(f'{self.nice_size(event.size_change)} reduced in {event.time:0.2f} sec: {event.final_switches}')
-        uf.set_status('Done')
+            self.units.set_detail(row, f'{self.nice_size(event.size_change)} reduced in {event.time:0.2f} sec: {event.final_switches}')
+        self.units.set_status(row, 'Done')
 
     def handle_unit_update(self, event: pt.PngUpdateEvent):
-        uf = self.get_unit_frame(event.id)
-        if uf is None:
+        row = self.get_unit_row(event.id)
+        if row is None:
             return
-        uf.update_progress(event.done, event.required)
-        uf.set_status('Running')
+        self.units.update_progress(row, event.done, event.required)
+        self.units.set_status(row, 'Running')
 
     def open_path(self):
         result = filedialog.askdirectory(initialdir=self.path_text.get())
@@ -298,6 +335,9 @@ class App(tk.Tk):
         if not self.check_pngout_set():
             return
         self.work_path = path
+        #worked out once here, not with a stat for every queued file
+        self.work_prefix = os.path.join(path, '') if path.is_dir() else None
+        self.pending_events.clear()
         self.clear_units()
         self.stats_reset()
         self.update_job_progress()
@@ -313,16 +353,19 @@ class App(tk.Tk):
             [self.work_path], 
             filters, 
             self.recursive.get(), 
-            extra_switches)
+            extra_switches,
+            parallel_filters=self.parallel_filters.get(),
+            cache_path=self.CACHE_PATH if self.use_cache.get() else None,
+            schedule=Schedule.LARGEST_FIRST if self.largest_first.get() else Schedule.FIFO)
         
         self.after(self.THREAD_CHECK_TIME, self.thread_check)
         
-        self.manager = pt.Manager(order, daemon=True)
+        self.manager = pt.create_manager(order, daemon=True)
         self.manager.start()
 
     def stop_work(self):
         self.stop_btn.config(state=tk.DISABLED)
-        self.manager.stop_event.set()
+        self.manager.stop()
         self.current_state = self.STATE.STOPPING
         self.update_status()
 
@@ -337,6 +380,7 @@ class App(tk.Tk):
         message = f'{finish_message}\n\n'
         message += f'{self.files_total} files queued\n'
         message += f'{self.files_done} complete\n'
+        message += f'{self.skip_count} skipped\n'
         message += f'{self.error_count} errors\n'
         message += f'{self.nice_size(self.size_savings)} reduced total'
         messagebox.showinfo(title="Final Stats", icon=icon, message=message)
@@ -346,23 +390,24 @@ class App(tk.Tk):
         self.files_total = 0
         self.size_savings = 0
         self.error_count = 0
+        self.skip_count = 0
 
-    def add_unit(self, id: int, path: Path):
-        display_name = str(path.relative_to(self.work_path)) if self.work_path.is_dir() else str(path.name)
-        uf = UnitFrame(self.png_parent.scrollable_frame, 0, display_name, borderwidth=1, relief='solid', padding=(2,2))
-        self.units[id] = uf
-        uf.pack(padx=2, pady=2, fill='x', expand=True)
+    def add_unit(self, id: int, path: str):
+        if self.work_prefix is not None and path.startswith(self.work_prefix):
+            display_name = path[len(self.work_prefix):]
+        else:
+            display_name = os.path.basename(path)
+        self.units.add(id, display_name)
 
     def clear_units(self):
-        self.units.clear()
         self.png_parent.clear()
 
-    def get_unit_frame(self, id: int) -> UnitFrame | None:
-        uf = self.units.get(id, None)
+    def get_unit_row(self, id: int) -> int | None:
+        row = self.units.get_row(id)
         #debug
-        if uf is None:
-            print(f"Unit frame does not exist for {id}")
-        return uf
+        if row is None:
+            print(f"Unit row does not exist for {id}")
+        return row
 
     def load_config(self):
         if not self.CONFIG_PATH.exists():
@@ -373,6 +418,9 @@ class App(tk.Tk):
                 self.keep_pal.set(config['keep_pal'])
                 self.recursive.set(config['recursive'])
                 self.thread_count.set(config['thread_count'])
+                self.parallel_filters.set(config.get('parallel_filters', False))
+                self.use_cache.set(config.get('use_cache', False))
+                self.largest_first.set(config.get('largest_first', False))
                 PngUnit.PNGOUT_PATH = Path(config['pngout_path'])
                 for ndx, var in enumerate(self.filter_bools):
                     var.set(ndx in config['filters'])
@@ -386,6 +434,9 @@ class App(tk.Tk):
                 'recursive': self.recursive.get(),
                 'keep_pal': self.keep_pal.get(),
                 'thread_count': self.thread_count.get(),
+                'parallel_filters': self.parallel_filters.get(),
+                'use_cache': self.use_cache.get(),
+                'largest_first': self.largest_first.get(),
                 'filters': self.get_selected_filters()
             }
             with open(self.CONFIG_PATH, 'w') as fp:
@@ -412,7 +463,7 @@ class App(tk.Tk):
 
     def update_job_progress(self):
         if self.files_total > 0:
-            self.job_progress['value'] = (self.files_done + self.error_count) / self.files_total
+            self.job_progress['value'] = (self.files_done + self.error_count + self.skip_count) / self.files_total
             return
         self.job_progress['value'] = 0
 
@@ -447,14 +498,7 @@ class App(tk.Tk):
         return f'{int(hours):02}:{int(mins):02}:{int(seconds):02}'
     
     def nice_size(self, bytes: int) -> str:
-        #only 3 paths, no need for iteration
-        if bytes < 1024:
-            return f'{bytes} bytes'
-        kb = 1024
-        mb = kb * 1024
-        if bytes < mb:
-            return f'{bytes / kb:0.2f} Kb'
-        return f'{bytes / mb:0.2f} Mb'
+        return nice_size(bytes)
     
     '''
     def debug_action(self):
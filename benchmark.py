@@ -0,0 +1,385 @@
+'''Measures outfront's own overhead with synthetic images and a fake pngout.
+
+Generates a tree of small images from a seed, points PngUnit at
+fake_pngout.py and runs a Manager over it exactly like the command line
+does. Nothing here needs the real pngout, real assets or the network, so
+the numbers only move when discovery, queueing, scheduling or event
+handling change.
+
+    python benchmark.py --files 500 -t 8
+    python benchmark.py --files 200 --latency 0.05 --engine async --repeat 3
+
+Each run prints a summary and appends it as a JSON line to bench_output.txt.
+Per unit overhead is the wall time the pool spent on a file beyond the
+pngout runs themselves, with the cost of starting a process measured at the
+beginning so it counts as pngout's time rather than ours. The pool's width
+is the most pngout processes seen running at once, not the thread count,
+since parallel filters run several per thread. Peak memory is sampled
+during each run, for outfront itself and for the pngouts running with it.
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+from pathlib import Path
+from threading import Thread, Event
+from time import time, monotonic
+from pngunit import WorkOrder, PngUnit, Schedule, Engine, FILTER_NAMES
+from pngpool import running_children_stats
+import pngthreads as pt
+
+FAKE_PNGOUT = Path(__file__).resolve().parent / 'fake_pngout.py'
+OUTPUT_PATH = Path.cwd() / 'bench_output.txt'
+#process starts timed to calibrate the per run spawn cost
+CALIBRATION_RUNS = 20
+#seconds between memory samples during a run
+MEMORY_SAMPLE_TIME = 0.02
+
+def make_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def make_png(rng: random.Random, size: int, color: int) -> bytes:
+    side = max(1, int((size / 3) ** 0.5))
+    data = b'\x89PNG\r\n\x1a\n' + make_chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, color, 0, 0, 0))
+    if color == 3:
+        gray = rng.random() < 0.5
+        palette = b''.join(bytes([v, v, v]) if gray else bytes([v, 255 - v, v // 2]) for v in range(256))
+        data += make_chunk(b'PLTE', palette)
+    body = rng.randbytes(max(0, size - len(data) - 24))
+    return data + make_chunk(b'IDAT', body) + make_chunk(b'IEND', b'')
+
+def make_bmp(rng: random.Random, size: int) -> bytes:
+    side = max(1, int((size / 3) ** 0.5))
+    pixels = rng.randbytes(max(0, size - 54))
+    header = struct.pack('<2sIHHI', b'BM', 54 + len(pixels), 0, 0, 54)
+    dib = struct.pack('<IiiHHIIiiII', 40, side, side, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + dib + pixels
+
+def generate_tree(root: Path, seed: int, files: int, depth: int, fanout: int,
+                  min_size: int, max_size: int, colors: list[int], bmp_fraction: float) -> int:
+    '''Writes files images below root, spread over a directory tree depth levels deep
+    with fanout sub directories each. Returns the total bytes written.
+    '''
+    rng = random.Random(seed)
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [parent / f'd{index}' for parent in level for index in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        directory.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for index in range(files):
+        directory = rng.choice(directories)
+        size = rng.randint(min_size, max_size)
+        if rng.random() < bmp_fraction:
+            path, data = directory / f'img{index}.bmp', make_bmp(rng, size)
+        else:
+            path, data = directory / f'img{index}.png', make_png(rng, size, rng.choice(colors))
+        path.write_bytes(data)
+        total += len(data)
+    return total
+
+def write_wrapper(directory: Path) -> Path:
+    '''pngout is started directly, so the python script needs an executable in front of it.
+    '''
+    path = directory / 'pngout'
+    path.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_PNGOUT}" "$@"\n')
+    path.chmod(0o755)
+    return path
+
+def calibrate_spawn(pngout: Path, directory: Path) -> float:
+    '''Median seconds for one fake pngout run that does nothing but start and exit.
+    '''
+    sample = directory / 'calibrate.png'
+    sample.write_bytes(make_png(random.Random(0), 1024, 0))
+    env = dict(os.environ, FAKE_PNGOUT_LATENCY='0', FAKE_PNGOUT_LATENCY_PER_MB='0')
+    times = []
+    for _ in range(CALIBRATION_RUNS):
+        start = monotonic()
+        subprocess.run([str(pngout), str(sample), str(directory / 'calibrate-out.png'), '/f5', '/y'],
+                       env=env, capture_output=True)
+        times.append(monotonic() - start)
+    return statistics.median(times)
+
+def page_kb() -> int | None:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') // 1024
+    except (AttributeError, ValueError, OSError):
+        return None
+
+class MemorySampler(Thread):
+    '''Peak resident set in KB of this process and of its running children together, while running.
+
+    rusage only has a peak for the whole life of the process, so it can't
+    tell runs apart. A peak shorter than MEMORY_SAMPLE_TIME can be missed.
+    Both stay None without /proc.
+    '''
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = Event()
+        self.page_kb = page_kb()
+        self.self_kb: int | None = None
+        self.children_kb: int | None = None
+
+    def run(self):
+        while not self.stopped.wait(MEMORY_SAMPLE_TIME):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+    def sample(self):
+        if self.page_kb is None:
+            return
+        try:
+            with open('/proc/self/statm') as fp:
+                own = int(fp.read().split()[1]) * self.page_kb
+        except OSError:
+            return
+        self.self_kb = max(self.self_kb or 0, own)
+        children = running_children_stats()
+        if children is not None:
+            #rss, in pages
+            running = sum( int(fields[21]) for fields in children ) * self.page_kb
+            self.children_kb = max(self.children_kb or 0, running)
+
+class Recorder:
+    '''Timestamps the manager's events as they are taken off the queue.
+    '''
+    def __init__(self):
+        self.start_time: float = 0
+        self.end_time: float = 0
+        self.first_queued: float = 0
+        self.queued: dict[int, float] = {}
+        self.started: dict[int, float] = {}
+        self.passes: int = 0
+        self.done: int = 0
+        self.errors: int = 0
+        self.skipped: int = 0
+        self.trials: int = 0
+        self.size_change: int = 0
+        self.finished: bool = False
+
+    def handle_event(self, event: pt.BaseEvent):
+        now = monotonic()
+        if isinstance(event, pt.SessionStartEvent):
+            self.start_time = now
+        elif isinstance(event, pt.SessionEndEvent):
+            self.end_time = now
+            self.finished = True
+        elif isinstance(event, pt.SessionQueueBatchEvent):
+            for id in event.ids:
+                self.queued[id] = now
+            self.first_queued = self.first_queued or now
+        elif isinstance(event, pt.PngUpdateEvent):
+            #the first update comes as a unit starts, the rest as each pass ends
+            if event.id in self.started:
+                self.passes += 1
+            else:
+                self.started[event.id] = now
+        elif isinstance(event, pt.PngDoneEvent):
+            self.done += 1
+            self.size_change += event.size_change
+        elif isinstance(event, pt.PngTrialEvent):
+            self.trials += 1
+            self.size_change += event.size_change
+        elif isinstance(event, pt.PngErrorEvent):
+            self.errors += 1
+        elif isinstance(event, pt.PngSkipEvent):
+            self.skipped += 1
+
+    def queue_waits(self) -> list[float]:
+        return [ self.started[id] - queued for id, queued in self.queued.items() if id in self.started ]
+
+def read_runs(log: Path) -> list[tuple[float, float, float]]:
+    '''Each fake pngout run's seconds past process start and the wall clock times it started and ended.
+    '''
+    if not log.exists():
+        return []
+    runs = []
+    for line in log.read_text().splitlines():
+        elapsed, started, ended = line.split()
+        runs.append((float(elapsed), float(started), float(ended)))
+    return runs
+
+def peak_concurrency(runs: list[tuple[float, float, float]], spawn: float) -> int:
+    '''Most pngout processes running at once, each counted from before its spawn cost.
+    '''
+    #an end sorts before a start at the same time, back to back runs don't overlap
+    changes = sorted([ (started - spawn, 1) for _, started, _ in runs ] + [ (ended, -1) for _, _, ended in runs ])
+    running = peak = 0
+    for _, change in changes:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+def run_once(args: argparse.Namespace, root: Path, spawn: float) -> dict:
+    tree = root / 'tree'
+    input_bytes = generate_tree(tree, args.seed, args.files, args.depth, args.fanout,
+                                args.min_size, args.max_size, args.colors, args.bmp_fraction)
+    log = root / 'runs.log'
+    log.unlink(missing_ok=True)
+    os.environ['FAKE_PNGOUT_LOG'] = str(log)
+    order = WorkOrder(
+        args.threads,
+        [tree],
+        args.filters,
+        True,
+        [],
+        parallel_filters=args.parallel_filters,
+        schedule=Schedule(args.schedule),
+        scan_threads=args.scan_threads,
+        engine=Engine(args.engine),
+        min_gain=args.early_stop,
+        reorder_filters=args.early_stop is not None,
+        extra_trials=args.trials)
+    recorder = Recorder()
+    sampler = MemorySampler()
+    sampler.start()
+    manager = pt.create_manager(order, daemon=True)
+    manager.start()
+    while not recorder.finished:
+        recorder.handle_event(manager.EVENT_QUEUE.get())
+    manager.join()
+    sampler.stop()
+
+    makespan = recorder.end_time - recorder.start_time
+    pngout_runs = read_runs(log)
+    runs = len(pngout_runs)
+    units = recorder.done + recorder.errors + recorder.skipped
+    pngout_time = runs * spawn + sum( elapsed for elapsed, _, _ in pngout_runs )
+    width = peak_concurrency(pngout_runs, spawn)
+    waits = recorder.queue_waits()
+    shutil.rmtree(tree)
+    return {
+        'files': args.files,
+        'units': units,
+        'done': recorder.done,
+        'errors': recorder.errors,
+        'trials': recorder.trials,
+        'input_bytes': input_bytes,
+        'saved_bytes': recorder.size_change,
+        'pngout_runs': runs,
+        'makespan': makespan,
+        'discovery': (recorder.first_queued - recorder.start_time) if recorder.first_queued else None,
+        'files_per_sec': units / makespan if makespan else None,
+        'runs_per_sec': runs / makespan if makespan else None,
+        'queue_wait_median': statistics.median(waits) if waits else None,
+        'queue_wait_max': max(waits) if waits else None,
+        'peak_processes': width,
+        'mean_processes': pngout_time / makespan if makespan else None,
+        #pool time not spent inside pngout, spread over the units
+        'overhead_per_unit': (makespan * width - pngout_time) / units if units and width else None,
+        'ideal_makespan': pngout_time / width if width else None,
+        'peak_rss_kb': sampler.self_kb,
+        'peak_children_rss_kb': sampler.children_kb,
+    }
+
+def format_result(result: dict) -> str:
+    def ms(value: float | None) -> str:
+        return 'n/a' if value is None else f'{value * 1000:0.2f} ms'
+    def sec(value: float | None) -> str:
+        return 'n/a' if value is None else f'{value:0.3f} sec'
+    def kb(value: int | None) -> str:
+        return 'n/a' if value is None else f'{value} KB'
+    lines = [
+        f'{result["units"]} units ({result["done"]} done, {result["errors"]} errors), '
+        f'{result["pngout_runs"]} pngout runs, {result["trials"]} trials kept',
+        f'makespan {sec(result["makespan"])}, ideal {sec(result["ideal_makespan"])}',
+        f'up to {result["peak_processes"]} pngout processes at once, {result["mean_processes"] or 0:0.1f} on average',
+        f'{result["files_per_sec"] or 0:0.1f} files/sec, {result["runs_per_sec"] or 0:0.1f} runs/sec',
+        f'first file queued after {ms(result["discovery"])}',
+        f'queue wait median {ms(result["queue_wait_median"])}, max {ms(result["queue_wait_max"])}',
+        f'overhead {ms(result["overhead_per_unit"])} per unit',
+        f'peak memory: outfront {kb(result["peak_rss_kb"])}, pngout processes {kb(result["peak_children_rss_kb"])}',
+    ]
+    return '\n'.join(lines)
+
+def parse_list(text: str) -> list[int]:
+    try:
+        return sorted({ int(part) for part in text.split(',') if part.strip() })
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid list: {text}')
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Benchmark outfront against a fake pngout')
+    parser.add_argument('--files', type=int, default=200, help='images to generate (default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=2, help='directory levels below the root (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=4, help='sub directories per directory (default: %(default)s)')
+    parser.add_argument('--min-size', type=int, default=2048, metavar='BYTES', help='smallest image (default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=65536, metavar='BYTES', help='largest image (default: %(default)s)')
+    parser.add_argument('--colors', type=parse_list, default=[0, 2, 3, 6], metavar='TYPES',
+                        help='png color types to pick from, 2 and 6 exercise the /c retry (default: 0,2,3,6)')
+    parser.add_argument('--bmp-fraction', type=float, default=0.0, metavar='FRACTION',
+                        help='share of images written as bmp, exercising conversion (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the generated tree (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count() or 4, help='worker threads (default: %(default)s)')
+    parser.add_argument('-f', '--filters', type=parse_list, default=list(range(len(FILTER_NAMES))),
+                        help='comma separated filter numbers (default: all)')
+    parser.add_argument('-p', '--parallel-filters', action='store_true', help='run each file\'s filters at the same time')
+    parser.add_argument('-e', '--early-stop', type=float, metavar='FRACTION', help='stop passes gaining less than this')
+    parser.add_argument('--trials', type=int, default=0, metavar='N', help='extra trials per file (default: %(default)s)')
+    parser.add_argument('--schedule', choices=[ schedule.value for schedule in Schedule ], default=Schedule.FIFO.value)
+    parser.add_argument('--engine', choices=[ engine.value for engine in Engine ], default=Engine.THREADS.value)
+    parser.add_argument('--scan-threads', type=int, default=1, metavar='N', help='parallel directory scanning (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.01, metavar='SECONDS',
+                        help='time every fake pngout run takes past process start (default: %(default)s)')
+    parser.add_argument('--latency-per-mb', type=float, default=0.0, metavar='SECONDS',
+                        help='extra fake pngout time per MB of input (default: %(default)s)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, metavar='FRACTION',
+                        help='share of files the fake pngout fails on (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1, metavar='N', help='runs over identical trees (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=Path, default=OUTPUT_PATH, metavar='PATH',
+                        help='file the JSON results are appended to (default: %(default)s)')
+    return parser
+
+def main(argv: list[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.files < 1 or args.threads < 1 or args.repeat < 1:
+        parser.error('files, threads and repeat must be at least 1')
+    if args.trials and args.engine != Engine.THREADS.value:
+        parser.error('--trials only works with the threads engine')
+    if args.min_size > args.max_size:
+        parser.error('min size is larger than max size')
+    os.environ['FAKE_PNGOUT_LATENCY'] = str(args.latency)
+    os.environ['FAKE_PNGOUT_LATENCY_PER_MB'] = str(args.latency_per_mb)
+    os.environ['FAKE_PNGOUT_FAIL_RATE'] = str(args.fail_rate)
+
+    with tempfile.TemporaryDirectory(prefix='outfront-bench-') as temp:
+        root = Path(temp)
+        PngUnit.PNGOUT_PATH = write_wrapper(root)
+        spawn = calibrate_spawn(PngUnit.PNGOUT_PATH, root)
+        print(f'pngout spawn cost {spawn * 1000:0.2f} ms')
+        for number in range(args.repeat):
+            result = run_once(args, root, spawn)
+            print(f'run {number + 1}/{args.repeat}')
+            print(format_result(result))
+            record = {
+                'time': time(),
+                'engine': args.engine,
+                'schedule': args.schedule,
+                'threads': args.threads,
+                'filters': args.filters,
+                'parallel_filters': args.parallel_filters,
+                'latency': args.latency,
+                'seed': args.seed,
+                'spawn_cost': spawn,
+                **result,
+            }
+            with open(args.output, 'a') as fp:
+                fp.write(json.dumps(record) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,451 @@
+'''Headless command line front end.
+
+Only depends on pngunit and pngthreads so it can run on machines without a
+display and without paying for the tkinter import.
+'''
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+from queue import Empty
+from pathlib import Path
+from time import time
+from pngunit import WorkOrder, PngUnit, Schedule, Engine, FILTER_NAMES, nice_size
+from pngcache import DEFAULT_CACHE_PATH
+from pngjournal import DEFAULT_JOURNAL_PATH
+from pngreport import DEFAULT_REPORT_PATH
+from pngpool import usable_cores
+from pngremote import parse_address, TOKEN_ENVIRONMENT
+import pngthreads as pt
+
+CONFIG_PATH = Path.cwd() / 'config.json'
+
+EXIT_OK = 0
+EXIT_UNIT_ERRORS = 1
+EXIT_USAGE = 2
+EXIT_SESSION_ERROR = 3
+EXIT_CANCELED = 130
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='outfront', description='Multi-threaded front end for pngout (headless mode)')
+    parser.add_argument('paths', nargs='+', type=Path, help='files or directories to optimize')
+    parser.add_argument('-r', '--recursive', action='store_true', help='descend into sub directories')
+    parser.add_argument('-t', '--threads', type=parse_threads, default=os.cpu_count() or 4,
+                        help='number of worker threads, or auto to start at the core count and follow the '
+                             'machine\'s load (default: %(default)s)')
+    parser.add_argument('--scan-threads', type=int, default=1, metavar='N',
+                        help='scan sibling directories in parallel when recursive, useful on network storage (default: %(default)s)')
+    parser.add_argument('-f', '--filters', type=parse_filters, default=list(range(len(FILTER_NAMES))),
+                        help='comma separated pngout filter numbers 0-6 (default: all)')
+    parser.add_argument('-p', '--parallel-filters', action='store_true',
+                        help='run the filters for each file at the same time on temporary copies and keep the smallest')
+    parser.add_argument('-c', '--cache', type=Path, nargs='?', const=DEFAULT_CACHE_PATH, metavar='PATH',
+                        help='skip files recorded as already optimized with the same filters and switches (default: %(const)s)')
+    parser.add_argument('-e', '--early-stop', type=float, nargs='?', const=0.0, metavar='FRACTION',
+                        help='stop a file\'s passes once one gains no more than this fraction of its size, '
+                             'trying the filters that win most often first (default: %(const)s, any gain continues)')
+    parser.add_argument('--reorder-filters', action='store_true',
+                        help='try the filters that have won most often first, across sessions when --cache is used')
+    parser.add_argument('--top-filters', type=int, metavar='K',
+                        help='only run the K filters that have won most often for similar images, '
+                             'implies --reorder-filters (images with no history still run every filter)')
+    parser.add_argument('--trials', type=int, default=0, metavar='N',
+                        help='after a file\'s filters are done, queue N more pngout runs with other block splits (/b, /n) '
+                             'and then randomized tables (/r), keeping any that come out smaller; they only run when '
+                             'no file is waiting, largest files first (default: %(default)s)')
+    parser.add_argument('--trial-time', type=float, metavar='SECONDS',
+                        help='stop starting extra trials for a file this long after its first one')
+    parser.add_argument('--schedule', choices=[ schedule.value for schedule in Schedule ], default=Schedule.FIFO.value,
+                        help='fifo: discovery order, largest: biggest estimated cost first, '
+                             'presort: discover everything then run biggest first (default: fifo)')
+    parser.add_argument('--queue-limit', type=int, default=100000, metavar='N',
+                        help='pause discovery while N files are waiting for a worker, 0 for no limit; with '
+                             '--schedule largest only the waiting files are ordered (default: %(default)s)')
+    parser.add_argument('--engine', choices=[ engine.value for engine in Engine ], default=Engine.THREADS.value,
+                        help='threads: one OS thread per worker, async: one asyncio loop for every pngout process (default: threads)')
+    parser.add_argument('--memory-budget', type=parse_size, nargs='?', const=default_memory_budget(), metavar='SIZE',
+                        help='only start files while their estimated pngout memory fits in SIZE (e.g. 4G), '
+                             'big images are throttled and small ones run at full width (default: half of RAM)')
+    parser.add_argument('--core-budget', type=int, metavar='N',
+                        help='only run N pngout processes at once, counting parallel filter trials')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='kill any single pngout run that takes longer than this')
+    parser.add_argument('-j', '--journal', type=Path, nargs='?', const=DEFAULT_JOURNAL_PATH, metavar='PATH',
+                        help='record the state of every file so the session can be resumed (default: %(const)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip files the journal says were finished and restart the rest, implies --journal')
+    parser.add_argument('--report', type=Path, nargs='?', const=DEFAULT_REPORT_PATH, metavar='PATH',
+                        help='write every pngout run, file and the session with their timings, '
+                             'as CSV if PATH ends in .csv and JSON Lines otherwise (default: %(const)s)')
+    parser.add_argument('--metrics', type=Path, metavar='PATH',
+                        help='keep running totals in PATH in the Prometheus text format while the session runs')
+    parser.add_argument('--dedup', action='store_true',
+                        help='optimize byte-identical files once and copy the result to the others')
+    parser.add_argument('--dedup-link', action='store_true',
+                        help='with --dedup, hard link duplicates to the optimized file instead of copying')
+    parser.add_argument('--list-switches', action='store_true',
+                        help='ask pngout /l for each result\'s switches instead of reading them from its header')
+    parser.add_argument('--nice', type=int, default=0, metavar='N',
+                        help='run pngout N nice levels below outfront, unix only (default: %(default)s)')
+    parser.add_argument('--affinity', type=parse_cpus, metavar='CPUS',
+                        help='pin pngout to these cpus, e.g. 0-3,6, linux only')
+    parser.add_argument('--stage', type=Path, nargs='?', const=default_staging_dir(), metavar='DIR',
+                        help='run passes on copies in DIR and write each result back once, only if smaller; '
+                             'the copies need as much space as the files in progress (default: %(const)s)')
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help='also hand files to remote workers started with pngremote.py, '
+                             'use -t 0 to leave all the work to them (HOST defaults to 127.0.0.1)')
+    parser.add_argument('--token', default=os.environ.get(TOKEN_ENVIRONMENT),
+                        help=f'shared secret remote workers must know (default: ${TOKEN_ENVIRONMENT})')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and optimize image files as they are added to or modified in the '
+                             'directories, until stopped with Ctrl-C or SIGTERM; files already there are left alone')
+    parser.add_argument('--settle', type=float, default=2.0, metavar='SECONDS',
+                        help='with --watch, only queue a file once it has been unchanged this long (default: %(default)s)')
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help='with --watch, rescan the directories at this interval instead of using inotify, '
+                             'e.g. for network shares where inotify misses other machines\' writes')
+    parser.add_argument('--kp', action='store_true', help='keep palette indicies (/kp)')
+    parser.add_argument('-s', '--switch', action='append', default=[], dest='switches', metavar='SWITCH',
+                        help='extra pngout switch, may be repeated (e.g. -s /s0)')
+    parser.add_argument('--pngout', type=Path, help='location of the pngout binary (default: config.json or PATH)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the final summary')
+    parser.add_argument('-v', '--verbose', action='store_true', help='also print queued files and pass progress')
+    return parser
+
+def parse_filters(text: str) -> list[int]:
+    try:
+        filters = sorted({ int(part) for part in text.split(',') if part.strip() })
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid filter list: {text}')
+    if not len(filters) or filters[0] < 0 or filters[-1] >= len(FILTER_NAMES):
+        raise argparse.ArgumentTypeError(f'filters must be between 0 and {len(FILTER_NAMES) - 1}')
+    return filters
+
+def parse_threads(text: str) -> int | str:
+    if text == 'auto':
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid thread count: {text}')
+
+def parse_cpus(text: str) -> set[int]:
+    cpus: set[int] = set()
+    try:
+        for part in text.split(','):
+            first, _, last = part.partition('-')
+            cpus.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid cpu list: {text}')
+    if not len(cpus):
+        raise argparse.ArgumentTypeError('cpu list is empty')
+    return cpus
+
+def parse_size(text: str) -> int:
+    units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+    text = text.strip().upper().removesuffix('B')
+    scale = units.get(text[-1:], None)
+    try:
+        value = float(text[:-1] if scale is not None else text) * (scale or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid size: {text}')
+    if value <= 0:
+        raise argparse.ArgumentTypeError('size must be greater than 0')
+    return int(value)
+
+def default_memory_budget() -> int | None:
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        #no sysconf on Windows
+        return None
+
+def default_staging_dir() -> Path:
+    #RAM backed on most linux systems
+    shm = Path('/dev/shm')
+    return shm if shm.is_dir() else Path(tempfile.gettempdir())
+
+def find_pngout(option: Path | None) -> Path | None:
+    if option is not None:
+        #a bare relative name would otherwise be looked up on PATH by subprocess
+        return option.resolve() if option.exists() else None
+    #same config file the gui writes
+    if CONFIG_PATH.exists():
+        try:
+            with open(CONFIG_PATH, 'r') as fp:
+                path = Path(json.load(fp)['pngout_path'])
+            if path.exists():
+                return path
+        except Exception:
+            pass
+    found = shutil.which('pngout')
+    if found is not None:
+        return Path(found)
+    trypath = Path.cwd() / 'pngout.exe'
+    if trypath.exists():
+        return trypath
+    return None
+
+class Reporter:
+    '''Turns the manager's event stream into console output and final stats.
+    '''
+    def __init__(self, quiet: bool = False, verbose: bool = False, out = sys.stdout, trials: bool = False):
+        self.quiet = quiet
+        self.verbose = verbose
+        self.out = out
+        #trial events arrive after a file is done, so its path is kept for them
+        self.trials = trials
+        #paths of files queued and not yet finished, as str since there can be millions
+        self.paths: dict[int, str] = {}
+        self.files_total: int = 0
+        self.files_done: int = 0
+        self.error_count: int = 0
+        #errors that were only a stop reaching a running file, also in error_count
+        self.cancel_count: int = 0
+        self.skip_count: int = 0
+        self.size_savings: int = 0
+        self.start_time: float = 0
+        self.end_time: float = 0
+        self.finished: bool = False
+        #why the session itself failed, empty if it ran
+        self.session_error: str = ''
+        self.event_map = {
+            pt.SessionStartEvent: self.handle_start,
+            pt.SessionEndEvent: self.handle_end,
+            pt.SessionQueueBatchEvent: self.handle_queued,
+            pt.PngUpdateEvent: self.handle_unit_update,
+            pt.PngErrorEvent: self.handle_unit_error,
+            pt.PngSkipEvent: self.handle_unit_skip,
+            pt.PngDoneEvent: self.handle_unit_done,
+            pt.PngTrialEvent: self.handle_unit_trial,
+        }
+
+    def handle_event(self, event):
+        method = self.event_map.get(type(event), None)
+        if method is not None:
+            method(event)
+
+    def handle_start(self, event: pt.SessionStartEvent):
+        self.start_time = time()
+
+    def handle_end(self, event: pt.SessionEndEvent):
+        self.end_time = time()
+        self.finished = True
+        self.session_error = event.error
+
+    def handle_queued(self, event: pt.SessionQueueBatchEvent):
+        self.paths.update(zip(event.ids, event.paths))
+        self.files_total += len(event.ids)
+        if self.verbose:
+            for path in event.paths:
+                self.write(f'queued {path}')
+
+    def handle_unit_update(self, event: pt.PngUpdateEvent):
+        if self.verbose:
+            self.write(f'{self.progress()} {self.paths.get(event.id, event.id)}: pass {event.done}/{event.required}')
+
+    def handle_unit_error(self, event: pt.PngErrorEvent):
+        self.error_count += 1
+        if event.error == 'Canceled':
+            self.cancel_count += 1
+        text = event.error
+        if len(event.detail):
+            text += f' ({event.detail})'
+        if not self.quiet:
+            self.write(f'{self.progress()} {self.paths.get(event.id, event.id)}: error: {text}')
+        self.forget(event.id)
+
+    def handle_unit_skip(self, event: pt.PngSkipEvent):
+        self.skip_count += 1
+        if self.verbose:
+            self.write(f'{self.progress()} {self.paths.get(event.id, event.id)}: skipped: {event.reason}')
+        self.forget(event.id)
+
+    def handle_unit_done(self, event: pt.PngDoneEvent):
+        self.files_done += 1
+        self.size_savings += event.size_change
+        if not self.quiet:
+            if event.size_change == 0:
+                detail = f'no change in {event.time:0.2f} sec'
+            else:
+                detail = f'{nice_size(event.size_change)} reduced in {event.time:0.2f} sec: {event.final_switches}'
+            self.write(f'{self.progress()} {self.paths.get(event.id, event.id)}: {detail}')
+        if not self.trials:
+            self.forget(event.id)
+
+    def handle_unit_trial(self, event: pt.PngTrialEvent):
+        self.size_savings += event.size_change
+        if self.verbose:
+            self.write(f'{self.progress()} {self.paths.get(event.id, event.id)}: trial {event.switches} '
+                       f'reduced {nice_size(event.size_change)} more')
+
+    def forget(self, id: int):
+        self.paths.pop(id, None)
+
+    def progress(self) -> str:
+        return f'[{self.files_done + self.error_count + self.skip_count}/{self.files_total}]'
+
+    def summary(self, canceled: bool) -> str:
+        total = (self.end_time or time()) - self.start_time if self.start_time else 0
+        lines = [
+            'Job Canceled' if canceled else 'Completed',
+            f'{self.files_total} files queued',
+            f'{self.files_done} complete',
+            f'{self.skip_count} skipped',
+            f'{self.error_count} errors',
+            f'{nice_size(self.size_savings)} reduced total',
+            f'{total:0.2f} sec elapsed',
+        ]
+        return '\n'.join(lines)
+
+    def write(self, text: str):
+        print(text, file=self.out, flush=True)
+
+def run(order: WorkOrder, reporter: Reporter) -> bool:
+    '''Runs a work order to completion, returns False if it was canceled.
+    '''
+    manager = pt.create_manager(order, daemon=True)
+    manager.start()
+    canceled = False
+    while not reporter.finished:
+        try:
+            reporter.handle_event(manager.EVENT_QUEUE.get(timeout=0.5))
+        except Empty:
+            if not manager.is_alive() and manager.EVENT_QUEUE.empty():
+                #died without ending the session
+                reporter.handle_end(pt.SessionEndEvent('Session stopped unexpectedly'))
+        except KeyboardInterrupt:
+            canceled = True
+            manager.stop()
+            reporter.write('Canceling, waiting for workers to stop...')
+    manager.join()
+    return not canceled
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def main(argv: list[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        if not path.exists():
+            parser.error(f'{path} does not exist')
+        if not path.is_dir() and not PngUnit.is_extension_valid(path):
+            parser.error(f'{path} is not a valid type for pngout')
+    adaptive = args.threads == 'auto'
+    if adaptive:
+        args.threads = usable_cores(args.affinity)
+    if args.threads < (0 if args.listen else 1):
+        parser.error('threads must be at least 1, or 0 with --listen')
+    if args.stage is not None and not args.stage.is_dir():
+        parser.error(f'{args.stage} is not a directory')
+    if args.trials < 0:
+        parser.error('trials must be at least 0')
+    if args.trials and args.engine != Engine.THREADS.value:
+        parser.error('--trials only works with the threads engine')
+    if args.trials and args.listen:
+        #remote workers would run them on the coordinator, even with -t 0
+        parser.error('--trials can\'t be combined with --listen')
+    if args.listen:
+        if args.engine != Engine.THREADS.value:
+            parser.error('--listen only works with the threads engine')
+        try:
+            parse_address(args.listen)
+        except ValueError:
+            parser.error(f'invalid address: {args.listen}')
+        if not args.token:
+            parser.error(f'--listen needs a token, use --token or set {TOKEN_ENVIRONMENT}')
+    if args.watch:
+        for path in args.paths:
+            if not path.is_dir():
+                parser.error(f'--watch needs directories, {path} is not one')
+        if args.schedule == Schedule.LARGEST_FIRST_PRESORT.value or args.dedup or args.dedup_link:
+            parser.error('--watch can\'t be used with --schedule presort or --dedup, they wait for discovery to end')
+        if args.settle < 0 or (args.poll is not None and args.poll <= 0):
+            parser.error('settle must be at least 0 and poll greater than 0')
+    if args.queue_limit < 0:
+        parser.error('queue limit must be at least 0')
+    if args.scan_threads < 1:
+        parser.error('scan threads must be at least 1')
+    if args.early_stop is not None and not 0 <= args.early_stop < 1:
+        parser.error('early stop fraction must be at least 0 and less than 1')
+    if args.core_budget is not None and args.core_budget < 1:
+        parser.error('core budget must be at least 1')
+    if args.top_filters is not None and args.top_filters < 1:
+        parser.error('top filters must be at least 1')
+    if args.resume and args.journal is None:
+        args.journal = DEFAULT_JOURNAL_PATH
+    pngout = find_pngout(args.pngout)
+    if pngout is None:
+        parser.error('could not find pngout, use --pngout to provide its location')
+    PngUnit.PNGOUT_PATH = pngout
+
+    extra_switches = list(args.switches)
+    if args.kp:
+        extra_switches.append('/kp')
+    order = WorkOrder(
+        args.threads,
+        args.paths,
+        args.filters,
+        args.recursive,
+        extra_switches,
+        parallel_filters=args.parallel_filters,
+        cache_path=args.cache,
+        schedule=Schedule(args.schedule),
+        scan_threads=args.scan_threads,
+        engine=Engine(args.engine),
+        process_timeout=args.timeout,
+        journal_path=args.journal,
+        resume=args.resume,
+        dedup=args.dedup or args.dedup_link,
+        dedup_link=args.dedup_link,
+        min_gain=args.early_stop,
+        reorder_filters=args.reorder_filters or args.early_stop is not None or args.top_filters is not None,
+        filter_limit=args.top_filters,
+        list_switches=args.list_switches,
+        memory_budget=args.memory_budget,
+        core_budget=args.core_budget,
+        adaptive_threads=adaptive,
+        nice=args.nice,
+        cpu_affinity=args.affinity,
+        listen=args.listen,
+        listen_token=args.token,
+        staging_dir=args.stage,
+        extra_trials=args.trials,
+        trial_time=args.trial_time,
+        report_path=args.report,
+        metrics_path=args.metrics,
+        queue_limit=args.queue_limit or None,
+        watch=args.watch,
+        watch_settle=args.settle,
+        watch_poll=args.poll)
+
+    reporter = Reporter(args.quiet, args.verbose, trials=args.trials > 0)
+    if args.watch:
+        #service managers stop a watcher with SIGTERM, wind down the same way as Ctrl-C
+        signal.signal(signal.SIGTERM, interrupt)
+    try:
+        completed = run(order, reporter)
+    except OSError as e:
+        #only the --listen socket can fail before the session starts
+        parser.error(f'could not listen on {args.listen}: {e}')
+    #stopping is the only way a watch ends, so it isn't a cancel
+    canceled = not completed and not args.watch
+    reporter.write(reporter.summary(canceled))
+    if reporter.session_error:
+        reporter.write(f'Session failed: {reporter.session_error}')
+        return EXIT_SESSION_ERROR
+    if canceled:
+        return EXIT_CANCELED
+    errors = reporter.error_count
+    if args.watch:
+        #files interrupted by the stop weren't failures, they're picked up again when next modified
+        errors -= reporter.cancel_count
+    return EXIT_UNIT_ERRORS if errors else EXIT_OK
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,67 +1,154 @@
-from pathlib import Path
-import tkinter as tk
+from array import array
 from tkinter import ttk
-from tkinter.font import Font
 
-class UnitFrame(ttk.Frame):
-    def __init__(self, container, id: int, name: str, **kwargs):
+class UnitModel:
+    '''Per-unit display state kept in flat arrays instead of widgets.
+
+    Rows are in queue order, details are only stored for units that have one.
+    '''
+    STATUSES = ['Queued', 'Running', 'Done', 'Error', 'Skipped']
+
+    def __init__(self):
+        self.rows: dict[int, int] = {}
+        self.names: list[str] = []
+        self.status = bytearray()
+        self.done = array('H')
+        self.required = array('H')
+        self.details: dict[int, str] = {}
+        #bumped on every change so views know when to redraw
+        self.version: int = 0
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def clear(self):
+        self.rows.clear()
+        self.names.clear()
+        self.status = bytearray()
+        self.done = array('H')
+        self.required = array('H')
+        self.details.clear()
+        self.version += 1
+
+    def add(self, id: int, name: str):
+        self.rows[id] = len(self.names)
+        self.names.append(name)
+        self.status.append(0)
+        self.done.append(0)
+        self.required.append(0)
+        self.version += 1
+
+    def get_row(self, id: int) -> int | None:
+        return self.rows.get(id, None)
+
+    def set_status(self, row: int, status: str):
+        self.status[row] = self.STATUSES.index(status)
+        self.version += 1
+
+    def set_detail(self, row: int, message: str):
+        '''For error messages or details
+        '''
+        self.details[row] = message
+        self.version += 1
+
+    def update_progress(self, row: int, done: int, of: int):
+        self.done[row] = done
+        self.required[row] = of
+        self.version += 1
+
+    def row_values(self, row: int) -> tuple[str, tuple[str, str, str]]:
+        progress = f'{self.done[row]}/{self.required[row]}' if self.required[row] else ''
+        detail = self.details.get(row, '').replace('\n', ' ')
+        return self.names[row], (self.STATUSES[self.status[row]], progress, detail)
+
+
+class VirtualUnitList(ttk.Frame):
+    '''Shows a UnitModel with only enough Treeview rows to fill the visible area.
+
+    Scrolling moves a window over the model and refills those rows, so the
+    cost of the view doesn't grow with the number of units.
+    '''
+    def __init__(self, container, model: UnitModel, **kwargs):
         super().__init__(container, **kwargs)
-        self.id = id
-        self.name = name
-        self.name_label = tk.Label(self, text=self.name, anchor='w')
-        self.status_text = tk.StringVar(value='Queued')
-        self.status_label = tk.Label(self, textvariable=self.status_text)
-        self.progress = ttk.Progressbar(self, maximum=1)
-        self.name_label.grid(row=0, column=0, sticky='we')
-        self.status_label.grid(row=0, column=1)
-        self.progress.grid(row=0, column=2)
+        self.model = model
+        self.first: int = 0
+        self.visible: int = 1
+        self.drawn_version: int = -1
+        self.items: list[str] = []
+        self.tree = ttk.Treeview(self, columns=('status', 'progress', 'detail'), selectmode='none', height=1)
+        self.tree.heading('#0', text='File', anchor='w')
+        self.tree.heading('status', text='Status', anchor='w')
+        self.tree.heading('progress', text='Passes', anchor='w')
+        self.tree.heading('detail', text='Detail', anchor='w')
+        self.tree.column('#0', width=220, stretch=True)
+        self.tree.column('status', width=70, stretch=False)
+        self.tree.column('progress', width=60, stretch=False)
+        self.tree.column('detail', width=280, stretch=True)
+        self.scrollbar = ttk.Scrollbar(self, orient='vertical', command=self.on_scrollbar)
+        self.tree.grid(row=0, column=0, sticky='news')
+        self.scrollbar.grid(row=0, column=1, sticky='ns')
+        self.rowconfigure(0, weight=1)
         self.columnconfigure(0, weight=1)
 
-    def set_detail(self, message: str):
-        '''For error messages or details
+        self.tree.bind('<Configure>', lambda ev: self.resize(ev.height))
+        self.tree.bind('<MouseWheel>', lambda ev: self.scroll(-3 if ev.delta > 0 else 3))
+        self.tree.bind('<Button-4>', lambda ev: self.scroll(-3))
+        self.tree.bind('<Button-5>', lambda ev: self.scroll(3))
+
+    def row_height(self) -> int:
+        height = ttk.Style(self).lookup('Treeview', 'rowheight')
+        try:
+            return max(1, int(height))
+        except (TypeError, ValueError):
+            return 20
+
+    def resize(self, height: int):
+        #one row's worth is taken by the heading
+        visible = max(1, height // self.row_height() - 1)
+        if visible == self.visible and len(self.items):
+            return
+        self.visible = visible
+        self.refresh(force=True)
+
+    def on_scrollbar(self, action: str, amount: str, unit: str = ''):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * len(self.model)))
+        elif action == 'scroll':
+            step = self.visible if unit == 'pages' else 1
+            self.scroll(int(amount) * step)
+
+    def scroll(self, rows: int):
+        self.scroll_to(self.first + rows)
+
+    def scroll_to(self, first: int):
+        first = max(0, min(first, len(self.model) - self.visible))
+        if first == self.first:
+            return
+        self.first = first
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False):
+        '''Redraws the visible rows, cheap to call when nothing changed.
         '''
-        detail_label = tk.Label(self, anchor='w', justify='left', text=message)
-        detail_label.grid(row=1, column=0, columnspan=3, sticky='we')
-
-    def update_progress(self, done: int, of: int):
-        self.progress['value'] = float(done) / float(of)
-
-    def set_status(self, status: str):
-        self.status_text.set(status)
-
-
-#used https://blog.teclado.com/tkinter-scrollable-frames/ as a base
-class ScrollableFrame(ttk.Frame):
-    def __init__(self, container, *args, **kwargs):
-        super().__init__(container, *args, **kwargs)
-        self.canvas = tk.Canvas(self)
-        scrollbar = ttk.Scrollbar(self, orient='vertical', command=self.canvas.yview)
-        self.scrollable_frame = ttk.Frame(self.canvas)
-
-        self.scrollable_frame.bind(
-            '<Configure>',
-            lambda ev: self.canvas.configure(
-                scrollregion=self.canvas.bbox('all')
-            )
-        )
-
-        self.window = self.canvas.create_window((0,0), window=self.scrollable_frame, anchor='nw')
-        self.canvas.configure(yscrollcommand=scrollbar.set)
-        self.canvas.bind(
-            '<Configure>',
-            lambda ev: self.resize_inner_frame(ev.width)#self.canvas.itemconfig(self.window, width=self.canvas.winfo_width() - 7)
-        )
-        self.canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
-
-    def resize_inner_frame(self, width: int):
-        bw = int(self.canvas.cget('borderwidth'))
-        hlt = int(self.canvas.cget('highlightthickness'))
-        rwidth = width - bw * 2 - hlt * 2
-        self.canvas.itemconfig(self.window, width=rwidth)
+        if not force and self.drawn_version == self.model.version:
+            return
+        self.drawn_version = self.model.version
+        total = len(self.model)
+        self.first = max(0, min(self.first, total - self.visible))
+        count = min(self.visible, total - self.first)
+        while len(self.items) < count:
+            self.items.append(self.tree.insert('', 'end'))
+        while len(self.items) > count:
+            self.tree.delete(self.items.pop())
+        for offset, item in enumerate(self.items):
+            text, values = self.model.row_values(self.first + offset)
+            self.tree.item(item, text=text, values=values)
+        if total:
+            self.scrollbar.set(self.first / total, (self.first + count) / total)
+        else:
+            self.scrollbar.set(0, 1)
 
     def clear(self):
-        for child in self.scrollable_frame.winfo_children():
-            child.destroy()
-        self.scrollable_frame.config(height=1)
-        
\ No newline at end of file
+        self.model.clear()
+        self.first = 0
+        self.refresh(force=True)
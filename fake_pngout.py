@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+'''Deterministic stand-in for pngout, used by benchmark.py.
+
+Accepts the same command lines outfront builds and behaves like pngout
+closely enough to drive every code path: it shrinks files by a fixed
+fraction per filter, answers /c0 on true color PNGs with return code 3 and
+a "; try /c#" hint, returns 2 when a pass can't improve a file and can be
+told to fail some files. Nothing is random, the same input always gives the
+same output, so runs can be compared.
+
+Configured with environment variables:
+
+FAKE_PNGOUT_LATENCY         seconds every run sleeps (default 0.01)
+FAKE_PNGOUT_LATENCY_PER_MB  extra seconds per MB of input (default 0)
+FAKE_PNGOUT_GAIN            fraction removed by the best filter (default 0.02)
+FAKE_PNGOUT_RETRY           0 to accept any /c instead of returning 3 (default 1)
+FAKE_PNGOUT_FAIL_RATE       fraction of files that fail with code 1 (default 0)
+FAKE_PNGOUT_LOG             file each run appends a line to: its seconds past process
+                            start, then the wall clock time it started and ended at
+'''
+import os
+import struct
+import sys
+import time
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+#share of the gain each filter gets, /f5 is best like it often is with the real thing
+FILTER_WEIGHTS = [0.3, 0.6, 0.5, 0.7, 0.8, 1.0, 0.9]
+#bytes at the start of a png that are never cut, signature and IHDR
+HEADER_SIZE = 33
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def is_switch(arg):
+    return arg.startswith('/') and '/' not in arg[1:]
+
+def png_color_type(data):
+    if data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        return None
+    return data[25]
+
+def make_png(width, height, color, body):
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, color, 0, 0, 0)
+    chunk = struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr))
+    return PNG_SIGNATURE + chunk + body
+
+def trial_gain(switches, key):
+    '''Small extra saving for /b, /n and /r runs, different per switch and file.
+    '''
+    gain = 0.0
+    for switch in switches:
+        if switch[:2] in ('/b', '/n', '/r'):
+            gain += (zlib.crc32((switch + str(key)).encode()) % 100) / 50000.0
+    return gain
+
+def main(argv):
+    switches = [arg for arg in argv if is_switch(arg)]
+    files = [arg for arg in argv if not is_switch(arg)]
+    if not files:
+        print('pngout: no input file', file=sys.stderr)
+        return 1
+    source = files[0]
+    target = files[1] if len(files) > 1 else source
+    with open(source, 'rb') as fp:
+        data = fp.read()
+    color = png_color_type(data)
+
+    if '/l' in switches:
+        print('/c%d /f5 /d8' % (color if color is not None else 2))
+        return 0
+
+    delay = env_float('FAKE_PNGOUT_LATENCY', 0.01) + env_float('FAKE_PNGOUT_LATENCY_PER_MB', 0) * len(data) / 1048576
+    if delay > 0:
+        time.sleep(delay)
+
+    key = zlib.crc32(data[:256])
+    if (key % 10000) < env_float('FAKE_PNGOUT_FAIL_RATE', 0) * 10000:
+        print('Error: fake failure')
+        return 1
+
+    values = dict((switch[:2], switch[2:]) for switch in switches)
+    requested_color = int(values.get('/c', '0') or 0)
+    filter = int(values.get('/f', '5') or 5)
+    if color in (2, 6) and requested_color == 0 and os.environ.get('FAKE_PNGOUT_RETRY', '1') != '0':
+        print(' In: %d bytes  %s /c%d\n; try /c%d' % (len(data), source, color, color))
+        return 3
+
+    if color is None:
+        #conversion, the body stands in for the compressed pixels
+        body = data[:max(1, len(data) - HEADER_SIZE)]
+        data = make_png(64, 64, 2, body)
+    gain = env_float('FAKE_PNGOUT_GAIN', 0.02) * FILTER_WEIGHTS[filter % len(FILTER_WEIGHTS)]
+    gain += trial_gain(switches, key)
+    cut = int(len(data) * gain)
+    result = data[:max(HEADER_SIZE, len(data) - cut)]
+    if len(result) >= len(data) and source == target:
+        print(' In: %d bytes\nUnable to compress further: copying original file' % len(data))
+        return 2
+    with open(target, 'wb') as fp:
+        fp.write(result)
+    print(' In: %d bytes\nOut: %d bytes' % (len(data), len(result)))
+    return 0
+
+if __name__ == '__main__':
+    start, started = time.monotonic(), time.time()
+    code = main(sys.argv[1:])
+    log = os.environ.get('FAKE_PNGOUT_LOG', '')
+    if log:
+        with open(log, 'a') as fp:
+            fp.write('%f %f %f\n' % (time.monotonic() - start, started, time.time()))
+    sys.exit(code)
@@ -4,9 +4,14 @@
 #nuitka-project: --windows-console=disable
 #nuitka-project: --windows-icon-from-ico={MAIN_DIRECTORY}/icon.ico
 
-from app import App
+import sys
 
 def main():
+    #any arguments means headless mode, keep tkinter out of the import path
+    if len(sys.argv) > 1:
+        from cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+    from app import App
     app = App()
     app.title('outfront')
     app.mainloop()
@@ -0,0 +1,312 @@
+'''asyncio engine, an alternative to one OS thread per worker.
+
+Every pngout process is started with asyncio.create_subprocess_exec on a
+single event loop, with a semaphore limiting how many run at once. Discovery,
+scheduling, the result cache and the event stream are shared with the thread
+engine, so the GUI and CLI can't tell the two apart. Unit steps that copy
+or replace files run in the default executor so the loop never waits on disk.
+'''
+import asyncio
+import inspect
+from asyncio.subprocess import PIPE
+from pathlib import Path
+from time import monotonic
+from typing import Any, Awaitable, Callable
+from pngunit import PngUnit, PngUnitException, PngUnitCanceled, UnitRecord, WorkOrder, Schedule
+from pngjournal import JournalState
+from pngthreads import (Manager, STOP, describe_error, SessionStartEvent, SessionEndEvent, PngUpdateEvent,
+                        post_unit_event, check_unit, finish_unit, fail_unit)
+
+async def settle(future: asyncio.Future) -> bool:
+    '''Waits for future through any number of cancels, returning whether there were any.
+
+    Cancels can arrive more than once, a trial is canceled both through its
+    unit's gather and by run_trials itself.
+    '''
+    canceled = False
+    while not future.done():
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            canceled = True
+    return canceled
+
+async def uninterrupted[T](awaitable: Awaitable[T], discard: Callable[[T], Any] | None = None) -> T:
+    '''Awaits awaitable and lets it finish when the caller is canceled.
+
+    A result that arrives too late is handed to discard, awaited if it
+    returns an awaitable, before the cancel is raised.
+    '''
+    future = asyncio.ensure_future(awaitable)
+    if not await settle(future):
+        return future.result()
+    if discard is not None and not future.cancelled() and future.exception() is None:
+        cleanup = discard(future.result())
+        if inspect.isawaitable(cleanup):
+            await settle(asyncio.ensure_future(cleanup))
+    raise asyncio.CancelledError
+
+async def in_thread[T](function: Callable[..., T], *args, discard: Callable[[T], Any] | None = None) -> T:
+    '''asyncio.to_thread that lets function finish when the caller is canceled.
+
+    Cleanup after a cancel then never races a copy still being written.
+    '''
+    return await uninterrupted(asyncio.to_thread(function, *args), discard)
+
+async def reap(process: asyncio.subprocess.Process):
+    '''Kills process and waits for it, through any further cancels.
+
+    Its transport is only closed once it has exited and its pipes are read
+    to the end, one left behind would be closed by the garbage collector
+    after the loop is gone.
+    '''
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    if await settle(asyncio.ensure_future(process.communicate())):
+        raise asyncio.CancelledError
+
+async def to_completion[T](function: Callable[..., T], *args) -> T:
+    '''Runs a step that may post a unit's outcome in a thread, finishing it even if the task is canceled.
+
+    The cancel is dropped rather than raised afterwards, callers check the
+    stop event instead, so a unit is never reported twice.
+    '''
+    future = asyncio.ensure_future(asyncio.to_thread(function, *args))
+    if await settle(future):
+        task = asyncio.current_task()
+        assert task is not None
+        while task.uncancel():
+            pass
+    return future.result()
+
+class AsyncManager(Manager):
+    def __init__(self, workorder: WorkOrder, **kwargs):
+        super().__init__(workorder, **kwargs)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.work_queue: asyncio.Queue
+        #limits units in flight
+        self.unit_slots: asyncio.Semaphore
+        #limits pngout processes, parallel filter trials share these
+        self.process_slots: asyncio.Semaphore
+        #units wait for the resource budget one at a time, in arrival order
+        self.admission_lock: asyncio.Lock
+        self.budget_freed: asyncio.Event
+        self.tasks: set[asyncio.Task] = set()
+        #current width of unit_slots and process_slots, changed by the pool tuner
+        self.slot_count: int = workorder.threads
+        self.holds: set[asyncio.Task] = set()
+
+    def run(self):
+        asyncio.run(self.run_session())
+
+    async def run_session(self):
+        wo = self.workorder
+        self.loop = asyncio.get_running_loop()
+        #one spare place so a stop can always post STOP with discovery waiting to put its next unit
+        size = wo.queue_limit + 1 if wo.queue_limit else 0
+        self.work_queue = asyncio.Queue(size) if wo.schedule == Schedule.FIFO else asyncio.PriorityQueue(size)
+        self.unit_slots = asyncio.Semaphore(wo.threads)
+        self.process_slots = asyncio.Semaphore(wo.threads)
+        self.admission_lock = asyncio.Lock()
+        self.budget_freed = asyncio.Event()
+        self.EVENT_QUEUE.put(SessionStartEvent())
+        error = ''
+        dispatcher: asyncio.Task | None = None
+        try:
+            self.open_session()
+            self.start_tuner()
+            dispatcher = asyncio.create_task(self.dispatch())
+            #scanning blocks, so it runs in a thread and hands units back to the loop
+            await asyncio.to_thread(self.discover)
+            if not self.stop_event.is_set():
+                #after a stop cancel_tasks has already sent it
+                await self.work_queue.put(STOP)
+            await dispatcher
+        except Exception as e:
+            error = describe_error(e)
+            self.stop_event.set()
+            self.cancel_tasks()
+        finally:
+            if dispatcher is not None:
+                await asyncio.gather(dispatcher, return_exceptions=True)
+            if len(self.tasks):
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            await asyncio.to_thread(self.stop_tuner)
+            await asyncio.to_thread(self.close_session)
+            #always sent, front ends wait for it
+            self.EVENT_QUEUE.put(SessionEndEvent(error))
+
+    def discover(self):
+        self.process_paths(self.workorder)
+        self.release_units()
+
+    def dispatch_unit(self, unit: PngUnit | UnitRecord):
+        #called from the discovery thread, waits while the queue is full
+        assert self.loop is not None
+        asyncio.run_coroutine_threadsafe(self.work_queue.put(unit), self.loop).result()
+
+    async def dispatch(self):
+        while True:
+            unit = await self.work_queue.get()
+            if unit is STOP or self.stop_event.is_set():
+                return
+            await self.unit_slots.acquire()
+            if self.stop_event.is_set():
+                self.unit_slots.release()
+                return
+            task = asyncio.create_task(self.process_unit(self.open_unit(unit)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def process_unit(self, unit: PngUnit):
+        demand: tuple[int, int] | None = None
+        try:
+            signature = await to_completion(check_unit, unit, self.cache, self.journal)
+            if signature is None:
+                return
+            if self.stop_event.is_set():
+                raise PngUnitCanceled('Canceled')
+            demand = await self.admit(unit)
+            await in_thread(unit.start_stats)
+            await self.record_state(JournalState.PASS, unit, number=unit.get_pass_done())
+            post_unit_event(unit, PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
+            if unit.parallel:
+                await self.run_trials(unit)
+            else:
+                while len(unit.filters_left):
+                    filter, command = await in_thread(unit.next_command)
+                    assert unit.work_path is not None
+                    returncode, stdout = await self.execute(unit, command, unit.work_path, filter)
+                    await in_thread(unit.handle_result, filter, returncode, stdout)
+                    await self.record_state(JournalState.PASS, unit, number=unit.get_pass_done())
+                    post_unit_event(unit, PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
+            await to_completion(finish_unit, unit, self.cache, self.journal, signature)
+        except asyncio.CancelledError:
+            #stop was requested, processes were killed when the task was canceled
+            await to_completion(fail_unit, unit, self.journal, PngUnitCanceled('Canceled'))
+        except Exception as e:
+            await to_completion(fail_unit, unit, self.journal, e)
+        finally:
+            if demand is not None:
+                assert self.budget is not None
+                self.budget.release(*demand)
+                self.budget_freed.set()
+            try:
+                await in_thread(unit.discard)
+            finally:
+                self.unit_slots.release()
+
+    async def record_state(self, state: JournalState, unit: PngUnit, signature: str = '', **extra):
+        '''Manager.record off the loop, the journal stats the output and fsyncs.
+        '''
+        if self.journal is not None:
+            await asyncio.to_thread(self.journal.record, state, unit, signature, **extra)
+
+    async def admit(self, unit: PngUnit) -> tuple[int, int] | None:
+        if self.budget is None:
+            return None
+        demand = await asyncio.to_thread(unit.get_demand)
+        async with self.admission_lock:
+            while not self.budget.try_acquire(*demand):
+                self.budget_freed.clear()
+                await self.budget_freed.wait()
+        return demand
+
+    async def run_trials(self, unit: PngUnit):
+        unit.plan_filters()
+        if not await in_thread(unit.color_known):
+            #one trial asks pngout for the color alone, the rest then start with its answer
+            await self.run_trial(unit, unit.filters_left[0], settle=True)
+        trials = [ asyncio.create_task(self.run_trial(unit, filter)) for filter in unit.filters_left ]
+        try:
+            await asyncio.gather(*trials)
+        except BaseException:
+            for trial in trials:
+                trial.cancel()
+            await asyncio.gather(*trials, return_exceptions=True)
+            raise
+        await in_thread(unit.finish_trials)
+
+    async def run_trial(self, unit: PngUnit, filter: int, settle: bool = False):
+        temp_path = await in_thread(unit.prepare_trial, filter, discard=lambda path: path.unlink(missing_ok=True))
+        try:
+            color: int | None = unit.color_number
+            while color is not None:
+                returncode, stdout = await self.execute(unit, unit.build_command(filter, temp_path, color), temp_path, filter)
+                color = unit.check_trial_result(returncode, stdout, color, settle)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        unit.trial_results[filter] = temp_path
+        unit.filters_left.remove(filter)
+        await self.record_state(JournalState.PASS, unit, number=unit.get_pass_done())
+        post_unit_event(unit, PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
+
+    async def execute(self, unit: PngUnit, command: list[str], target: Path, filter: int) -> tuple[int, str]:
+        """Runs pngout on target and logs the run with the unit.
+
+        The event loop reaps its children itself, so CPU time isn't known here.
+        """
+        async with self.process_slots:
+            size_before = unit.pass_input_size(target)
+            started = monotonic()
+            #a cancel during the spawn would otherwise leave the started process unreaped
+            process = await uninterrupted(asyncio.create_subprocess_exec(*command, stdout=PIPE, stderr=PIPE), reap)
+            PngUnit.tune_process(process.pid)
+            try:
+                stdout, _ = await asyncio.wait_for(process.communicate(), PngUnit.PROCESS_TIMEOUT)
+            except TimeoutError:
+                await reap(process)
+                raise PngUnitException('pngout timed out', f'No result after {PngUnit.PROCESS_TIMEOUT} seconds')
+            except asyncio.CancelledError:
+                await reap(process)
+                raise
+            finally:
+                unit.log_pass('pass', filter, command, target, size_before, monotonic() - started, None, process.returncode)
+            assert process.returncode is not None
+            return process.returncode, stdout.decode(errors='replace')
+
+    def pool_size(self) -> int:
+        return self.slot_count
+
+    def busy_workers(self) -> int:
+        return len(self.tasks)
+
+    def resize_workers(self, size: int):
+        #called from the tuner thread
+        assert self.loop is not None
+        self.loop.call_soon_threadsafe(self.resize_slots, size)
+
+    def resize_slots(self, size: int):
+        change = size - self.slot_count
+        self.slot_count = size
+        for _ in range(change):
+            self.unit_slots.release()
+            self.process_slots.release()
+        #shrinking holds on to slots as they come free, for the rest of the session
+        for _ in range(-change):
+            hold = asyncio.create_task(self.hold_slot())
+            #the loop only keeps weak references to tasks
+            self.holds.add(hold)
+
+    async def hold_slot(self):
+        await self.unit_slots.acquire()
+        await self.process_slots.acquire()
+
+    def stop(self):
+        """Cancels every running unit, killing its pngout processes.
+        """
+        self.stop_event.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.cancel_tasks)
+
+    def cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+        #queued units are dropped, which also frees discovery if it's waiting for room
+        while not self.work_queue.empty():
+            self.work_queue.get_nowait()
+        #wake the dispatcher if it's waiting for work
+        self.work_queue.put_nowait(STOP)
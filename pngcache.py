@@ -0,0 +1,140 @@
+'''Persistent record of files that have already been optimized.
+
+Results are keyed by a hash of the optimized file's content plus the set of
+filters and switches used, so an unchanged file can be skipped before pngout
+is ever started. A second table remembers the hash of each path by size and
+modification time so unchanged files don't even need to be read again. A third table counts
+which filter won for each kind of image so later sessions can try it first.
+'''
+from pathlib import Path
+from threading import Lock
+from dataclasses import dataclass
+from time import time
+import hashlib
+import mmap
+import os
+import sqlite3
+from pngunit import PngUnit, FilterList, SwitchList, FilterRanking
+
+DEFAULT_CACHE_PATH = Path.cwd() / 'outfront_cache.sqlite3'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    hash TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    final_switches TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (hash, signature)
+);
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS filter_wins (
+    features TEXT NOT NULL,
+    filter INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    PRIMARY KEY (features, filter)
+);
+'''
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        #mmap can't map an empty file
+        if size:
+            #hashing the whole mapping in one call releases the GIL for the duration
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+def make_signature(filters: FilterList, extra_switches: SwitchList, min_gain: float | None = None,
+                   filter_limit: int | None = None) -> str:
+    filter_text = ','.join(str(filter) for filter in sorted(filters))
+    signature = f'{filter_text}|{" ".join(sorted(extra_switches))}'
+    #runs that may skip filters aren't interchangeable with ones that tried them all
+    if min_gain is not None:
+        signature += f'|stop={min_gain}'
+    if filter_limit is not None:
+        signature += f'|top={filter_limit}'
+    return signature
+
+def unit_signature(unit: PngUnit) -> str:
+    return make_signature(unit.filters, unit.extra_switches, unit.min_gain, unit.filter_limit)
+
+@dataclass
+class CacheEntry:
+    hash: str
+    size: int
+    final_switches: str
+    recorded: float
+
+class ResultCache:
+    '''Thread safe, one connection shared by every worker.
+    '''
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+
+    def content_hash(self, path: Path) -> str:
+        '''Hash of a file's content, reusing the stored one if size and mtime are unchanged.
+        '''
+        stat = path.stat()
+        key = str(path.resolve())
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, hash FROM paths WHERE path = ?', (key,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        content = hash_file(path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO paths (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)',
+                                    (key, stat.st_size, stat.st_mtime_ns, content))
+            self.connection.commit()
+        return content
+
+    def lookup(self, path: Path, signature: str) -> CacheEntry | None:
+        content = self.content_hash(path)
+        with self.lock:
+            row = self.connection.execute('SELECT size, final_switches, recorded FROM results WHERE hash = ? AND signature = ?',
+                                          (content, signature)).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(content, row[0], row[1], row[2])
+
+    def record(self, path: Path, signature: str, final_switches: str):
+        '''Remember path's current content as the optimized result for signature.
+        '''
+        content = self.content_hash(path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO results (hash, signature, size, final_switches, recorded) VALUES (?, ?, ?, ?, ?)',
+                                    (content, signature, size, final_switches, time()))
+            self.connection.commit()
+
+    def record_win(self, features: str, filter: int):
+        with self.lock:
+            self.connection.execute('INSERT INTO filter_wins (features, filter, wins) VALUES (?, ?, 1) '
+                                    'ON CONFLICT (features, filter) DO UPDATE SET wins = wins + 1',
+                                    (features, filter))
+            self.connection.commit()
+
+    def load_ranking(self, ranking: FilterRanking):
+        '''Seeds ranking with the wins recorded by earlier sessions.
+        '''
+        with self.lock:
+            rows = self.connection.execute('SELECT features, filter, wins FROM filter_wins').fetchall()
+        for features, filter, wins in rows:
+            ranking.record_win(filter, features, wins)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,82 @@
+'''Finds byte-identical inputs so each distinct image is only optimized once.
+
+Units are grouped by size first, only same-sized units are hashed, and the
+hashing runs in a thread pool. The first unit of each group becomes the
+representative that gets optimized, and its result is copied or hard linked
+to the rest of the group when it finishes.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+import shutil
+import tempfile
+from pngunit import PngUnit
+from pngcache import hash_file
+
+def find_duplicates(units: list[PngUnit], threads: int = 4, link: bool = False) -> list[PngUnit]:
+    '''Returns the units that still need optimizing, in their original order.
+
+    Units left out are attached to their representative's duplicates list.
+    '''
+    by_size: dict[tuple[str, int], list[PngUnit]] = {}
+    for unit in units:
+        #already converted inputs are skipped by the worker, keep them out of groups
+        if unit.already_converted():
+            continue
+        by_size.setdefault((unit.type, unit.size), []).append(unit)
+    candidates = [ unit for group in by_size.values() if len(group) > 1 for unit in group ]
+    if not len(candidates):
+        return units
+
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='hash') as pool:
+        hashes = list(pool.map(safe_hash, [ unit.path for unit in candidates ]))
+
+    representatives: dict[tuple[str, int, str], PngUnit] = {}
+    duplicate_ids: set[int] = set()
+    for unit, content in zip(candidates, hashes):
+        if content is None:
+            continue
+        key = (unit.type, unit.size, content)
+        representative = representatives.setdefault(key, unit)
+        if representative is not unit:
+            representative.duplicates.append(unit)
+            representative.link_duplicates = link
+            duplicate_ids.add(unit.id)
+    return [ unit for unit in units if unit.id not in duplicate_ids ]
+
+def safe_hash(path: Path) -> str | None:
+    try:
+        return hash_file(path)
+    except OSError:
+        #unreadable files are left for the worker to report
+        return None
+
+def copy_to_duplicates(unit: PngUnit):
+    '''Gives every duplicate the representative's optimized output.
+    '''
+    source = unit.make_output_path()
+    for duplicate in unit.duplicates:
+        output = duplicate.make_output_path()
+        if unit.is_png() and unit.final_size == unit.size:
+            #nothing changed, the duplicate already has identical bytes
+            continue
+        handle, name = tempfile.mkstemp(prefix=f'{PngUnit.TEMP_PREFIX}{output.stem}-dup-', suffix='.png', dir=output.parent)
+        os.close(handle)
+        temp_path = Path(name)
+        try:
+            if not unit.link_duplicates or not try_link(source, temp_path):
+                shutil.copyfile(source, temp_path)
+                shutil.copymode(duplicate.path, temp_path)
+            os.replace(temp_path, output)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+def try_link(source: Path, temp_path: Path) -> bool:
+    try:
+        temp_path.unlink()
+        os.link(source, temp_path)
+        return True
+    except OSError:
+        #different file system or no hard link support
+        return False
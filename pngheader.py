@@ -0,0 +1,165 @@
+'''Reads image headers without decoding any pixels.
+
+Only the first few hundred bytes of a file are needed in the common case, so
+this is far cheaper than asking pngout. The result is used to pick a pngout
+color type (/c) before the first pass, when the header is enough to tell, and
+to group images with similar filter behaviour. Color types use the PNG numbering, which is also
+what pngout's /c switch takes.
+'''
+from pathlib import Path
+from dataclasses import dataclass
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+COLOR_GRAY = 0
+COLOR_RGB = 2
+COLOR_PALETTE = 3
+COLOR_GRAY_ALPHA = 4
+COLOR_RGBA = 6
+
+#stop looking for PLTE/tRNS after this many chunks, they must come before IDAT anyway
+_MAX_PNG_CHUNKS = 64
+#SOFn markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+_JPEG_FRAME_MARKERS = set(range(0xC0, 0xD0)) - { 0xC4, 0xC8, 0xCC }
+
+@dataclass
+class ImageHeader:
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+    #every palette entry has equal red, green and blue
+    gray_palette: bool = False
+    transparency: bool = False
+    #true color files can often be reduced to a palette or gray, which only the pixels can tell
+    decided: bool = True
+
+    def suggest_color(self) -> int | None:
+        '''The smallest pngout /c value that holds this image losslessly, None if pngout has to be asked.
+        '''
+        if not self.decided:
+            return None
+        if self.color_type == COLOR_PALETTE and self.gray_palette and not self.transparency:
+            return COLOR_GRAY
+        return self.color_type
+
+def read_header(path: Path) -> ImageHeader | None:
+    '''Parses the header of a supported image, None if the type isn't understood or the file is damaged.
+    '''
+    reader = _READERS.get(path.suffix.lower(), None)
+    if reader is None:
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            return reader(fp)
+    except (OSError, struct.error, ValueError):
+        return None
+
+def is_gray_palette(palette: bytes, stride: int) -> bool:
+    '''palette entries are stride bytes long, the first three being the color channels.
+    '''
+    for offset in range(0, len(palette) - stride + 1, stride):
+        a, b, c = palette[offset:offset + 3]
+        if not a == b == c:
+            return False
+    return True
+
+def read_png(fp) -> ImageHeader | None:
+    if fp.read(8) != PNG_SIGNATURE:
+        return None
+    length, kind = struct.unpack('>I4s', fp.read(8))
+    if kind != b'IHDR' or length != 13:
+        return None
+    width, height, depth, color = struct.unpack('>IIBB', fp.read(10))
+    header = ImageHeader(width, height, depth, color, decided=color in (COLOR_GRAY, COLOR_PALETTE))
+    #skip the rest of IHDR and its crc
+    fp.seek(7, 1)
+    for _ in range(_MAX_PNG_CHUNKS):
+        chunk = fp.read(8)
+        if len(chunk) < 8:
+            break
+        length, kind = struct.unpack('>I4s', chunk)
+        if kind in (b'IDAT', b'IEND'):
+            break
+        if kind == b'PLTE':
+            header.gray_palette = is_gray_palette(fp.read(length), 3)
+            fp.seek(4, 1)
+            continue
+        if kind == b'tRNS':
+            header.transparency = True
+        fp.seek(length + 4, 1)
+    return header
+
+def read_gif(fp) -> ImageHeader | None:
+    data = fp.read(13)
+    if data[:6] not in (b'GIF87a', b'GIF89a'):
+        return None
+    width, height, packed = struct.unpack('<HHB', data[6:11])
+    depth = (packed & 0x07) + 1
+    header = ImageHeader(width, height, depth, COLOR_PALETTE)
+    if packed & 0x80:
+        header.gray_palette = is_gray_palette(fp.read(3 * 2 ** depth), 3)
+    return header
+
+def read_bmp(fp) -> ImageHeader | None:
+    data = fp.read(18)
+    if data[:2] != b'BM':
+        return None
+    dib_size = struct.unpack('<I', data[14:18])[0]
+    if dib_size == 12:
+        #OS/2 core header, three byte palette entries
+        width, height, _, bpp = struct.unpack('<HHHH', fp.read(8))
+        compression = 0
+        colors_used = 0
+        stride = 3
+    elif dib_size >= 40:
+        width, height, _, bpp, compression = struct.unpack('<iiHHI', fp.read(16))
+        fp.seek(12, 1)
+        colors_used = struct.unpack('<I', fp.read(4))[0]
+        stride = 4
+    else:
+        return None
+    width = abs(width)
+    #negative height means the rows are stored top down
+    height = abs(height)
+    if bpp <= 8:
+        header = ImageHeader(width, height, bpp, COLOR_PALETTE)
+        fp.seek(14 + dib_size)
+        count = colors_used or 2 ** bpp
+        header.gray_palette = is_gray_palette(fp.read(count * stride), stride)
+        return header
+    #32 bit files only carry real alpha when bitfields or a v4+ header describe it
+    has_alpha = bpp == 32 and dib_size >= 56 and compression in (3, 6)
+    return ImageHeader(width, height, 8, COLOR_RGBA if has_alpha else COLOR_RGB, decided=False)
+
+def read_jpeg(fp) -> ImageHeader | None:
+    if fp.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        #fill bytes and standalone markers have no length
+        if code == 0xFF:
+            fp.seek(-1, 1)
+            continue
+        if code in (0x01, 0xD8) or 0xD0 <= code <= 0xD7:
+            continue
+        if code in (0xD9, 0xDA):
+            #end of image or start of scan before any frame header
+            return None
+        length = struct.unpack('>H', fp.read(2))[0]
+        if code in _JPEG_FRAME_MARKERS:
+            depth, height, width, components = struct.unpack('>BHHB', fp.read(6))
+            #lossy photos practically never fit a palette, so true color is a safe start
+            return ImageHeader(width, height, depth, COLOR_GRAY if components == 1 else COLOR_RGB)
+        fp.seek(length - 2, 1)
+
+_READERS = {
+    '.png': read_png,
+    '.gif': read_gif,
+    '.bmp': read_bmp,
+    '.jpg': read_jpeg,
+}
@@ -0,0 +1,104 @@
+'''Append-only record of unit states so an interrupted session can be resumed.
+
+Each line is a JSON object. Lines are flushed as they are written so a
+crashed process loses nothing, and synced to disk at most once a second so a
+power cut loses very little. A torn last line is ignored when reading.
+'''
+from pathlib import Path
+from threading import Lock
+from enum import Enum
+from time import time
+import json
+import os
+from pngunit import PngUnit, UnitRecord
+
+DEFAULT_JOURNAL_PATH = Path.cwd() / 'outfront_journal.jsonl'
+
+class JournalState(Enum):
+    QUEUED = 'queued'
+    PASS = 'pass'
+    DONE = 'done'
+    SKIPPED = 'skipped'
+    ERROR = 'error'
+
+#states that mean a file needs no more work
+_FINISHED = (JournalState.DONE.value, JournalState.SKIPPED.value)
+
+class Journal:
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, path: Path = DEFAULT_JOURNAL_PATH, resume: bool = False):
+        self.path = path
+        self.lock = Lock()
+        #path -> (size, mtime_ns, signature) of files finished by an earlier run
+        self.finished: dict[str, tuple[int, int, str]] = {}
+        #paths that were started but never finished
+        self.partial: set[str] = set()
+        if resume:
+            self.load()
+        self.fp = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self.last_sync = time()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        started: set[str] = set()
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                    path = record['path']
+                    state = record['state']
+                except (ValueError, KeyError):
+                    #torn write from a crash
+                    continue
+                if state in _FINISHED:
+                    self.finished[path] = (record['size'], record['mtime_ns'], record['signature'])
+                    started.discard(path)
+                elif state == JournalState.PASS.value:
+                    started.add(path)
+                    self.finished.pop(path, None)
+        self.partial = started
+
+    def is_finished(self, unit: PngUnit, signature: str) -> bool:
+        '''True if an earlier run finished this file and it hasn't changed since.
+        '''
+        entry = self.finished.get(str(unit.make_output_path()), None)
+        if entry is None:
+            return False
+        try:
+            stat = unit.make_output_path().stat()
+        except OSError:
+            return False
+        return entry == (stat.st_size, stat.st_mtime_ns, signature)
+
+    def was_partial(self, unit: PngUnit) -> bool:
+        return str(unit.make_output_path()) in self.partial
+
+    def record(self, state: JournalState, unit: PngUnit | UnitRecord, signature: str = '', **extra):
+        record = { 'time': time(), 'state': state.value, 'path': str(unit.make_output_path()) }
+        if state.value in _FINISHED:
+            #identifies the finished file so a later change gets it processed again
+            stat = unit.make_output_path().stat()
+            record['size'] = stat.st_size
+            record['mtime_ns'] = stat.st_mtime_ns
+            record['signature'] = signature
+        record.update(extra)
+        line = json.dumps(record) + '\n'
+        if state != JournalState.PASS:
+            #duplicates share their representative's fate
+            for duplicate in unit.duplicates:
+                self.record(state, duplicate, signature, **extra)
+        with self.lock:
+            self.fp.write(line)
+            self.fp.flush()
+            now = time()
+            if now - self.last_sync >= self.SYNC_INTERVAL:
+                os.fsync(self.fp.fileno())
+                self.last_sync = now
+
+    def close(self):
+        with self.lock:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.fp.close()
@@ -0,0 +1,149 @@
+'''Sizes the worker pool to the machine's measured load.
+
+A PoolTuner thread samples the load average and the CPU time used by our
+pngout processes every few seconds and moves the pool one worker at a time
+towards the number of cores nobody else is using. Running processes are read
+from /proc, since child rusage only covers the ones already reaped. Without
+/proc every busy worker is counted as a full core. Where the load average
+isn't available (Windows) the pool keeps its starting size.
+'''
+from threading import Thread, Event
+from typing import Protocol
+from time import monotonic
+import os
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def usable_cores(affinity: set[int] | None = None) -> int:
+    if affinity:
+        return len(affinity)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def system_load() -> float | None:
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+def children_cpu_time() -> float:
+    '''CPU seconds used by finished child processes, pngout included.
+    '''
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def running_children_stats() -> list[list[bytes]] | None:
+    '''/proc stat fields of each running child process from the state on, None without /proc.
+    '''
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return None
+    parent = os.getpid()
+    children = []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as fp:
+                stat = fp.read()
+        except OSError:
+            #exited since the listing
+            continue
+        #the name before the fields is in parentheses and may contain anything
+        fields = stat[stat.rfind(b')') + 2:].split()
+        if len(fields) < 22 or int(fields[1]) != parent:
+            continue
+        children.append(fields)
+    return children
+
+def running_children_cpu_time() -> float | None:
+    '''CPU seconds used so far by child processes still running, None without /proc.
+    '''
+    try:
+        ticks = os.sysconf('SC_CLK_TCK')
+    except (AttributeError, ValueError):
+        return None
+    children = running_children_stats()
+    if children is None:
+        return None
+    #utime and stime, in clock ticks
+    return sum( int(fields[11]) + int(fields[12]) for fields in children ) / ticks
+
+def choose_pool_size(current: int, busy: int, cores: int, load: float, own_rate: float,
+                     minimum: int = 1, maximum: int | None = None) -> int:
+    '''Pool size for the next interval, at most one worker away from current.
+
+    own_rate is the CPU seconds per second our pngout processes used, so
+    load - own_rate is what everyone else is putting on the machine. Workers
+    that spend time waiting on disk use less than a core each, so more of
+    them fit in the same idle cores.
+    '''
+    maximum = maximum or cores * 2
+    outside = max(0.0, load - own_rate)
+    idle = cores - outside
+    per_worker = min(1.0, own_rate / busy) if busy and own_rate > 0 else 1.0
+    target = int(idle / max(per_worker, 0.25))
+    target = max(minimum, min(maximum, target))
+    #idle workers already, growing won't help
+    if target > current and busy < current:
+        return current
+    if target > current:
+        return current + 1
+    if target < current:
+        return current - 1
+    return current
+
+class ResizablePool(Protocol):
+    def pool_size(self) -> int: ...
+    def busy_workers(self) -> int: ...
+    def resize_workers(self, size: int): ...
+
+class PoolTuner(Thread):
+    INTERVAL: float = 3.0
+
+    def __init__(self, pool: ResizablePool, cores: int, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+        self.cores = cores
+        self.done = Event()
+
+    def run(self):
+        if system_load() is None:
+            return
+        last_time = monotonic()
+        last_cpu = self.own_cpu_time()
+        while not self.done.wait(self.INTERVAL):
+            now = monotonic()
+            cpu = self.own_cpu_time()
+            own_rate = (cpu - last_cpu) / max(now - last_time, 1e-6) if cpu is not None and last_cpu is not None else None
+            last_time, last_cpu = now, cpu
+            load = system_load()
+            if load is None:
+                return
+            current = self.pool.pool_size()
+            busy = self.pool.busy_workers()
+            if own_rate is None:
+                #our running pngouts can't be measured, assume each takes a core rather than blaming them on others
+                own_rate = float(busy)
+            size = choose_pool_size(current, busy, self.cores, load, own_rate)
+            if size != current:
+                self.pool.resize_workers(size)
+
+    @staticmethod
+    def own_cpu_time() -> float | None:
+        '''CPU seconds of every pngout this process started, finished or not.
+        '''
+        running = running_children_cpu_time()
+        if running is None:
+            return None
+        return children_cpu_time() + running
+
+    def stop(self):
+        self.done.set()
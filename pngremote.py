@@ -0,0 +1,419 @@
+'''Spreads one work order over several machines.
+
+The coordinator is a normal session started with --listen HOST:PORT. It
+still discovers files, checks the cache and journal and reports progress,
+but every connection from a remote worker becomes one more RemoteWorker
+thread pulling from the same work queue. A RemoteWorker streams the file to
+its connection, relays the remote pngout passes as events and writes the
+result back, so the machines need no shared storage.
+
+Remote workers are started with ``python pngremote.py HOST:PORT --slots N``
+and open one connection per slot. When a connection drops mid-unit the unit
+is queued again for another worker, up to RemoteWorker.MAX_ATTEMPTS times.
+
+Both sides share a token, given with --token or OUTFRONT_TOKEN. The
+coordinator opens each connection with a random challenge and only accepts
+a hello carrying the challenge's HMAC under the token, so the token itself
+never crosses the network.
+
+Messages are JSON lines, each followed by ``length`` bytes of file content.
+'''
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import socket
+import sys
+import tempfile
+from pathlib import Path
+from queue import Queue
+from threading import Thread, Lock
+from time import sleep, monotonic
+from pngunit import PngUnit, PngUnitException, PngUnitCanceled, PngUnitRetry, WorkOrder
+from pngthreads import (Manager, PngWorker, UnitEvent, PngUpdateEvent, PngErrorEvent, PngSkipEvent, PngDoneEvent,
+                        STOP, post_unit_event)
+from pngjournal import JournalState
+
+PROTOCOL_VERSION = 2
+TOKEN_ENVIRONMENT = 'OUTFRONT_TOKEN'
+#longest JSON header accepted, file content doesn't count
+MAX_HEADER = 64 * 1024
+HANDSHAKE_TIMEOUT = 10.0
+
+EVENT_TYPES: dict[str, type[UnitEvent]] = {
+    cls.__name__: cls for cls in (PngUpdateEvent, PngErrorEvent, PngSkipEvent, PngDoneEvent)
+}
+
+def parse_address(text: str) -> tuple[str, int]:
+    host, _, port = text.rpartition(':')
+    #other machines have to be let in by naming the interface, e.g. 0.0.0.0:PORT
+    return host or '127.0.0.1', int(port)
+
+def sign_challenge(token: str, challenge: str) -> str:
+    return hmac.new(token.encode(), challenge.encode(), hashlib.sha256).hexdigest()
+
+def encode_event(event: UnitEvent) -> dict:
+    return { 'type': 'event', 'event': type(event).__name__, 'fields': vars(event) }
+
+def decode_event(message: dict) -> UnitEvent:
+    cls = EVENT_TYPES[message['event']]
+    return cls(**message['fields'])
+
+class Channel:
+    '''One framed connection, safe to send on from several threads.
+    '''
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.reader = sock.makefile('rb')
+        self.send_lock = Lock()
+        self.closed: bool = False
+
+    def send(self, message: dict, payload: bytes = b''):
+        data = json.dumps(dict(message, length=len(payload))).encode() + b'\n'
+        with self.send_lock:
+            self.sock.sendall(data + payload)
+
+    def recv(self) -> tuple[dict, bytes] | None:
+        '''Next message and its payload, None once the connection is closed.
+        '''
+        try:
+            line = self.reader.readline(MAX_HEADER)
+            if not line.endswith(b'\n'):
+                self.closed = True
+                return None
+            message = json.loads(line)
+            length = message.get('length', 0)
+            payload = self.reader.read(length) if length else b''
+        except (OSError, ValueError):
+            self.closed = True
+            return None
+        if len(payload) != length:
+            self.closed = True
+            return None
+        return message, payload
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+#coordinator side
+class RemoteWorker(PngWorker):
+    '''Runs each unit's passes on the other end of a connection, everything else stays local.
+    '''
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, channel: Channel, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channel = channel
+        #a dead connection can't take more work, queued units go to the other workers
+        self.retire = lambda: self.channel.closed
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            if not self.channel.closed:
+                try:
+                    self.channel.send({ 'type': 'bye' })
+                except OSError:
+                    pass
+            self.channel.close()
+
+    def run_passes(self, unit: PngUnit):
+        unit.plan_filters()
+        unit.attempts += 1
+        content = unit.path.read_bytes()
+        try:
+            self.channel.send({
+                'type': 'unit',
+                'name': unit.path.name,
+                'filters': unit.filters,
+                'filters_left': unit.filters_left,
+                'switches': unit.extra_switches,
+                'parallel': unit.parallel,
+                'min_gain': unit.min_gain,
+                'timeout': PngUnit.PROCESS_TIMEOUT,
+            }, content)
+            while True:
+                received = self.channel.recv()
+                if received is None:
+                    raise OSError('Connection closed')
+                message, payload = received
+                if message['type'] == 'event':
+                    event = decode_event(message)
+                    event.id = unit.id
+                    if isinstance(event, PngUpdateEvent):
+                        self.record(JournalState.PASS, unit, number=event.done)
+                    post_unit_event(unit, event)
+                elif message['type'] == 'done':
+                    self.apply_result(unit, message, payload)
+                    return
+                elif message['type'] == 'error':
+                    if self.stop_event.is_set():
+                        raise PngUnitCanceled('Canceled')
+                    raise PngUnitException(message['error'], message.get('detail', ''))
+        except (OSError, KeyError, ValueError) as e:
+            self.channel.close()
+            if self.stop_event.is_set():
+                raise PngUnitCanceled('Canceled')
+            if unit.attempts >= self.MAX_ATTEMPTS:
+                raise PngUnitException('Remote worker lost', str(e))
+            raise PngUnitRetry('Remote worker lost', str(e))
+
+    def apply_result(self, unit: PngUnit, message: dict, payload: bytes):
+        unit.best_filter = message['best_filter']
+        unit.filters_left.clear()
+        if not unit.is_png():
+            unit.converted = True
+        if not len(payload):
+            #the remote couldn't improve on the original
+            return
+        unit.work_path = unit.make_temp('work')
+        unit.work_path.write_bytes(payload)
+        unit.commit_work()
+
+    def stop(self):
+        super().stop()
+        if self.unit is not None and not self.channel.closed:
+            try:
+                self.channel.send({ 'type': 'cancel' })
+            except OSError:
+                self.channel.close()
+
+class RemoteManager(Manager):
+    '''A Manager that also accepts remote workers on workorder.listen.
+
+    The socket is bound when the manager is created so a bad address is
+    reported before the session starts.
+    '''
+    def __init__(self, workorder: WorkOrder, **kwargs):
+        super().__init__(workorder, **kwargs)
+        assert workorder.listen is not None and workorder.listen_token
+        self.token = workorder.listen_token
+        self.listener = socket.create_server(parse_address(workorder.listen))
+        self.remote_workers: list[RemoteWorker] = []
+        self.accepting: bool = True
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.close_listener()
+
+    def open_session(self):
+        super().open_session()
+        #remote workers share the cache and journal, so none are let in before those exist
+        Thread(target=self.accept_workers, name='accept', daemon=True).start()
+
+    def accept_workers(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                #listener closed, the session is over
+                return
+            Thread(target=self.greet, args=(sock,), daemon=True).start()
+
+    def greet(self, sock: socket.socket):
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        channel = Channel(sock)
+        challenge = secrets.token_hex(16)
+        try:
+            channel.send({ 'type': 'challenge', 'challenge': challenge, 'version': PROTOCOL_VERSION })
+        except OSError:
+            channel.close()
+            return
+        received = channel.recv()
+        if received is None or received[0].get('type') != 'hello' or received[0].get('version') != PROTOCOL_VERSION:
+            channel.close()
+            return
+        if not hmac.compare_digest(str(received[0].get('auth', '')), sign_challenge(self.token, challenge)):
+            channel.close()
+            return
+        try:
+            channel.send({ 'type': 'welcome' })
+        except OSError:
+            channel.close()
+            return
+        #passes can take a long time, keepalive notices dead peers instead
+        sock.settimeout(None)
+        with self.pool_lock:
+            if not self.accepting or self.stop_event.is_set():
+                channel.close()
+                return
+            worker = RemoteWorker(channel, cache=self.cache, journal=self.journal, open_unit=self.open_unit, daemon=True)
+            self.remote_workers.append(worker)
+            worker.start()
+
+    def close_listener(self):
+        with self.pool_lock:
+            self.accepting = False
+        self.listener.close()
+
+    def stop_workers(self):
+        self.close_listener()
+        super().stop_workers()
+        for _ in [ worker for worker in self.remote_workers if worker.is_alive() ]:
+            PngWorker.WORK_QUEUE.put(STOP)
+
+    def wait_for_workers(self):
+        super().wait_for_workers()
+        for worker in self.remote_workers:
+            worker.join()
+
+    def stop(self):
+        self.close_listener()
+        for worker in list(self.remote_workers):
+            worker.stop()
+        super().stop()
+
+#remote side
+class RemoteSlot(Thread):
+    '''One connection to the coordinator, running one unit at a time.
+    '''
+    def __init__(self, address: tuple[str, int], token: str, connect_timeout: float, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+        self.token = token
+        self.connect_timeout = connect_timeout
+        self.unit: PngUnit | None = None
+        #false if the coordinator couldn't be reached or turned the slot away
+        self.joined: bool = False
+        self.inbox: Queue[tuple[dict, bytes] | None] = Queue()
+
+    def connect(self) -> Channel | None:
+        deadline = monotonic() + self.connect_timeout
+        while True:
+            try:
+                return Channel(socket.create_connection(self.address))
+            except OSError:
+                #the coordinator may still be starting
+                if monotonic() > deadline:
+                    return None
+                sleep(0.5)
+
+    def run(self):
+        channel = self.connect()
+        if channel is None:
+            print(f'could not connect to {self.address[0]}:{self.address[1]}', file=sys.stderr)
+            return
+        try:
+            with tempfile.TemporaryDirectory(prefix='outfront-remote-') as workdir:
+                if not self.answer_challenge(channel):
+                    print(f'{self.address[0]}:{self.address[1]} refused the connection, check the token and version',
+                          file=sys.stderr)
+                    return
+                self.joined = True
+                Thread(target=self.read, args=(channel,), daemon=True).start()
+                while True:
+                    received = self.inbox.get()
+                    if received is None or received[0]['type'] == 'bye':
+                        return
+                    message, payload = received
+                    if message['type'] == 'unit':
+                        self.run_unit(channel, Path(workdir), message, payload)
+        except OSError:
+            return
+        finally:
+            channel.close()
+
+    def answer_challenge(self, channel: Channel) -> bool:
+        '''True once the coordinator accepted the token, a wrong one just gets the connection closed.
+        '''
+        received = channel.recv()
+        if received is None or received[0].get('type') != 'challenge' or received[0].get('version') != PROTOCOL_VERSION:
+            return False
+        auth = sign_challenge(self.token, str(received[0]['challenge']))
+        channel.send({ 'type': 'hello', 'version': PROTOCOL_VERSION, 'auth': auth })
+        received = channel.recv()
+        return received is not None and received[0].get('type') == 'welcome'
+
+    def read(self, channel: Channel):
+        '''Cancels are handled as soon as they arrive, everything else is queued for run.
+        '''
+        while True:
+            received = channel.recv()
+            if received is not None and received[0]['type'] == 'cancel':
+                unit = self.unit
+                if unit is not None:
+                    unit.terminate()
+                continue
+            self.inbox.put(received)
+            if received is None:
+                #the coordinator went away, stop whatever is running
+                unit = self.unit
+                if unit is not None:
+                    unit.terminate()
+                return
+
+    def run_unit(self, channel: Channel, workdir: Path, message: dict, payload: bytes):
+        path = workdir / Path(message['name']).name
+        path.write_bytes(payload)
+        unit = PngUnit(path, message['filters'], message['switches'], message['parallel'], len(payload), message['min_gain'])
+        unit.filters_left = list(message['filters_left'])
+        PngUnit.PROCESS_TIMEOUT = message['timeout']
+        self.unit = unit
+        try:
+            unit.start_stats()
+            while unit.run_pass():
+                channel.send(encode_event(PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total())))
+            output = unit.make_output_path()
+            improved = not unit.is_png() or output.stat().st_size < len(payload)
+            channel.send({ 'type': 'done', 'best_filter': unit.best_filter }, output.read_bytes() if improved else b'')
+        except PngUnitException as e:
+            channel.send({ 'type': 'error', 'error': str(e), 'detail': e.detail })
+        except OSError:
+            #lost the coordinator, the unit will be handed to someone else
+            pass
+        except Exception as e:
+            channel.send({ 'type': 'error', 'error': 'Unexpected Exception', 'detail': str(e) })
+        finally:
+            self.unit = None
+            unit.discard()
+            path.unlink(missing_ok=True)
+            unit.make_output_path().unlink(missing_ok=True)
+
+def main(argv: list[str] | None = None) -> int:
+    #imported here so the coordinator doesn't pull in the cli
+    from cli import find_pngout, EXIT_OK, EXIT_SESSION_ERROR, EXIT_CANCELED
+    parser = argparse.ArgumentParser(prog='pngremote', description='Remote worker for an outfront session started with --listen')
+    parser.add_argument('address', help='HOST:PORT of the coordinator')
+    parser.add_argument('--slots', type=int, default=os.cpu_count() or 4, help='units to run at once (default: %(default)s)')
+    parser.add_argument('--pngout', type=Path, help='location of the pngout binary (default: config.json or PATH)')
+    parser.add_argument('--connect-timeout', type=float, default=30.0, metavar='SECONDS',
+                        help='keep trying to reach the coordinator this long (default: %(default)s)')
+    parser.add_argument('--token', default=os.environ.get(TOKEN_ENVIRONMENT),
+                        help=f'shared secret given to the coordinator (default: ${TOKEN_ENVIRONMENT})')
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error(f'a token is required, use --token or set {TOKEN_ENVIRONMENT}')
+    try:
+        address = parse_address(args.address)
+    except ValueError:
+        parser.error(f'invalid address: {args.address}')
+    if args.slots < 1:
+        parser.error('slots must be at least 1')
+    pngout = find_pngout(args.pngout)
+    if pngout is None:
+        parser.error('could not find pngout, use --pngout to provide its location')
+    PngUnit.PNGOUT_PATH = pngout
+    slots = [ RemoteSlot(address, args.token, args.connect_timeout, daemon=True) for _ in range(args.slots) ]
+    for slot in slots:
+        slot.start()
+    try:
+        for slot in slots:
+            while slot.is_alive():
+                slot.join(0.5)
+    except KeyboardInterrupt:
+        return EXIT_CANCELED
+    return EXIT_OK if any(slot.joined for slot in slots) else EXIT_SESSION_ERROR
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+'''Machine-readable record of a session, for finding where time goes.
+
+Every pngout run is written with its filter, wall and CPU time and the
+bytes before and after, every file with its queue wait and outcome, and the
+session with its discovery time and makespan. The report is JSON Lines, or
+CSV when the path ends in .csv, one record per line with a "record" column
+telling them apart.
+
+An optional metrics file holds running totals in the Prometheus text format,
+rewritten atomically at most once a second so the node exporter's textfile
+collector (or anything else) can read it mid-session.
+'''
+from pathlib import Path
+from threading import Lock
+from collections import defaultdict
+from time import time, monotonic
+import csv
+import json
+import os
+from pngunit import PngUnit, PassRecord
+
+DEFAULT_REPORT_PATH = Path.cwd() / 'outfront_report.jsonl'
+
+FIELDS = [
+    'record', 'time', 'unit', 'path', 'kind', 'filter', 'switches', 'wall', 'cpu',
+    'size_before', 'size_after', 'returncode', 'status', 'detail', 'queue_wait',
+    'units', 'discovery', 'makespan',
+]
+
+class SessionReport:
+    METRICS_INTERVAL = 1.0
+
+    def __init__(self, path: Path | None = None, metrics_path: Path | None = None):
+        self.path = path
+        self.metrics_path = metrics_path
+        self.lock = Lock()
+        self.fp = None
+        self.writer: csv.DictWriter | None = None
+        if path is not None:
+            self.fp = open(path, 'w', encoding='utf-8', newline='')
+            if path.suffix.lower() == '.csv':
+                self.writer = csv.DictWriter(self.fp, FIELDS)
+                self.writer.writeheader()
+        #running totals for the metrics file, keyed by filter or status
+        self.passes: dict[str, int] = defaultdict(int)
+        self.pass_seconds: dict[str, float] = defaultdict(float)
+        self.pass_cpu_seconds: dict[str, float] = defaultdict(float)
+        self.pass_bytes_saved: dict[str, int] = defaultdict(int)
+        self.units: dict[str, int] = defaultdict(int)
+        self.queue_wait: float = 0.0
+        self.last_metrics: float = 0.0
+
+    def record_pass(self, unit: PngUnit, record: PassRecord):
+        self.write({
+            'record': 'pass',
+            'unit': unit.id,
+            'path': str(unit.path),
+            'kind': record.kind,
+            'filter': record.filter,
+            'switches': record.switches,
+            'wall': round(record.wall, 6),
+            'cpu': None if record.cpu is None else round(record.cpu, 6),
+            'size_before': record.size_before,
+            'size_after': record.size_after,
+            'returncode': record.returncode,
+        })
+        label = 'none' if record.filter is None else str(record.filter)
+        with self.lock:
+            self.passes[label] += 1
+            self.pass_seconds[label] += record.wall
+            self.pass_cpu_seconds[label] += record.cpu or 0.0
+            if record.returncode == 0:
+                self.pass_bytes_saved[label] += max(0, record.size_before - record.size_after)
+        self.update_metrics()
+
+    def record_unit(self, unit: PngUnit, status: str, detail: str = ''):
+        '''Records a finished, failed or skipped file.
+        '''
+        started = getattr(unit, 'time_start', None)
+        finished = getattr(unit, 'time_end', None)
+        queue_wait = None
+        if started is not None and unit.time_queued is not None:
+            queue_wait = max(0.0, started - unit.time_queued)
+        self.write({
+            'record': 'unit',
+            'unit': unit.id,
+            'path': str(unit.path),
+            'status': status,
+            'detail': detail or None,
+            'queue_wait': None if queue_wait is None else round(queue_wait, 6),
+            'wall': round(finished - started, 6) if started is not None and finished is not None else None,
+            'size_before': unit.size,
+            'size_after': unit.final_size,
+        })
+        with self.lock:
+            self.units[status] += 1
+            self.queue_wait += queue_wait or 0.0
+        self.update_metrics()
+
+    def record_session(self, units: int, discovery: float, makespan: float):
+        self.write({
+            'record': 'session',
+            'units': units,
+            'discovery': round(discovery, 6),
+            'makespan': round(makespan, 6),
+        })
+
+    def write(self, row: dict):
+        if self.fp is None:
+            return
+        row['time'] = time()
+        with self.lock:
+            if self.writer is not None:
+                self.writer.writerow(row)
+            else:
+                self.fp.write(json.dumps({ key: value for key, value in row.items() if value is not None }) + '\n')
+            self.fp.flush()
+
+    def update_metrics(self, force: bool = False):
+        if self.metrics_path is None:
+            return
+        now = monotonic()
+        with self.lock:
+            if not force and now - self.last_metrics < self.METRICS_INTERVAL:
+                return
+            self.last_metrics = now
+            temp_path = self.metrics_path.with_name(f'.{self.metrics_path.name}.tmp')
+            try:
+                temp_path.write_text(self.format_metrics(), encoding='utf-8')
+                os.replace(temp_path, self.metrics_path)
+            except OSError:
+                #metrics are best effort, the session carries on without them
+                temp_path.unlink(missing_ok=True)
+
+    def format_metrics(self) -> str:
+        lines: list[str] = []
+        def counter(name: str, help: str, values: dict, label: str):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} counter')
+            for key in sorted(values):
+                lines.append(f'{name}{{{label}="{key}"}} {values[key]}')
+        counter('outfront_passes_total', 'pngout runs by filter.', self.passes, 'filter')
+        counter('outfront_pass_seconds_total', 'Wall time of pngout runs by filter.', self.pass_seconds, 'filter')
+        counter('outfront_pass_cpu_seconds_total', 'CPU time of pngout runs by filter.', self.pass_cpu_seconds, 'filter')
+        counter('outfront_pass_bytes_saved_total', 'Bytes removed by pngout runs by filter.', self.pass_bytes_saved, 'filter')
+        counter('outfront_units_total', 'Files finished by outcome.', self.units, 'status')
+        lines.append('# HELP outfront_queue_wait_seconds_total Time files spent queued before starting.')
+        lines.append('# TYPE outfront_queue_wait_seconds_total counter')
+        lines.append(f'outfront_queue_wait_seconds_total {self.queue_wait}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.update_metrics(force=True)
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
@@ -0,0 +1,87 @@
+'''Directory discovery built on os.scandir.
+
+The dirent type is used to tell files from directories and each matching
+image is stat'ed exactly once, with the size handed on to PngUnit so it
+doesn't need to stat again. Results are yielded as they are found so the
+work queue can be fed while the rest of the tree is still being scanned.
+scan_entries also keeps the modification time, for pngwatch's index.
+'''
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections.abc import Iterator, Iterable
+import os
+from pngunit import PngUnit
+
+type ScanResult = tuple[Path, int]
+#path, size and st_mtime_ns
+type ScanEntry = tuple[Path, int, int]
+
+def scan_paths(paths: Iterable[Path], recursive: bool, threads: int = 1) -> Iterator[ScanResult]:
+    '''Yields (path, size) for every valid image under paths.
+
+    With threads > 1 sibling directories are scanned in parallel, which
+    mostly helps on network file systems where each listing is slow.
+    '''
+    for path, size, _ in scan_entries(paths, recursive, threads):
+        yield path, size
+
+def scan_entries(paths: Iterable[Path], recursive: bool, threads: int = 1) -> Iterator[ScanEntry]:
+    '''Same as scan_paths with each file's modification time as well.
+    '''
+    for path in paths:
+        if not path.is_dir():
+            if path.is_file() and PngUnit.is_extension_valid(path):
+                stat = path.stat()
+                yield path, stat.st_size, stat.st_mtime_ns
+            continue
+        if not recursive:
+            yield from scan_directory(path)[0]
+        elif threads > 1:
+            yield from scan_tree_parallel(path, threads)
+        else:
+            yield from scan_tree(path)
+
+def scan_directory(path: Path) -> tuple[list[ScanEntry], list[Path]]:
+    '''Lists one directory, returns its images and sub directories.
+    '''
+    files: list[ScanEntry] = []
+    dirs: list[Path] = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(path / entry.name)
+                    elif PngUnit.is_extension_valid(Path(entry.name)) and entry.is_file():
+                        stat = entry.stat()
+                        files.append((path / entry.name, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    #vanished or unreadable entry, same as walk skipping it
+                    continue
+    except OSError:
+        pass
+    return files, dirs
+
+def scan_tree(root: Path) -> Iterator[ScanEntry]:
+    stack = [root]
+    while len(stack):
+        files, dirs = scan_directory(stack.pop())
+        yield from files
+        #reversed so directories come out in listing order
+        stack.extend(reversed(dirs))
+
+def scan_tree_parallel(root: Path, threads: int) -> Iterator[ScanEntry]:
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='scan') as pool:
+        pending: set[Future[tuple[list[ScanEntry], list[Path]]]] = { pool.submit(scan_directory, root) }
+        try:
+            while len(pending):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, dirs = future.result()
+                    for dir in dirs:
+                        pending.add(pool.submit(scan_directory, dir))
+                    yield from files
+        finally:
+            #consumer stopped early, don't start any more listings
+            for future in pending:
+                future.cancel()
@@ -1,165 +1,801 @@
-from threading import Thread, Event
+from threading import Thread, Event, Condition, Lock
 from queue import Queue, Empty
-from time import sleep
+from collections import deque
+import heapq
+from copy import copy
+from time import perf_counter, time
 from pathlib import Path
-from typing import ClassVar
-from pngunit import PngUnit, PngUnitException, WorkOrder
+import os
+import re
+import shutil
+import tempfile
+from typing import ClassVar, Callable
+from pngunit import (PngUnit, PngUnitException, PngUnitCanceled, PngUnitRetry, WorkOrder, Schedule, Engine, FilterRanking,
+                     TrialJob, UnitRecord, trial_switches)
+from pngcache import ResultCache, unit_signature
+from pngscan import scan_paths
+from pngjournal import Journal, JournalState
+from pngdedup import find_duplicates, copy_to_duplicates
+from pngpool import PoolTuner, usable_cores
+from pngreport import SessionReport
+from pngwatch import Watcher
 
 
 #Events, put in a class queue
 class BaseEvent:
     pass
 
-class PngUpdateEvent(BaseEvent):
+class UnitEvent(BaseEvent):
+    id: int
+
+class PngUpdateEvent(UnitEvent):
     def __init__(self, id: int, done: int, required: int):
         self.id = id
         self.done = done
         self.required = required
 
-class PngErrorEvent(BaseEvent):
+class PngErrorEvent(UnitEvent):
     def __init__(self, id: int, error: str, detail: str = ''):
         self.id = id
         self.error = error
         self.detail = detail
 
-class PngDoneEvent(BaseEvent):
+class PngSkipEvent(UnitEvent):
+    def __init__(self, id: int, reason: str):
+        self.id = id
+        self.reason = reason
+
+class PngDoneEvent(UnitEvent):
     def __init__(self, id: int, size_change: int, time: float, final_switches: str):
         self.id = id
         self.size_change = size_change
         self.time = time
         self.final_switches = final_switches
 
+class PngTrialEvent(UnitEvent):
+    """An extra trial made an already finished unit smaller.
+    """
+    def __init__(self, id: int, size_change: int, switches: str):
+        self.id = id
+        self.size_change = size_change
+        self.switches = switches
+
 class SessionStartEvent(BaseEvent):
     pass
 
 class SessionEndEvent(BaseEvent):
-    pass
+    def __init__(self, error: str = ''):
+        #set when the session itself failed, e.g. the cache or journal couldn't be opened
+        self.error = error
 
-class SessionQueueEvent(BaseEvent):
-    def __init__(self, id: int, path: Path):
-        self.id = id
-        self.path = path
+class SessionQueueBatchEvent(BaseEvent):
+    """Units discovery queued, posted in batches so a large tree isn't one event per file.
+
+    Paths are plain strings, a Path per file costs several times the memory
+    while the event waits for a slow consumer.
+    """
+    def __init__(self, ids: list[int], paths: list[str]):
+        self.ids = ids
+        self.paths = paths
+
+class EventBatcher:
+    """Drains an event queue for a bounded time, merging events that can be merged.
+
+    Consecutive queued batches become one SessionQueueBatchEvent of up to
+    max_queued units and only the latest PngUpdateEvent per unit is kept,
+    dropped entirely if the unit finished in the same batch. Order is
+    otherwise preserved, so the consumer's cost per drain depends on the
+    budget, not on the file count, and no single event is too big to handle
+    in one go.
+    """
+    def __init__(self, queue: Queue[BaseEvent], budget: float = 0.03, max_events: int = 20000, max_queued: int = 2000):
+        self.queue = queue
+        self.budget = budget
+        self.max_events = max_events
+        self.max_queued = max_queued
+        #true when the last drain stopped before the queue was empty
+        self.backlog: bool = False
+
+    def drain(self) -> list[BaseEvent]:
+        deadline = perf_counter() + self.budget
+        merged: list[BaseEvent | None] = []
+        updates: dict[int, int] = {}
+        batch: SessionQueueBatchEvent | None = None
+        self.backlog = False
+        for count in range(self.max_events):
+            #checking the clock every event costs more than it saves
+            if count % 64 == 0 and count and perf_counter() > deadline:
+                self.backlog = True
+                break
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                break
+            if isinstance(event, SessionQueueBatchEvent):
+                if batch is None or len(batch.ids) >= self.max_queued:
+                    batch = SessionQueueBatchEvent([], [])
+                    merged.append(batch)
+                batch.ids.extend(event.ids)
+                batch.paths.extend(event.paths)
+                continue
+            batch = None
+            if isinstance(event, PngUpdateEvent):
+                if event.id in updates:
+                    merged[updates[event.id]] = event
+                    continue
+                updates[event.id] = len(merged)
+            elif isinstance(event, (PngDoneEvent, PngErrorEvent, PngSkipEvent)) and event.id in updates:
+                merged[updates.pop(event.id)] = None
+            merged.append(event)
+        else:
+            self.backlog = not self.queue.empty()
+        return [ event for event in merged if event is not None ]
+
+class WorkQueue(Queue):
+    """Units in discovery or priority order, with trial jobs only handed out when no unit is waiting.
+
+    Both lanes share one Queue so task_done and join cover trials too.
+    Discovery adds units with put_unit, which waits while limit units are
+    already queued. Workers use plain put for trials and retries, so they
+    never block on the queue they consume.
+    """
+    def __init__(self, priority: bool = False, limit: int | None = None):
+        self.priority = priority
+        self.limit = limit
+        super().__init__()
+
+    def put_unit(self, item: PngUnit | UnitRecord):
+        with self.not_full:
+            while self.limit and len(self.units) + len(self.heap) >= self.limit:
+                self.not_full.wait()
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _init(self, maxsize: int):
+        self.units: deque = deque()
+        self.heap: list = []
+        self.trials: list[TrialJob] = []
+
+    def _qsize(self) -> int:
+        return len(self.units) + len(self.heap) + len(self.trials)
+
+    def _put(self, item):
+        if isinstance(item, TrialJob):
+            heapq.heappush(self.trials, item)
+        elif self.priority:
+            heapq.heappush(self.heap, item)
+        else:
+            self.units.append(item)
+
+    def _get(self):
+        if len(self.units):
+            return self.units.popleft()
+        if len(self.heap):
+            return heapq.heappop(self.heap)
+        return heapq.heappop(self.trials)
+
+class _StopToken:
+    """Queue sentinel telling a worker to exit.
+
+    Sorts after every unit so it also works in a PriorityQueue.
+    """
+    def __lt__(self, other) -> bool:
+        return False
+
+    def __gt__(self, other) -> bool:
+        return True
+
+STOP = _StopToken()
+
+def post_unit_event(unit: PngUnit, event: UnitEvent):
+    """Posts a unit's event, repeated for each of its duplicates.
+
+    Also hands the unit's pngout runs and outcome to the session report, so
+    every engine reports the same way.
+    """
+    report_passes(unit)
+    report_unit(unit, event)
+    Manager.EVENT_QUEUE.put(event)
+    for duplicate in unit.duplicates:
+        duplicate_event = copy(event)
+        duplicate_event.id = duplicate.id
+        report_unit(duplicate, duplicate_event)
+        Manager.EVENT_QUEUE.put(duplicate_event)
+
+#session staging directories are named after the pid that owns them, see Manager.configure_units
+STAGING_PREFIX = 'outfront-stage-'
+_STAGING_NAME = re.compile(rf'{STAGING_PREFIX}(\d+)-[a-z0-9_]+')
+
+def process_exists(pid: int) -> bool:
+    if os.name != 'posix':
+        #signal 0 would kill the process on windows, so every owner is assumed alive
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        #someone else's process
+        return True
+    return True
+
+def remove_stale_staging(directory: Path):
+    '''Removes staging directories whose session was killed before it could clean up.
+
+    A RAM backed directory like /dev/shm would otherwise hold the copies until reboot.
+    '''
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        match = _STAGING_NAME.fullmatch(entry.name)
+        if match is None or not entry.is_dir(follow_symlinks=False):
+            continue
+        if not process_exists(int(match.group(1))):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def check_unit(unit: PngUnit, cache: ResultCache | None, journal: Journal | None) -> str | None:
+    '''The checks every engine makes before a unit's first pass.
+
+    Returns the unit's signature if it should run, None once it has been
+    skipped or rejected, with its event already posted.
+    '''
+    signature = unit_signature(unit)
+    #a converted file's output is what the journal lists, so this comes before already_converted
+    if journal is not None:
+        if journal.is_finished(unit, signature):
+            post_unit_event(unit, PngSkipEvent(unit.id, 'Finished in a previous session'))
+            return None
+        if journal.was_partial(unit):
+            unit.remove_stale_temps()
+    if unit.already_converted():
+        post_unit_event(unit, PngErrorEvent(unit.id, 'Skipping because output PNG already exists, it may have already been converted.'))
+        return None
+    if cache is not None:
+        entry = cache.lookup(unit.path, signature)
+        if entry is not None:
+            if journal is not None:
+                journal.record(JournalState.SKIPPED, unit, signature)
+            post_unit_event(unit, PngSkipEvent(unit.id, f'Already optimized: {entry.final_switches}'))
+            return None
+    return signature
+
+def finish_unit(unit: PngUnit, cache: ResultCache | None, journal: Journal | None, signature: str):
+    '''Records and announces a unit whose passes have all run, however the engine ran them.
+    '''
+    unit.end_stats()
+    copy_to_duplicates(unit)
+    if cache is not None:
+        cache.record(unit.make_output_path(), signature, unit.final_switches)
+        if unit.best_filter is not None:
+            cache.record_win(unit.get_features(), unit.best_filter)
+    if journal is not None:
+        journal.record(JournalState.DONE, unit, signature)
+    total = unit.time_end - unit.time_start
+    change = unit.size - unit.final_size
+    post_unit_event(unit, PngDoneEvent(unit.id, change, total, unit.final_switches))
+
+def fail_unit(unit: PngUnit, journal: Journal | None, error: Exception):
+    '''Records and announces a unit that ended with error.
+    '''
+    if isinstance(error, PngUnitException):
+        message, detail = str(error), error.detail
+    else:
+        message, detail = 'Unexpected Exception', str(error)
+    if journal is not None:
+        journal.record(JournalState.ERROR, unit, error=str(error))
+    post_unit_event(unit, PngErrorEvent(unit.id, message, detail))
+
+def describe_error(error: Exception) -> str:
+    return f'{type(error).__name__}: {error}'
+
+def report_passes(unit: PngUnit):
+    if Manager.REPORT is not None:
+        for record in unit.take_pass_records():
+            Manager.REPORT.record_pass(unit, record)
+
+def report_unit(unit: PngUnit, event: UnitEvent):
+    if Manager.REPORT is None:
+        return
+    if isinstance(event, PngDoneEvent):
+        Manager.REPORT.record_unit(unit, 'done')
+    elif isinstance(event, PngErrorEvent):
+        Manager.REPORT.record_unit(unit, 'error', f'{event.error} ({event.detail})' if event.detail else event.error)
+    elif isinstance(event, PngSkipEvent):
+        Manager.REPORT.record_unit(unit, 'skipped', event.reason)
+
+class ResourceBudget:
+    '''Admits units while their estimated memory and pngout processes fit.
+
+    Threads are admitted in arrival order so a big unit isn't starved by a
+    stream of small ones. A unit bigger than the whole budget still runs,
+    alone, once everything before it has finished.
+    '''
+    def __init__(self, memory: int | None = None, cores: int | None = None):
+        self.condition = Condition()
+        self.memory_free = memory
+        self.cores_free = cores
+        self.running: int = 0
+        self.next_ticket: int = 0
+        self.serving: int = 0
+        self.canceled: bool = False
+
+    def fits(self, memory: int, cores: int) -> bool:
+        if not self.running:
+            return True
+        if self.memory_free is not None and memory > self.memory_free:
+            return False
+        return self.cores_free is None or cores <= self.cores_free
+
+    def take(self, memory: int, cores: int):
+        self.running += 1
+        if self.memory_free is not None:
+            self.memory_free -= memory
+        if self.cores_free is not None:
+            self.cores_free -= cores
+
+    def acquire(self, memory: int, cores: int):
+        '''Blocks until the demand fits, raises PngUnitCanceled if the session is stopped first.
+        '''
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.condition.wait_for(lambda: self.canceled or (ticket == self.serving and self.fits(memory, cores)))
+            self.serving += 1
+            #later tickets may fit now too
+            self.condition.notify_all()
+            if self.canceled:
+                raise PngUnitCanceled('Canceled')
+            self.take(memory, cores)
+
+    def try_acquire(self, memory: int, cores: int) -> bool:
+        '''Non-blocking version for callers that already admit one unit at a time.
+        '''
+        with self.condition:
+            if not self.fits(memory, cores):
+                return False
+            self.take(memory, cores)
+            return True
+
+    def release(self, memory: int, cores: int):
+        with self.condition:
+            self.running -= 1
+            if self.memory_free is not None:
+                self.memory_free += memory
+            if self.cores_free is not None:
+                self.cores_free += cores
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.canceled = True
+            self.condition.notify_all()
 
 #worker threads
 class PngWorker(Thread):
-    WORK_QUEUE: ClassVar[Queue[PngUnit]] = Queue()
-    def __init__(self, *args, **kwargs):
+    WORK_QUEUE: ClassVar[WorkQueue] = WorkQueue()
+    EXTRA_TRIALS: ClassVar[int] = 0
+    TRIAL_TIME: ClassVar[float | None] = None
+    def __init__(self, *args, cache: ResultCache | None = None, journal: Journal | None = None,
+                 budget: ResourceBudget | None = None, retire: Callable[[], bool] | None = None,
+                 open_unit: Callable[[PngUnit | UnitRecord], PngUnit] | None = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.stop_event = Event()
-        self.done_event = Event()
+        self.cache = cache
+        self.journal = journal
+        self.budget = budget
+        #asked between units, True means the pool is shrinking and this worker should exit
+        self.retire = retire
+        #builds the full unit for a queued record
+        self.open_unit = open_unit
+        self.unit: PngUnit | None = None
+        #demand reserved from the budget for the current unit
+        self.reserved: tuple[int, int] | None = None
 
     def run(self):
-        while not self.done_event.is_set():
-            #print('worker: waiting for work')
+        while True:
+            #blocks until there is work or the manager sends STOP
+            item = self.WORK_QUEUE.get()
             try:
-                unit = self.WORK_QUEUE.get(timeout=0.2)
-            except Empty:
-                continue
-            #TODO unhandled
-
-            #print('got work')
-            try:
-                if unit.already_converted():
-                    Manager.EVENT_QUEUE.put(PngErrorEvent(unit.id, 'Skipping because output PNG already exists, it may have already been converted.'))
-                    continue
-                unit.start_stats()
-                Manager.EVENT_QUEUE.put(PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
-                while unit.run_pass():
-                    Manager.EVENT_QUEUE.put(PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
-                    if self.stop_event.is_set():
-                        #print('bailing due to stop')
-                        return
-                unit.end_stats()
-                total = unit.time_end - unit.time_start
-                change =  unit.size - unit.final_size
-                self.WORK_QUEUE.task_done()
-                Manager.EVENT_QUEUE.put(PngDoneEvent(unit.id, change, total, unit.final_switches))
-            except PngUnitException as e:
-                self.WORK_QUEUE.task_done()
-                Manager.EVENT_QUEUE.put(PngErrorEvent(unit.id, str(e), e.detail))
-            except Exception as e:
+                if item is STOP:
+                    return
+                #drain anything left over after a stop without running it
+                if self.stop_event.is_set():
+                    pass
+                elif isinstance(item, TrialJob):
+                    self.run_trial_job(item)
+                elif isinstance(item, UnitRecord):
+                    assert self.open_unit is not None
+                    self.process_unit(self.open_unit(item))
+                else:
+                    self.process_unit(item)
+            finally:
                 self.WORK_QUEUE.task_done()
-                Manager.EVENT_QUEUE.put(PngErrorEvent(unit.id, 'Unexpected Exception', str(e)))
-        #print('exit due to done flag')
-    def done(self):
-        self.done_event.set()
+            if self.retire is not None and self.retire():
+                return
+
+    def process_unit(self, unit: PngUnit):
+        self.unit = unit
+        retry = False
+        try:
+            #stop may have missed this unit if it landed between get() and here
+            if self.stop_event.is_set():
+                raise PngUnitCanceled('Canceled')
+            signature = check_unit(unit, self.cache, self.journal)
+            if signature is None:
+                return
+            self.admit(unit)
+            unit.start_stats()
+            self.record(JournalState.PASS, unit, number=unit.get_pass_done())
+            post_unit_event(unit, PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
+            self.run_passes(unit)
+            finish_unit(unit, self.cache, self.journal, signature)
+            self.queue_trials(unit)
+        except PngUnitRetry:
+            if self.stop_event.is_set():
+                fail_unit(unit, self.journal, PngUnitCanceled('Canceled'))
+            else:
+                retry = True
+        except Exception as e:
+            fail_unit(unit, self.journal, e)
+        finally:
+            self.release()
+            self.unit = None
+            unit.discard()
+        if retry:
+            #requeued only once this worker is done with it, task_done for this get comes after the put so join can't return early
+            self.WORK_QUEUE.put(unit)
+
+    def queue_trials(self, unit: PngUnit):
+        for index in range(self.EXTRA_TRIALS):
+            self.WORK_QUEUE.put(TrialJob(unit, index))
+
+    def run_trial_job(self, job: TrialJob):
+        unit = job.unit
+        if unit.trials_started is None:
+            unit.trials_started = time()
+        elif self.TRIAL_TIME is not None and time() - unit.trials_started > self.TRIAL_TIME:
+            return
+        self.unit = unit
+        try:
+            self.admit(unit, unit.get_trial_demand())
+            saved = unit.run_variant(job.index)
+            if not saved:
+                return
+            copy_to_duplicates(unit)
+            signature = unit_signature(unit)
+            if self.cache is not None:
+                self.cache.record(unit.make_output_path(), signature, unit.final_switches)
+            #the output changed since DONE was recorded, --resume would otherwise redo the file
+            self.record(JournalState.DONE, unit, signature)
+            post_unit_event(unit, PngTrialEvent(unit.id, saved, ' '.join(trial_switches(job.index))))
+        except PngUnitException:
+            #a failed trial leaves the finished result as it was
+            pass
+        finally:
+            #trials that saved nothing post no event
+            report_passes(unit)
+            self.release()
+            self.unit = None
+
+    def run_passes(self, unit: PngUnit):
+        while unit.run_pass():
+            self.record(JournalState.PASS, unit, number=unit.get_pass_done())
+            post_unit_event(unit, PngUpdateEvent(unit.id, unit.get_pass_done(), unit.get_pass_total()))
+            if self.stop_event.is_set():
+                raise PngUnitCanceled('Canceled')
+
+    def admit(self, unit: PngUnit, demand: tuple[int, int] | None = None):
+        if self.budget is None:
+            return
+        if demand is None:
+            demand = unit.get_demand()
+        self.budget.acquire(*demand)
+        self.reserved = demand
+
+    def release(self):
+        if self.budget is not None and self.reserved is not None:
+            self.budget.release(*self.reserved)
+        self.reserved = None
+
+    def record(self, state: JournalState, unit: PngUnit, signature: str = '', **extra):
+        if self.journal is not None:
+            self.journal.record(state, unit, signature, **extra)
 
     def stop(self):
-        self.done_event.set()
+        """Kills the current unit's pngout processes and skips anything still queued.
+
+        The unit only ever worked on temporary copies, so the original is left as it was.
+        """
         self.stop_event.set()
+        unit = self.unit
+        if unit is not None:
+            unit.terminate()
 
 class Manager(Thread):
     EVENT_QUEUE: ClassVar[Queue[BaseEvent]] = Queue()
+    #discovered units are announced and dispatched this many at a time, or after this many seconds
+    QUEUE_BATCH: ClassVar[int] = 256
+    QUEUE_BATCH_TIME: ClassVar[float] = 0.05
+    #set for the length of a session that writes a report or metrics, see pngreport
+    REPORT: ClassVar[SessionReport | None] = None
     def __init__(self, workorder: WorkOrder, **kwargs):
         super().__init__(**kwargs)
-        self.workers: list[PngWorker]
+        self.workers: list[PngWorker] = []
         self.stop_event = Event()
         self.workorder = workorder
+        self.cache: ResultCache | None = None
+        self.journal: Journal | None = None
+        self.held_units: list[PngUnit | UnitRecord] = []
+        #discovered but not yet announced, see enqueue_unit
+        self.pending_units: list[PngUnit | UnitRecord] = []
+        self.pending_since: float = 0
+        self.ranking = FilterRanking() if workorder.reorder_filters else None
+        self.budget: ResourceBudget | None = None
+        if workorder.memory_budget is not None or workorder.core_budget is not None:
+            self.budget = ResourceBudget(workorder.memory_budget, workorder.core_budget)
+        self.pool_lock = Lock()
+        #workers still to exit after the pool was shrunk
+        self.retiring: int = 0
+        self.tuner: PoolTuner | None = None
+        self.session_start: float = 0
+        self.discovery_time: float = 0
+        #seconds discovery spent waiting for room in a full work queue, not scanning
+        self.dispatch_wait: float = 0
+        self.units_queued: int = 0
 
     def run(self):
         wo = self.workorder
-        PngWorker.WORK_QUEUE = Queue() #incase we ran before and stopped mid-run
+        #new queue incase we ran before and stopped mid-run
+        PngWorker.WORK_QUEUE = WorkQueue(priority=wo.schedule != Schedule.FIFO, limit=wo.queue_limit)
+        PngWorker.EXTRA_TRIALS = wo.extra_trials
+        PngWorker.TRIAL_TIME = wo.trial_time
         self.EVENT_QUEUE.put(SessionStartEvent())
-        self.create_workers(wo.threads)
-        self.process_paths(wo)
-        while not PngWorker.WORK_QUEUE.empty():
-            if self.stop_event.is_set():
-                break
-            sleep(0.1)
-        #print('manager: exit quque loop')
-        self.stop_workers()
-        #print('manager: stop workers sent')
-        self.wait_for_workers()
-        #print('manager: workers stopped')
-        self.EVENT_QUEUE.put(SessionEndEvent())
-        #print('queue sent')
+        error = ''
+        try:
+            self.open_session()
+            self.create_workers(wo.threads)
+            self.start_tuner()
+            self.process_paths(wo)
+            self.release_units()
+            #every get is balanced by a task_done, so this returns the moment the last unit finishes
+            PngWorker.WORK_QUEUE.join()
+        except Exception as e:
+            error = describe_error(e)
+            self.stop()
+        finally:
+            self.stop_tuner()
+            self.stop_workers()
+            self.wait_for_workers()
+            self.close_session()
+            #always sent, front ends wait for it
+            self.EVENT_QUEUE.put(SessionEndEvent(error))
 
     def process_paths(self, wo: WorkOrder):
-        for path in wo.paths:
-            if wo.recursive and path.is_dir:
-                self.process_path_walk(path, wo)
-            else:
-                self.process_path_flat(path, wo)
-    
-    def process_path_flat(self, path: Path, wo: WorkOrder):
-        if path.is_file() and PngUnit.is_extension_valid(path):
-            self.enqueue_unit(PngUnit(path, wo.filters, wo.extra_switches))
+        if wo.watch:
+            self.watch_paths(wo)
             return
-        for child in path.iterdir():
-            if self.stop_event.is_set():
-                return
-            if not child.is_file():
-                continue
-            if not PngUnit.is_extension_valid(child):
-                continue
-            self.enqueue_unit(PngUnit(child, wo.filters, wo.extra_switches))
-
-    def process_path_walk(self, path: Path, wo: WorkOrder):
-        for base, dirs, files in path.walk():
-            for file in files:
+        started = perf_counter()
+        self.dispatch_wait = 0
+        try:
+            for path, size in scan_paths(wo.paths, wo.recursive, wo.scan_threads):
                 if self.stop_event.is_set():
                     return
-                full = base / file
-                if full.is_file() and PngUnit.is_extension_valid(full):
-                    self.enqueue_unit(PngUnit(full, wo.filters, wo.extra_switches))
-    
-    def enqueue_unit(self, unit: PngUnit):
-        self.EVENT_QUEUE.put(SessionQueueEvent(unit.id, unit.path))
-        PngWorker.WORK_QUEUE.put(unit)
+                self.enqueue_unit(self.make_record(path, size))
+        finally:
+            self.flush_units()
+            self.discovery_time = perf_counter() - started - self.dispatch_wait
+
+    def watch_paths(self, wo: WorkOrder):
+        '''Queues files as they change under the work order's paths, until the session is stopped.
+
+        Files already there are only indexed, the way a finished batch leaves them.
+        '''
+        started = time()
+        watcher = Watcher(wo.paths, wo.recursive, wo.watch_settle, wo.watch_poll)
+        self.discovery_time = time() - started
+        PngUnit.ON_REPLACE = watcher.note_written
+        try:
+            while not self.stop_event.is_set():
+                for path, size in watcher.changes():
+                    if self.stop_event.is_set():
+                        break
+                    self.enqueue_unit(self.make_record(path, size))
+                #changes come in bursts, each is announced as soon as it's read
+                self.flush_units()
+        finally:
+            PngUnit.ON_REPLACE = None
+            watcher.close()
+
+    def make_record(self, path: Path, size: int) -> PngUnit | UnitRecord:
+        if self.workorder.dedup:
+            #duplicates are found by grouping full units, see pngdedup
+            return self.make_unit(path, size)
+        return UnitRecord(str(path), size)
+
+    def make_unit(self, path: Path, size: int | None = None, id: int | None = None) -> PngUnit:
+        wo = self.workorder
+        return PngUnit(path, wo.filters, wo.extra_switches, wo.parallel_filters, size, wo.min_gain, self.ranking, wo.filter_limit, id)
+
+    def open_unit(self, item: PngUnit | UnitRecord) -> PngUnit:
+        '''The full unit for a queued item, built as a worker takes it.
+        '''
+        if isinstance(item, PngUnit):
+            return item
+        unit = self.make_unit(Path(item.path), item.size, item.id)
+        unit.time_queued = item.time_queued
+        return unit
+
+    def open_session(self):
+        '''Sets up everything the session writes to, raises if any of it can't be opened.
+        '''
+        self.configure_units()
+        self.open_cache()
+        self.open_journal()
+        self.open_report()
+
+    def close_session(self):
+        '''Closes whatever open_session got as far as opening.
+        '''
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.close_report()
+        self.remove_staging()
+
+    def configure_units(self):
+        wo = self.workorder
+        PngUnit.PROCESS_TIMEOUT = wo.process_timeout
+        PngUnit.LIST_SWITCHES = wo.list_switches
+        PngUnit.NICE = wo.nice
+        PngUnit.AFFINITY = wo.cpu_affinity
+        PngUnit.STAGING_DIR = None
+        if wo.staging_dir is not None:
+            remove_stale_staging(wo.staging_dir)
+            #private to the session, removed with everything left in it at the end
+            PngUnit.STAGING_DIR = Path(tempfile.mkdtemp(prefix=f'{STAGING_PREFIX}{os.getpid()}-', dir=wo.staging_dir))
+
+    def remove_staging(self):
+        if PngUnit.STAGING_DIR is not None:
+            shutil.rmtree(PngUnit.STAGING_DIR, ignore_errors=True)
+            PngUnit.STAGING_DIR = None
+
+    def open_cache(self):
+        if self.workorder.cache_path is None:
+            return
+        self.cache = ResultCache(self.workorder.cache_path)
+        if self.ranking is not None:
+            self.cache.load_ranking(self.ranking)
+
+    def open_journal(self):
+        wo = self.workorder
+        if wo.journal_path is not None:
+            self.journal = Journal(wo.journal_path, wo.resume)
+
+    def open_report(self):
+        wo = self.workorder
+        self.session_start = time()
+        if wo.report_path is not None or wo.metrics_path is not None:
+            Manager.REPORT = SessionReport(wo.report_path, wo.metrics_path)
+
+    def close_report(self):
+        report = Manager.REPORT
+        if report is None:
+            return
+        Manager.REPORT = None
+        report.record_session(self.units_queued, self.discovery_time, time() - self.session_start)
+        report.close()
+
+    def record(self, state: JournalState, unit: PngUnit | UnitRecord, signature: str = '', **extra):
+        if self.journal is not None:
+            self.journal.record(state, unit, signature, **extra)
+
+    def enqueue_unit(self, unit: PngUnit | UnitRecord):
+        unit.time_queued = time()
+        self.units_queued += 1
+        self.record(JournalState.QUEUED, unit)
+        if not len(self.pending_units):
+            self.pending_since = perf_counter()
+        self.pending_units.append(unit)
+        if len(self.pending_units) >= self.QUEUE_BATCH or perf_counter() - self.pending_since >= self.QUEUE_BATCH_TIME:
+            self.flush_units()
+
+    def flush_units(self):
+        '''Announces the pending units in one event, then hands them on.
+
+        The event goes first so no unit can report before it was queued.
+        '''
+        units = self.pending_units
+        if not len(units):
+            return
+        self.pending_units = []
+        self.EVENT_QUEUE.put(SessionQueueBatchEvent([ unit.id for unit in units ], [ str(unit.path) for unit in units ]))
+        if self.workorder.schedule == Schedule.LARGEST_FIRST_PRESORT or self.workorder.dedup:
+            #held back until discovery finishes so the whole set can be ordered or deduplicated
+            self.held_units.extend(units)
+            return
+        started = perf_counter()
+        for unit in units:
+            if self.stop_event.is_set():
+                break
+            self.dispatch_unit(unit)
+        self.dispatch_wait += perf_counter() - started
+
+    def release_units(self):
+        wo = self.workorder
+        units = self.held_units
+        self.held_units = []
+        if wo.dedup and not self.stop_event.is_set():
+            units = find_duplicates(units, wo.threads, wo.dedup_link)
+        if wo.schedule == Schedule.LARGEST_FIRST_PRESORT:
+            units.sort()
+        for unit in units:
+            if self.stop_event.is_set():
+                break
+            self.dispatch_unit(unit)
+
+    def dispatch_unit(self, unit: PngUnit | UnitRecord):
+        #waits while the queue is full, so discovery runs no further ahead of the workers than queue_limit
+        PngWorker.WORK_QUEUE.put_unit(unit)
 
     def create_workers(self, number: int):
-        self.workers = []
         for _ in range(number):
-            worker = PngWorker(daemon=True)
+            worker = PngWorker(cache=self.cache, journal=self.journal, budget=self.budget, retire=self.claim_retirement,
+                               open_unit=self.open_unit, daemon=True)
             self.workers.append(worker)
             worker.start()
 
     def stop_workers(self):
-        for worker in self.workers:
+        #retired workers have already exited
+        for _ in [ worker for worker in self.workers if worker.is_alive() ]:
+            PngWorker.WORK_QUEUE.put(STOP)
+
+    def start_tuner(self):
+        if not self.workorder.adaptive_threads:
+            return
+        self.tuner = PoolTuner(self, usable_cores(self.workorder.cpu_affinity), daemon=True)
+        self.tuner.start()
+
+    def stop_tuner(self):
+        if self.tuner is not None:
+            self.tuner.stop()
+            self.tuner.join()
+
+    def pool_size(self) -> int:
+        with self.pool_lock:
+            return self.current_pool_size()
+
+    def current_pool_size(self) -> int:
+        return sum(1 for worker in self.workers if worker.is_alive()) - self.retiring
+
+    def busy_workers(self) -> int:
+        return sum(1 for worker in self.workers if worker.unit is not None)
+
+    def resize_workers(self, size: int):
+        '''Grows the pool right away, shrinks it as workers finish their current unit.
+        '''
+        with self.pool_lock:
             if self.stop_event.is_set():
-                worker.stop()
-            else:
-                worker.done()
+                return
+            change = size - self.current_pool_size()
+            if change < 0:
+                self.retiring -= change
+                return
+            kept = min(self.retiring, change)
+            self.retiring -= kept
+            self.create_workers(change - kept)
+
+    def claim_retirement(self) -> bool:
+        with self.pool_lock:
+            if self.retiring <= 0:
+                return False
+            self.retiring -= 1
+            return True
 
     def wait_for_workers(self):
         for worker in self.workers:
@@ -168,6 +804,41 @@ class Manager(Thread):
     def stop(self):
         """Sends a soft stop to the thread and any active workers.
         
-        Threads will exit when they next have a chance.
+        Queued units are dropped and running pngout processes are killed,
+        the session ends once the workers have cleaned up.
         """
-        self.stop_event.set()
\ No newline at end of file
+        self.stop_event.set()
+        if self.budget is not None:
+            self.budget.cancel()
+        for worker in list(self.workers):
+            worker.stop()
+        self.drain_queue()
+
+    def drain_queue(self):
+        stop_tokens = 0
+        while True:
+            try:
+                unit = PngWorker.WORK_QUEUE.get_nowait()
+            except Empty:
+                break
+            if unit is STOP:
+                stop_tokens += 1
+            PngWorker.WORK_QUEUE.task_done()
+        #workers still need their sentinel if the manager already sent them
+        for _ in range(stop_tokens):
+            PngWorker.WORK_QUEUE.put(STOP)
+
+def create_manager(workorder: WorkOrder, **kwargs) -> Manager:
+    """Builds the manager for the engine the work order asks for.
+
+    Every kind posts the same events to Manager.EVENT_QUEUE.
+    """
+    if workorder.listen is not None:
+        #imported here, pngremote builds on this module
+        from pngremote import RemoteManager
+        return RemoteManager(workorder, **kwargs)
+    if workorder.engine == Engine.ASYNC:
+        #imported here, pngasync builds on this module
+        from pngasync import AsyncManager
+        return AsyncManager(workorder, **kwargs)
+    return Manager(workorder, **kwargs)
@@ -1,8 +1,19 @@
 from pathlib import Path
-from time import time
+from time import time, monotonic
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from collections.abc import Iterator
+from threading import Lock
+import os
+import re
+import selectors
+import shutil
 import subprocess
-from typing import ClassVar
+import tempfile
+from typing import ClassVar, Callable
 from dataclasses import dataclass
+from enum import Enum
+from pngheader import ImageHeader, read_header
+import math
 
 type FilterList = list[int]
 type SwitchList = list[str]
@@ -16,6 +27,110 @@ _VALID_EXTENSIONS: list[str] = [
     '.bmp'
 ]
 
+FILTER_NAMES: list[str] = [
+    'None',
+    'Sub',
+    'Up',
+    'Average',
+    'Paeth',
+    'Mixed',
+    'Reuse'
+]
+
+def image_features(path: Path, header: ImageHeader | None) -> str:
+    '''Cheap description of an image for grouping filter history.
+
+    Images are described by their color type, bit depth and pixel count to
+    the nearest power of four, by extension only when the header can't be read.
+    '''
+    extension = path.suffix.lower().lstrip('.')
+    if header is None:
+        return extension
+    pixels = header.width * header.height
+    scale = int(math.log2(pixels)) // 2 if pixels else 0
+    return f'{extension}:c{header.color_type}:d{header.bit_depth}:s{scale}'
+
+@dataclass
+class PassRecord:
+    '''Measurements of a single pngout run, see PngUnit.execute.
+    '''
+    #pass for filter passes and parallel filter trials, variant for extra trials
+    kind: str
+    filter: int | None
+    switches: str
+    wall: float
+    #None where the child's rusage isn't available
+    cpu: float | None
+    size_before: int
+    size_after: int
+    returncode: int
+
+class MeasuredPopen(subprocess.Popen):
+    '''Popen that reaps its child with os.wait4, keeping the child's CPU time.
+
+    communicate always reaps the child itself, so read_output takes its
+    place. Without os.wait4 both fall back to communicate and wait, and
+    cpu_time stays None.
+    '''
+    cpu_time: float | None = None
+
+    def read_output(self, timeout: float | None) -> str:
+        '''Reads stdout to the end, raises subprocess.TimeoutExpired after timeout seconds if there is one.
+        '''
+        if not hasattr(os, 'wait4'):
+            stdout, _ = self.communicate(timeout=timeout)
+            return stdout.decode(errors='replace')
+        assert self.stdout is not None
+        output = bytearray()
+        deadline = None if timeout is None else monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.stdout, selectors.EVENT_READ)
+            while True:
+                if deadline is None:
+                    selector.select()
+                elif not selector.select(max(0, deadline - monotonic())):
+                    raise subprocess.TimeoutExpired(self.args, timeout or 0)
+                chunk = os.read(self.stdout.fileno(), 65536)
+                if not len(chunk):
+                    break
+                output += chunk
+        self.stdout.close()
+        return output.decode(errors='replace')
+
+    def reap(self):
+        '''Waits for the child after its output has ended.
+        '''
+        if not hasattr(os, 'wait4') or self.returncode is not None:
+            self.wait()
+            return
+        try:
+            _, status, usage = os.wait4(self.pid, 0)
+        except ChildProcessError:
+            #a kill from another thread polled it first
+            self.wait()
+            return
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.cpu_time = usage.ru_utime + usage.ru_stime
+
+def file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+class Schedule(Enum):
+    FIFO = 'fifo'
+    #biggest estimated cost first as units are discovered
+    LARGEST_FIRST = 'largest'
+    #discover everything, then dispatch biggest first (LPT)
+    LARGEST_FIRST_PRESORT = 'presort'
+
+class Engine(Enum):
+    #one OS thread per worker, each blocking on its pngout process
+    THREADS = 'threads'
+    #a single asyncio loop running every pngout process
+    ASYNC = 'async'
+
 @dataclass
 class WorkOrder:
     threads: int
@@ -23,49 +138,528 @@ class WorkOrder:
     filters: FilterList
     recursive: bool
     extra_switches: SwitchList
+    parallel_filters: bool = False
+    cache_path: Path | None = None
+    schedule: Schedule = Schedule.FIFO
+    scan_threads: int = 1
+    engine: Engine = Engine.THREADS
+    #seconds before a single pngout run is killed, None to wait forever
+    process_timeout: float | None = None
+    #append-only record of unit states, see pngjournal
+    journal_path: Path | None = None
+    #skip units the journal says are finished instead of starting over
+    resume: bool = False
+    #optimize byte-identical inputs once and copy the result to the others
+    dedup: bool = False
+    #hard link duplicates to the optimized file instead of copying
+    dedup_link: bool = False
+    #stop a file's sequential passes once one gains less than this fraction of its size, None runs every filter
+    min_gain: float | None = None
+    #try the filters that have won most often first, remembered in the cache when there is one
+    reorder_filters: bool = False
+    #only run this many of the likeliest filters once similar images have a history, None runs them all
+    filter_limit: int | None = None
+    #ask pngout /l for the final switches instead of reading them from the result's header
+    list_switches: bool = False
+    #bytes of estimated pngout memory allowed at once, None for no limit
+    memory_budget: int | None = None
+    #pngout processes allowed at once across every unit, None for no limit
+    core_budget: int | None = None
+    #start at threads and grow or shrink the pool with the measured load, see pngpool
+    adaptive_threads: bool = False
+    #added to pngout's nice value so it yields to other jobs
+    nice: int = 0
+    #cpus pngout processes are pinned to, None for any
+    cpu_affinity: set[int] | None = None
+    #HOST:PORT to accept remote workers on, see pngremote
+    listen: str | None = None
+    #shared secret remote workers have to prove they know
+    listen_token: str | None = None
+    #run passes on copies in this directory (ideally RAM backed) and only write the result back once
+    staging_dir: Path | None = None
+    #block split and randomized pngout runs per file once its filters are done, see TrialJob
+    extra_trials: int = 0
+    #seconds of extra trials allowed per file, None for no limit
+    trial_time: float | None = None
+    #one line per pngout run, file and session, CSV for a .csv path and JSON Lines otherwise, see pngreport
+    report_path: Path | None = None
+    #counters in the Prometheus text format, rewritten while the session runs
+    metrics_path: Path | None = None
+    #discovered files queued ahead of the workers before discovery waits, None for no limit
+    queue_limit: int | None = 100000
+    #keep running and queue files under paths as they are added or modified, until stopped
+    watch: bool = False
+    #seconds a watched file must stay unchanged before it is queued
+    watch_settle: float = 2.0
+    #rescan watched paths at this interval instead of using inotify, None to prefer inotify
+    watch_poll: float | None = None
+
+class FilterRanking:
+    '''Counts which filter won each unit so later units can try likely winners first.
+
+    Wins are kept per image_features so similar images are ranked by each
+    other, with the overall count breaking ties and covering unseen features.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.wins: dict[str, dict[int, int]] = {}
+        self.totals: dict[int, int] = {}
+
+    def record_win(self, filter: int, features: str = '', count: int = 1):
+        with self.lock:
+            wins = self.wins.setdefault(features, {})
+            wins[filter] = wins.get(filter, 0) + count
+            self.totals[filter] = self.totals.get(filter, 0) + count
+
+    def knows(self, features: str) -> bool:
+        with self.lock:
+            return features in self.wins
+
+    def order(self, filters: FilterList, features: str = '') -> FilterList:
+        with self.lock:
+            wins = self.wins.get(features, {}).copy()
+            totals = self.totals.copy()
+        #stable, so ties keep the order they were selected in
+        return sorted(filters, key=lambda filter: (-wins.get(filter, 0), -totals.get(filter, 0)))
+
+#tried in order, every trial after these is randomized
+TRIAL_VARIANTS: list[SwitchList] = [
+    ['/b0'],
+    ['/b128'],
+    ['/b512'],
+    ['/b2048'],
+    ['/n2'],
+    ['/n4'],
+    ['/n8'],
+]
+
+def trial_switches(index: int) -> SwitchList:
+    if index < len(TRIAL_VARIANTS):
+        return TRIAL_VARIANTS[index]
+    return ['/r']
 
 class PngUnitException(Exception):
     def __init__(self, message: str, detail: str=''):
         super().__init__(message)
         self.detail = detail
 
+class PngUnitCanceled(PngUnitException):
+    pass
+
+class PngUnitRetry(PngUnitException):
+    '''The unit couldn't finish where it was running and should be queued again.
+    '''
+    pass
+
 class PngUnit:
     PNGOUT_PATH: ClassVar[Path]
     COLOR_SEARCH: ClassVar[str] = '; try /c'
     ID_COUNTER: ClassVar[int] = 0
-    def __init__(self, path: Path, filters: FilterList, extra_switches: SwitchList = []):
-        self.id = self.get_new_id()
+    TEMP_PREFIX: ClassVar[str] = '.outfront-'
+    PROCESS_TIMEOUT: ClassVar[float | None] = None
+    LIST_SWITCHES: ClassVar[bool] = False
+    NICE: ClassVar[int] = 0
+    AFFINITY: ClassVar[set[int] | None] = None
+    #private directory for working copies, None keeps them next to the output
+    STAGING_DIR: ClassVar[Path | None] = None
+    #rough pngout working set: the decoded image a few times over plus the process itself
+    MEMORY_PER_PIXEL: ClassVar[int] = 12
+    PROCESS_MEMORY: ClassVar[int] = 8 * 1024 * 1024
+    #told about every output outfront rewrites, so a watcher can tell its own writes apart, see pngwatch
+    ON_REPLACE: ClassVar[Callable[[Path], None] | None] = None
+    def __init__(self, path: Path, filters: FilterList, extra_switches: SwitchList | None = None, parallel: bool = False, size: int | None = None,
+                 min_gain: float | None = None, ranking: FilterRanking | None = None, filter_limit: int | None = None,
+                 id: int | None = None):
+        #a unit built from a queued UnitRecord keeps the id its events were announced with
+        self.id = self.get_new_id() if id is None else id
         self.path = path
         self.type = path.suffix.lower()
-        self.size = path.stat().st_size
+        #size can be passed in when discovery already has it, saving a stat
+        self.size = path.stat().st_size if size is None else size
         self.final_size = self.size
         self.time_start: float
         self.time_end: float
         self.color_number: int = 0
         self.color_adjusted: bool = False
+        #set once a pngout run has accepted color_number
+        self.color_checked: bool = False
         self.converted: bool = False
         self.filters = filters
         self.filters_left = filters.copy()
-        self.extra_switches = extra_switches
+        #the work order's list is shared by every unit and never modified
+        self.extra_switches = extra_switches if extra_switches is not None else []
         self.final_switches: str = ''
+        self.parallel = parallel
+        #the filter behind the committed output, None while the original is still the best
+        self.best_filter: int | None = None
+        #the last filter that improved the working copy, it only becomes best_filter if the copy is committed
+        self.work_filter: int | None = None
+        self.trial_pool: ThreadPoolExecutor | None = None
+        self.trial_iter: Iterator[Future[tuple[int, Path]]]
+        self.trial_results: dict[int, Path] = {}
+        #sequential passes run on a private copy that replaces the output when done
+        self.work_path: Path | None = None
+        self.processes: set[subprocess.Popen] = set()
+        self.process_lock = Lock()
+        self.canceled: bool = False
+        #identical inputs that receive this unit's result, see pngdedup
+        self.duplicates: list['PngUnit'] = []
+        self.link_duplicates: bool = False
+        self.min_gain = min_gain
+        self.ranking = ranking
+        #size after the last sequential pass, for early stopping, a png's first pass is measured against the original
+        self.last_size: int | None = self.size if self.is_png() else None
+        self.filters_skipped: int = 0
+        self.filter_limit = filter_limit
+        self.features: str | None = None
+        #times the unit was handed to a remote worker, see pngremote
+        self.attempts: int = 0
+        self.commit_lock = Lock()
+        #when the first extra trial started, for WorkOrder.trial_time
+        self.trials_started: float | None = None
+        #parsed from the original file before the first pass, see inspect
+        self.header: ImageHeader | None = None
+        self.inspected: bool = False
+        #set when the manager queues the unit, for the queue wait in reports
+        self.time_queued: float | None = None
+        #pngout runs not yet taken by the session report, see take_pass_records
+        self.pass_records: list[PassRecord] = []
 
     def run_pass(self) -> bool:
         if not len(self.filters_left):
             return False
+        if self.parallel:
+            return self.run_parallel_pass()
+        current_filter, command = self.next_command()
+        assert self.work_path is not None
+        result = self.execute(command, self.work_path, current_filter)
+        self.handle_result(current_filter, result.returncode, result.stdout)
+        return True
+
+    def next_command(self) -> tuple[int, list[str]]:
+        '''Pops the next sequential filter and builds its command against the working copy.
+        '''
+        if self.work_path is None:
+            self.work_path = self.make_temp('work')
+            self.plan_filters()
         current_filter = self.filters_left.pop(0)
-        result = subprocess.run(self.build_command(current_filter), capture_output=True, text=True)
-        if result.returncode in [0,2]:
+        return current_filter, self.build_command(current_filter, self.work_path)
+
+    def plan_filters(self):
+        '''Puts the likeliest filters first and drops any past the limit, called before the first pass.
+        '''
+        if self.ranking is None:
+            return
+        features = self.get_features()
+        self.filters_left = self.ranking.order(self.filters_left, features)
+        #without a history for images like this one the ranking is only a guess, so run everything
+        if self.filter_limit is not None and self.ranking.knows(features):
+            self.filters_skipped = max(0, len(self.filters_left) - self.filter_limit)
+            del self.filters_left[self.filter_limit:]
+
+    def get_features(self) -> str:
+        if self.features is None:
+            self.inspect()
+            self.features = image_features(self.path, self.header)
+        return self.features
+
+    def inspect(self):
+        '''Reads the original's header and starts with a color type pngout will accept.
+
+        Starting at /c0 made pngout reject every color image once and the
+        pass had to be run again with the color it suggested.
+        '''
+        if self.inspected:
+            return
+        self.inspected = True
+        self.header = read_header(self.path)
+        if self.header is None or self.color_adjusted:
+            return
+        color = self.header.suggest_color()
+        if color is not None:
+            self.color_number = color
+
+    def handle_result(self, filter: int, returncode: int, stdout: str):
+        '''Applies the outcome of a sequential pass, however it was run.
+        '''
+        if returncode in [0,2]:
             if not self.is_png() and not self.converted:
                 self.converted = True
-            return True
-        if result.returncode == 3:
+            if returncode == 0:
+                self.work_filter = filter
+            if self.min_gain is not None:
+                self.check_gain()
+            if not len(self.filters_left):
+                self.commit_work()
+            return
+        if returncode == 3:
             #prevent an infinite loop if we unexpectedly reach this return code again after adjustment
             if self.color_adjusted:
-                raise PngUnitException('Bad command error after color adjustment', result.stdout.strip())
-            self.adjust_color(result.stdout)
-            self.filters_left.insert(0, current_filter) #try this filter again
-            return True
-        raise PngUnitException('Error running pngout', result.stdout.strip())
+                raise PngUnitException('Bad command error after color adjustment', stdout.strip())
+            self.adjust_color(stdout)
+            self.filters_left.insert(0, filter) #try this filter again
+            return
+        raise PngUnitException('Error running pngout', stdout.strip())
+
+    def run_parallel_pass(self) -> bool:
+        '''Runs every remaining filter at once, each on a private temporary copy.
+
+        Each call waits for one trial to finish so callers can report progress
+        the same way as sequential passes. When the last trial finishes the
+        smallest result replaces the output file.
+        '''
+        if self.trial_pool is None:
+            self.plan_filters()
+            if not self.color_known():
+                #one trial asks pngout for the color alone, the rest then start with its answer
+                filter, temp_path = self.run_trial(self.filters_left[0], settle=True)
+                self.trial_results[filter] = temp_path
+                self.filters_left.remove(filter)
+                if not len(self.filters_left):
+                    self.finish_trials()
+                return True
+            self.trial_pool = ThreadPoolExecutor(max_workers=len(self.filters_left))
+            futures = [ self.trial_pool.submit(self.run_trial, filter) for filter in self.filters_left ]
+            self.trial_iter = as_completed(futures)
+        try:
+            filter, temp_path = next(self.trial_iter).result()
+        except Exception:
+            self.discard_trials()
+            raise
+        self.trial_results[filter] = temp_path
+        self.filters_left.remove(filter)
+        if not len(self.filters_left):
+            self.finish_trials()
+        return True
+
+    def run_trial(self, filter: int, settle: bool = False) -> tuple[int, Path]:
+        temp_path = self.prepare_trial(filter)
+        try:
+            color: int | None = self.color_number
+            while color is not None:
+                result = self.execute(self.build_command(filter, temp_path, color), temp_path, filter)
+                color = self.check_trial_result(result.returncode, result.stdout, color, settle)
+            return filter, temp_path
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def check_gain(self):
+        '''Drops the remaining filters once a pass stops paying for itself.
+        '''
+        assert self.work_path is not None and self.min_gain is not None
+        size = self.work_path.stat().st_size
+        #a conversion pass changes format, there's nothing to compare it with
+        if self.last_size is not None and self.last_size - size <= self.min_gain * self.last_size:
+            self.filters_skipped = len(self.filters_left)
+            self.filters_left.clear()
+        self.last_size = size
+
+    def commit_work(self):
+        '''Moves the finished working copy over the output, if it's an improvement.
+        '''
+        if self.work_path is None:
+            return
+        output = self.make_output_path()
+        work_path = self.work_path
+        self.work_path = None
+        if self.is_png() and work_path.stat().st_size >= output.stat().st_size:
+            work_path.unlink()
+            return
+        self.replace_output(work_path)
+        self.best_filter = self.work_filter
+
+    def replace_output(self, result: Path):
+        '''Atomically swaps result in as the output.
+
+        A staged result is on another file system, so it is first copied to a
+        temporary file next to the output. Either way the output is only ever
+        the old file or the complete new one.
+        '''
+        output = self.make_output_path()
+        if result.parent != output.parent:
+            staged = result
+            result = self.make_temp('commit', staged=False, copy=False)
+            try:
+                shutil.copyfile(staged, result)
+            except BaseException:
+                result.unlink(missing_ok=True)
+                raise
+            finally:
+                staged.unlink(missing_ok=True)
+        shutil.copymode(self.path, result) #mkstemp files are private
+        os.replace(result, output)
+        if PngUnit.ON_REPLACE is not None:
+            PngUnit.ON_REPLACE(output)
+
+    def prepare_trial(self, filter: int) -> Path:
+        '''Creates the private file a filter trial works on.
+        '''
+        return self.make_temp(f'f{filter}')
+
+    def make_temp(self, label: str, staged: bool = True, copy: bool = True) -> Path:
+        '''Creates a temporary file in the staging directory or next to the output, a copy of the source for pngs.
+        '''
+        output = self.make_output_path()
+        directory = PngUnit.STAGING_DIR if staged and PngUnit.STAGING_DIR is not None else output.parent
+        handle, name = tempfile.mkstemp(prefix=f'{PngUnit.TEMP_PREFIX}{output.stem}-{label}-', suffix='.png', dir=directory)
+        os.close(handle)
+        temp_path = Path(name)
+        if copy and self.is_png():
+            try:
+                shutil.copyfile(self.path, temp_path)
+            except BaseException:
+                temp_path.unlink(missing_ok=True)
+                raise
+        return temp_path
+
+    def check_trial_result(self, returncode: int, stdout: str, color: int, settle: bool = False) -> int | None:
+        '''Returns None when a trial is finished, otherwise the color to retry it with.
+
+        A settling trial runs before any other and keeps the color pngout
+        accepted for the trials after it.
+        '''
+        if returncode in [0,2]:
+            if settle:
+                self.settle_color(color)
+            return None
+        if returncode == 3:
+            #only one adjustment per trial and none after pngout named the color, same as sequential passes
+            adjusted = self.parse_color(stdout)
+            if color != self.color_number or adjusted == color or self.color_adjusted:
+                raise PngUnitException('Bad command error after color adjustment', stdout.strip())
+            return adjusted
+        raise PngUnitException('Error running pngout', stdout.strip())
+
+    def finish_trials(self):
+        output = self.make_output_path()
+        current_size = output.stat().st_size if self.is_png() else None
+        best = None
+        best_size = 0
+        for filter, temp_path in self.trial_results.items():
+            if not temp_path.exists() or not temp_path.stat().st_size:
+                continue
+            size = temp_path.stat().st_size
+            if best is None or size < best_size:
+                best = filter
+                best_size = size
+        if best is not None and (current_size is None or best_size < current_size):
+            self.replace_output(self.trial_results.pop(best))
+            self.best_filter = best
+            if not self.is_png():
+                self.converted = True
+        self.discard_trials()
+        if not self.is_png() and not self.converted:
+            raise PngUnitException('No filter produced a converted file')
+
+    def discard_trials(self):
+        if self.trial_pool is not None:
+            self.trial_pool.shutdown(wait=False, cancel_futures=True)
+            for future in self.trial_iter:
+                #wait for stragglers so their temp files can be removed too
+                try:
+                    filter, temp_path = future.result()
+                    self.trial_results[filter] = temp_path
+                except Exception:
+                    pass
+            self.trial_pool = None
+        for temp_path in self.trial_results.values():
+            temp_path.unlink(missing_ok=True)
+        self.trial_results.clear()
+
+    def remove_stale_temps(self):
+        '''Removes temporary files left behind by an interrupted earlier run.
+        '''
+        output = self.make_output_path()
+        #exactly the names make_temp creates, so other files' temps never match
+        pattern = re.compile(rf'{re.escape(PngUnit.TEMP_PREFIX + output.stem)}-(work|commit|f\d+|t\d+)-[a-z0-9_]{{8}}\.png')
+        #staging directories of dead sessions are removed whole when a session starts, see pngthreads
+        directories = [ directory for directory in (output.parent, PngUnit.STAGING_DIR) if directory is not None ]
+        for directory in directories:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if pattern.fullmatch(entry.name):
+                        Path(entry.path).unlink(missing_ok=True)
+
+    def discard(self):
+        '''Removes every temporary file, the original is left as it was.
+        '''
+        self.discard_trials()
+        if self.work_path is not None:
+            self.work_path.unlink(missing_ok=True)
+            self.work_path = None
+
+    def execute(self, command: list[str], target: Path, filter: int | None = None, kind: str = 'pass') -> subprocess.CompletedProcess:
+        '''Runs pngout on target and logs a PassRecord for it, however it ends.
+        '''
+        size_before = self.pass_input_size(target)
+        with self.process_lock:
+            if self.canceled:
+                raise PngUnitCanceled('Canceled')
+            started = monotonic()
+            #nothing reads pngout's stderr
+            process = MeasuredPopen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.processes.add(process)
+        self.tune_process(process.pid)
+        try:
+            stdout = process.read_output(PngUnit.PROCESS_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise PngUnitException('pngout timed out', f'No result after {PngUnit.PROCESS_TIMEOUT} seconds')
+        finally:
+            #out of the set first, so terminate can't poll it or signal its pid once it's reaped
+            with self.process_lock:
+                self.processes.discard(process)
+            process.reap()
+            self.log_pass(kind, filter, command, target, size_before, monotonic() - started, process.cpu_time, process.returncode)
+        if self.canceled:
+            raise PngUnitCanceled('Canceled')
+        return subprocess.CompletedProcess(command, process.returncode, stdout)
+
+    def pass_input_size(self, target: Path) -> int:
+        #a conversion pass starts from an empty temporary file, its input is the original
+        return file_size(target) or self.size
+
+    def log_pass(self, kind: str, filter: int | None, command: list[str], target: Path,
+                 size_before: int, wall: float, cpu: float | None, returncode: int | None):
+        '''Keeps the measurements of one pngout run until the report takes them, safe from any thread.
+        '''
+        #switches follow the last path in the command, which is always target
+        switches = ' '.join(command[command.index(str(target)) + 1:])
+        record = PassRecord(kind, filter, switches, wall, cpu, size_before, file_size(target),
+                            -1 if returncode is None else returncode)
+        with self.process_lock:
+            self.pass_records.append(record)
+
+    def take_pass_records(self) -> list[PassRecord]:
+        with self.process_lock:
+            records = self.pass_records
+            self.pass_records = []
+        return records
+
+    @staticmethod
+    def tune_process(pid: int):
+        '''Applies NICE and AFFINITY to a started pngout.
+
+        Done after the spawn rather than in preexec_fn, which isn't safe with threads.
+        '''
+        try:
+            if PngUnit.NICE:
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + PngUnit.NICE)
+            if PngUnit.AFFINITY:
+                os.sched_setaffinity(pid, PngUnit.AFFINITY)
+        except (AttributeError, OSError):
+            #not supported on this platform, or pngout already exited
+            pass
+
+    def terminate(self):
+        '''Kills any running pngout process, safe to call from another thread.
+        '''
+        with self.process_lock:
+            self.canceled = True
+            for process in self.processes:
+                process.kill()
     
     def is_png(self) -> bool:
         return self.type == '.png'
@@ -78,37 +672,74 @@ class PngUnit:
     
     def start_stats(self):
         self.time_start = time()
+        #read before any pass can rewrite the header
+        self.inspect()
 
     def end_stats(self):
         self.time_end = time()
         self.final_size = self.make_output_path().stat().st_size
         self.final_switches = self.get_final_switches()
+        if self.ranking is not None and self.best_filter is not None:
+            self.ranking.record_win(self.best_filter, self.get_features())
 
     def get_final_switches(self) -> str:
+        '''Describes the result the way pngout /l does, without starting pngout unless asked to.
+        '''
+        header = None if PngUnit.LIST_SWITCHES else read_header(self.make_output_path())
+        if header is None:
+            return self.list_switches()
+        switches = [f'/c{header.color_type}']
+        #unknown when no pass beat the original
+        if self.best_filter is not None:
+            switches.append(f'/f{self.best_filter}')
+        switches.append(f'/d{header.bit_depth}')
+        return ' '.join(switches)
+
+    def list_switches(self) -> str:
         result = subprocess.run([str(PngUnit.PNGOUT_PATH), str(self.make_output_path()), '/l'], capture_output=True, text=True)
         if result.returncode:
             return "Unknown"
         return result.stdout.strip()
     
     def adjust_color(self, output: str):
+        self.color_number = self.parse_color(output)
+        self.color_adjusted = True
+
+    def settle_color(self, color: int):
+        if color != self.color_number:
+            self.color_number = color
+            self.color_adjusted = True
+        self.color_checked = True
+
+    def color_known(self) -> bool:
+        '''Whether pngout is expected to accept color_number without asking for another.
+        '''
+        self.inspect()
+        return self.color_checked or self.color_adjusted or (self.header is not None and self.header.suggest_color() is not None)
+
+    @staticmethod
+    def parse_color(output: str) -> int:
         try:
             found = output.index(PngUnit.COLOR_SEARCH)
             start = found + len(PngUnit.COLOR_SEARCH)
-            self.color_number = int(output[start:start+1])
-            self.color_adjusted = True
+            return int(output[start:start+1])
         except Exception as e:
             raise PngUnitException('Could not determine recommended color depth number', str(e))
     
-    def build_command(self, filter: int) -> list[str]:
+    def build_command(self, filter: int, output: Path | None = None, color: int | None = None) -> list[str]:
+        if output is None:
+            output = self.make_output_path()
+        if color is None:
+            color = self.color_number
         parts = [str(PngUnit.PNGOUT_PATH)]
         if not self.is_png() and not self.converted:
             #if it's not a png and we haven't converted, build 
             #command to convert on first run
             parts.append(str(self.path))
-            parts.append(str(self.make_output_path()))
+            parts.append(str(output))
         else:
-            parts.append(str(self.make_output_path()))
-        parts.append(f'/c{self.color_number}')
+            parts.append(str(output))
+        parts.append(f'/c{color}')
         parts.append(f'/f{filter}')
         parts.append('/y')
         return parts + self.extra_switches
@@ -123,6 +754,65 @@ class PngUnit:
     
     def get_pass_done(self) -> int:
         return len(self.filters) - len(self.filters_left)
+
+    def get_cost(self) -> int:
+        '''Rough estimate of the work in this unit, used for scheduling.
+        '''
+        return self.size * self.get_pass_total()
+
+    def run_variant(self, index: int) -> int:
+        '''Reruns the winning filter with trial_switches(index) on a copy of the finished output.
+
+        The copy replaces the output if it came out smaller, returns the bytes saved.
+        '''
+        output = self.make_output_path()
+        temp_path = self.make_temp(f't{index}', copy=False)
+        try:
+            shutil.copyfile(output, temp_path)
+            filter = self.best_filter if self.best_filter is not None else self.filters[0]
+            result = self.execute(self.build_command(filter, temp_path) + trial_switches(index), temp_path, filter, 'variant')
+            if result.returncode not in [0,2]:
+                raise PngUnitException('Error running pngout', result.stdout.strip())
+            #trials of the same unit finish on different workers
+            with self.commit_lock:
+                current = output.stat().st_size
+                saved = current - temp_path.stat().st_size
+                if result.returncode != 0 or saved <= 0:
+                    return 0
+                self.replace_output(temp_path)
+                self.final_size = current - saved
+            return saved
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def get_demand(self) -> tuple[int, int]:
+        '''Estimated (memory bytes, pngout processes) while this unit runs, used for admission.
+        '''
+        processes = len(self.filters_left) if self.parallel else 1
+        return processes * self.get_process_memory(), processes
+
+    def get_trial_demand(self) -> tuple[int, int]:
+        '''Same as get_demand for one extra trial, which is always a single process.
+        '''
+        return self.get_process_memory(), 1
+
+    def get_process_memory(self) -> int:
+        self.inspect()
+        if self.header is not None:
+            pixels = self.header.width * self.header.height
+        else:
+            #compressed images are rarely less than a quarter of their raw size
+            pixels = self.size
+        return pixels * self.MEMORY_PER_PIXEL + self.PROCESS_MEMORY
+
+    def __lt__(self, other: 'PngUnit | UnitRecord') -> bool:
+        #sorts most expensive first so a PriorityQueue hands out the longest jobs first
+        if isinstance(other, UnitRecord):
+            #a unit requeued among records, every unit of a session runs the same filters so size decides
+            return (-self.size, self.id) < (-other.size, other.id)
+        if not isinstance(other, PngUnit):
+            return NotImplemented
+        return (-self.get_cost(), self.id) < (-other.get_cost(), other.id)
     
     @staticmethod
     def is_extension_valid(path: Path) -> bool:
@@ -132,4 +822,59 @@ class PngUnit:
     def get_new_id(cls) -> int:
         new = cls.ID_COUNTER
         cls.ID_COUNTER += 1
-        return new
\ No newline at end of file
+        return new
+
+class UnitRecord:
+    """A discovered file waiting in the work queue, its PngUnit is only built when a worker takes it.
+
+    A tree of millions of files can be queued at once, so records hold no
+    more than the queue and the journal need, with the path as a plain string.
+    """
+    __slots__ = ('id', 'path', 'size', 'time_queued')
+    #only full units are grouped by pngdedup
+    duplicates: ClassVar[tuple[()]] = ()
+
+    def __init__(self, path: str, size: int):
+        self.id = PngUnit.get_new_id()
+        self.path = path
+        self.size = size
+        self.time_queued: float | None = None
+
+    def make_output_path(self) -> Path:
+        path = Path(self.path)
+        if path.suffix.lower() != '.png':
+            return path.parent / f'{path.stem}.png'
+        return path
+
+    def __lt__(self, other: 'UnitRecord | PngUnit') -> bool:
+        #largest first, the same order PngUnit.get_cost gives units of one session
+        if not isinstance(other, (UnitRecord, PngUnit)):
+            return NotImplemented
+        return (-self.size, self.id) < (-other.size, other.id)
+
+class TrialJob:
+    """One extra pngout run for a finished unit, queued behind every regular unit.
+
+    Jobs for the biggest outputs sort first so spare workers at the end of a
+    batch spend their time where the most bytes are.
+    """
+    def __init__(self, unit: PngUnit, index: int):
+        self.unit = unit
+        self.index = index
+        #fixed when queued, trials change final_size while others wait in the heap
+        self.size = unit.final_size
+
+    def __lt__(self, other: 'TrialJob') -> bool:
+        if not isinstance(other, TrialJob):
+            return NotImplemented
+        return (-self.size, self.unit.id, self.index) < (-other.size, other.unit.id, other.index)
+
+def nice_size(bytes: int) -> str:
+    #only 3 paths, no need for iteration
+    if bytes < 1024:
+        return f'{bytes} bytes'
+    kb = 1024
+    mb = kb * 1024
+    if bytes < mb:
+        return f'{bytes / kb:0.2f} Kb'
+    return f'{bytes / mb:0.2f} Mb'
@@ -0,0 +1,258 @@
+'''Watches directories and hands on images once they are new or modified.
+
+On Linux the kernel's inotify is used through ctypes, elsewhere (or when
+the watch limit runs out) the roots are rescanned every few seconds and
+compared with an index of (size, mtime) for every file. Either way a changed
+file is only reported once it has stopped changing for the settle time, so
+uploads still being written aren't picked up half done.
+
+Files outfront rewrites itself are reported through note_written, which
+updates the index so the rewrite isn't mistaken for a new change.
+'''
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from pngunit import PngUnit
+from pngscan import scan_entries
+
+#from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT_HEADER = struct.Struct('iIII')
+
+#size and st_mtime_ns
+type Signature = tuple[int, int]
+
+class Inotify:
+    '''Minimal ctypes binding for inotify, raises OSError where it isn't available.
+    '''
+    def __init__(self):
+        if not hasattr(os, 'O_NONBLOCK'):
+            raise OSError('inotify needs a posix system')
+        name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(name, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError('inotify is not available')
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.directories: dict[int, Path] = {}
+
+    def add(self, directory: Path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(directory))
+        self.directories[wd] = directory
+
+    def read(self, timeout: float) -> list[tuple[Path | None, int]]:
+        '''Events as (path, mask), a None path means events were lost.
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events: list[tuple[Path | None, int]] = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            if mask & IN_IGNORED:
+                #the directory was removed or unmounted
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd, None)
+            if directory is not None and len(name):
+                events.append((directory / os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    #seconds between rescans when polling
+    POLL_INTERVAL: float = 10.0
+    #longest wait in one call to changes, so a stop is noticed quickly
+    TICK: float = 0.5
+
+    def __init__(self, roots: list[Path], recursive: bool, settle: float = 2.0, poll: float | None = None):
+        '''Indexes every image under roots, which are reported from now on only if they change.
+
+        poll forces rescanning at that interval instead of inotify.
+        '''
+        self.roots = roots
+        self.recursive = recursive
+        self.settle = settle
+        self.poll_interval = poll or self.POLL_INTERVAL
+        self.lock = Lock()
+        self.index: dict[Path, Signature] = {}
+        #files seen changing, with their signature and when it last changed
+        self.pending: dict[Path, tuple[Signature | None, float]] = {}
+        self.inotify: Inotify | None = None
+        self.last_poll = monotonic()
+        if poll is None:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                self.inotify = None
+        self.build_index()
+
+    def build_index(self):
+        if self.inotify is not None:
+            try:
+                for root in self.roots:
+                    self.add_directory(root)
+            except OSError:
+                #usually the fs.inotify.max_user_watches limit, rescanning still works
+                self.inotify.close()
+                self.inotify = None
+        for path, size, mtime in self.scan(self.roots):
+            self.index[path] = (size, mtime)
+
+    def scan(self, roots: list[Path]):
+        return ( entry for entry in scan_entries(roots, self.recursive) if self.is_candidate(entry[0]) )
+
+    def add_directory(self, directory: Path):
+        assert self.inotify is not None
+        self.inotify.add(directory)
+        if not self.recursive:
+            return
+        for dirpath, dirnames, _ in os.walk(directory):
+            for name in dirnames:
+                self.inotify.add(Path(dirpath) / name)
+
+    @property
+    def method(self) -> str:
+        return 'inotify' if self.inotify is not None else 'polling'
+
+    def note_written(self, path: Path):
+        '''Records a file outfront just wrote, safe from any thread.
+        '''
+        signature = self.signature(path)
+        if signature is None:
+            return
+        with self.lock:
+            self.index[path] = signature
+
+    def changes(self) -> list[tuple[Path, int]]:
+        '''Waits up to TICK and returns (path, size) of files that changed and have settled since.
+        '''
+        if self.inotify is not None:
+            self.read_events()
+        else:
+            self.poll()
+        return self.settled()
+
+    def read_events(self):
+        assert self.inotify is not None
+        now = monotonic()
+        for path, mask in self.inotify.read(self.TICK):
+            if path is None:
+                self.rescan()
+                continue
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_new_directory(path)
+                continue
+            if self.is_candidate(path):
+                self.pending[path] = (None, now)
+
+    def add_new_directory(self, directory: Path):
+        '''A directory created or moved in, its files may already be complete.
+        '''
+        try:
+            self.add_directory(directory)
+        except OSError:
+            return
+        now = monotonic()
+        for path, _, _ in self.scan([directory]):
+            self.pending.setdefault(path, (None, now))
+
+    def poll(self):
+        now = monotonic()
+        wait = self.last_poll + self.poll_interval - now
+        if wait > 0:
+            #pending files still have to be checked while waiting for the next scan
+            sleep(min(wait, self.TICK))
+            return
+        self.last_poll = now
+        self.rescan()
+
+    def rescan(self):
+        now = monotonic()
+        seen: set[Path] = set()
+        for path, size, mtime in self.scan(self.roots):
+            seen.add(path)
+            with self.lock:
+                known = self.index.get(path, None)
+            if known != (size, mtime) and path not in self.pending:
+                self.pending[path] = ((size, mtime), now)
+        with self.lock:
+            #forget deleted files so one created again in their place is noticed
+            for path in [ path for path in self.index if path not in seen ]:
+                del self.index[path]
+
+    def settled(self) -> list[tuple[Path, int]]:
+        now = monotonic()
+        ready: list[tuple[Path, int]] = []
+        for path, (last, changed) in list(self.pending.items()):
+            signature = self.signature(path)
+            if signature is None:
+                #deleted or renamed away before it settled
+                del self.pending[path]
+                continue
+            if signature != last:
+                self.pending[path] = (signature, now)
+                continue
+            if now - changed < self.settle:
+                continue
+            del self.pending[path]
+            with self.lock:
+                if self.index.get(path, None) == signature:
+                    #unchanged after all, or outfront's own rewrite
+                    continue
+                self.index[path] = signature
+            ready.append((path, signature[0]))
+        return ready
+
+    @staticmethod
+    def is_candidate(path: Path) -> bool:
+        #outfront's temporary files share the directory with the output
+        return PngUnit.is_extension_valid(path) and not path.name.startswith(PngUnit.TEMP_PREFIX)
+
+    @staticmethod
+    def signature(path: Path) -> Signature | None:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
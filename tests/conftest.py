@@ -0,0 +1,90 @@
+'''Shared fixtures, every session runs against fake_pngout.py instead of pngout.
+'''
+from pathlib import Path
+from queue import Queue
+import sys
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import benchmark
+import pngthreads as pt
+from pngunit import PngUnit, WorkOrder
+
+#seconds a session may take before a test gives up on it
+SESSION_TIMEOUT = 60.0
+
+class Session:
+    '''Everything a finished session posted, by unit id.
+    '''
+    def __init__(self):
+        self.queued: dict[int, str] = {}
+        self.done: dict[int, int] = {}
+        self.errors: dict[int, list[str]] = {}
+        self.skipped: dict[int, list[str]] = {}
+        self.end: pt.SessionEndEvent | None = None
+
+    def handle_event(self, event: pt.BaseEvent):
+        if isinstance(event, pt.SessionQueueBatchEvent):
+            self.queued.update(zip(event.ids, event.paths))
+            return
+        if isinstance(event, pt.UnitEvent):
+            #a unit is always announced before anything it reports
+            assert event.id in self.queued
+        if isinstance(event, pt.PngDoneEvent):
+            self.done[event.id] = self.done.get(event.id, 0) + 1
+        elif isinstance(event, pt.PngErrorEvent):
+            self.errors.setdefault(event.id, []).append(event.error)
+        elif isinstance(event, pt.PngSkipEvent):
+            self.skipped.setdefault(event.id, []).append(event.reason)
+        elif isinstance(event, pt.SessionEndEvent):
+            self.end = event
+
+def wait_for_end(manager: pt.Manager, session: Session | None = None) -> Session:
+    session = session or Session()
+    while session.end is None:
+        session.handle_event(manager.EVENT_QUEUE.get(timeout=SESSION_TIMEOUT))
+    manager.join(SESSION_TIMEOUT)
+    assert not manager.is_alive()
+    return session
+
+@pytest.fixture(autouse=True)
+def pngout(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setenv('FAKE_PNGOUT_LATENCY', '0')
+    for name in ('FAKE_PNGOUT_LATENCY_PER_MB', 'FAKE_PNGOUT_GAIN', 'FAKE_PNGOUT_RETRY', 'FAKE_PNGOUT_FAIL_RATE', 'FAKE_PNGOUT_LOG'):
+        monkeypatch.delenv(name, raising=False)
+    path = benchmark.write_wrapper(tmp_path)
+    monkeypatch.setattr(PngUnit, 'PNGOUT_PATH', path, raising=False)
+    #each test gets its own event stream
+    monkeypatch.setattr(pt.Manager, 'EVENT_QUEUE', Queue())
+    return path
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    '''A dozen distinct images, a quarter of them BMPs to convert.
+    '''
+    root = tmp_path / 'tree'
+    benchmark.generate_tree(root, 1, 12, 1, 2, 2000, 6000, [2, 3, 6], 0.25)
+    return root
+
+@pytest.fixture
+def order(tree: Path):
+    def make(**options) -> WorkOrder:
+        options.setdefault('threads', 2)
+        options.setdefault('paths', [tree])
+        return WorkOrder(filters=[0, 5], recursive=True, extra_switches=[], **options)
+    return make
+
+@pytest.fixture
+def run_session():
+    def run(order: WorkOrder) -> Session:
+        manager = pt.create_manager(order, daemon=True)
+        manager.start()
+        return wait_for_end(manager)
+    return run
+
+def image_files(root: Path) -> list[Path]:
+    return sorted( path for path in root.rglob('*') if path.is_file() and PngUnit.is_extension_valid(path) )
+
+def temp_files(*roots: Path) -> list[Path]:
+    return [ path for root in roots for path in root.rglob(f'{PngUnit.TEMP_PREFIX}*') ]
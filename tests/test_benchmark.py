@@ -0,0 +1,11 @@
+'''The benchmark's own arithmetic.
+'''
+from benchmark import peak_concurrency
+
+def test_peak_concurrency_counts_overlapping_runs():
+    #two runs overlap, the third starts as the first ends
+    runs = [(0.5, 10.0, 11.0), (0.5, 10.5, 11.5), (0.5, 11.2, 12.0)]
+    assert peak_concurrency(runs, 0.0) == 2
+    #counted from before the spawn, the third now overlaps both
+    assert peak_concurrency(runs, 0.3) == 3
+    assert peak_concurrency([], 0.1) == 0
@@ -0,0 +1,22 @@
+'''The command line front end.
+'''
+from pathlib import Path
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def test_headless_mode_never_imports_tkinter(pngout: Path, tree: Path, tmp_path: Path):
+    script = ('import runpy, sys\n'
+              'try:\n'
+              '    runpy.run_path("outfront.py", run_name="__main__")\n'
+              'finally:\n'
+              '    print("tkinter" in sys.modules or "_tkinter" in sys.modules, file=sys.stderr)\n')
+    #every engine and front end module a session can load
+    arguments = [str(tree), '-r', '-q', '--pngout', str(pngout), '--engine', 'async', '-p', '--dedup',
+                 '--cache', str(tmp_path / 'cache.sqlite3'), '--journal', str(tmp_path / 'journal.jsonl'),
+                 '--report', str(tmp_path / 'report.jsonl')]
+    result = subprocess.run([sys.executable, '-c', script, *arguments], cwd=ROOT,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stderr.strip().splitlines()[-1] == 'False'
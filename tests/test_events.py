@@ -0,0 +1,45 @@
+'''The event stream front ends read.
+'''
+from queue import Queue
+import pytest
+import pngthreads as pt
+from pngunit import Engine, Schedule
+from conftest import Session, wait_for_end
+
+@pytest.mark.parametrize('engine', [Engine.THREADS, Engine.ASYNC])
+@pytest.mark.parametrize('schedule', [Schedule.FIFO, Schedule.LARGEST_FIRST_PRESORT])
+def test_queued_units_are_announced_in_batches(order, engine: Engine, schedule: Schedule, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(pt.Manager, 'QUEUE_BATCH', 5)
+    monkeypatch.setattr(pt.Manager, 'QUEUE_BATCH_TIME', 60.0)
+    batches: list[pt.SessionQueueBatchEvent] = []
+    class Recording(Session):
+        def handle_event(self, event: pt.BaseEvent):
+            if isinstance(event, pt.SessionQueueBatchEvent):
+                batches.append(event)
+            super().handle_event(event)
+    manager = pt.create_manager(order(engine=engine, schedule=schedule), daemon=True)
+    manager.start()
+    session = wait_for_end(manager, Recording())
+    assert [ len(batch.ids) for batch in batches ] == [5, 5, 2]
+    assert all( isinstance(path, str) for batch in batches for path in batch.paths )
+    assert len(session.done) == 12
+
+def test_batcher_merges_queued_batches():
+    queue = Queue()
+    queue.put(pt.SessionQueueBatchEvent([1, 2], ['a', 'b']))
+    queue.put(pt.SessionQueueBatchEvent([3], ['c']))
+    queue.put(pt.PngUpdateEvent(1, 0, 2))
+    queue.put(pt.SessionQueueBatchEvent([4], ['d']))
+    events = pt.EventBatcher(queue).drain()
+    assert [ type(event) for event in events ] == [pt.SessionQueueBatchEvent, pt.PngUpdateEvent, pt.SessionQueueBatchEvent]
+    assert events[0].ids == [1, 2, 3] and events[0].paths == ['a', 'b', 'c']
+    assert events[2].ids == [4]
+
+def test_batcher_splits_large_queued_batches():
+    queue = Queue()
+    for id in range(10):
+        queue.put(pt.SessionQueueBatchEvent([id * 3, id * 3 + 1, id * 3 + 2], ['a', 'b', 'c']))
+    events = pt.EventBatcher(queue, max_queued=8).drain()
+    #whole batches are merged until one passes the limit, none is split
+    assert [ len(event.ids) for event in events ] == [9, 9, 9, 3]
+    assert [ id for event in events for id in event.ids ] == list(range(30))
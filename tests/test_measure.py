@@ -0,0 +1,29 @@
+'''What sessions measure about themselves.
+'''
+import os
+import subprocess
+import sys
+import pytest
+import pngthreads as pt
+from pngunit import MeasuredPopen
+from conftest import wait_for_end
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='needs os.wait4')
+def test_reaped_child_cpu_time_is_kept():
+    script = 'import time\nend = time.process_time() + 0.3\nwhile time.process_time() < end: pass\nprint("done")'
+    process = MeasuredPopen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+    assert process.read_output(30).strip() == 'done'
+    process.reap()
+    assert process.returncode == 0
+    assert process.cpu_time is not None and process.cpu_time >= 0.25
+
+def test_discovery_time_leaves_out_queue_backpressure(order, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('FAKE_PNGOUT_LATENCY', '0.1')
+    monkeypatch.setattr(pt.Manager, 'QUEUE_BATCH', 1)
+    #one worker and room for one queued unit, so discovery waits on nearly every file
+    manager = pt.create_manager(order(threads=1, queue_limit=1), daemon=True)
+    manager.start()
+    session = wait_for_end(manager)
+    assert len(session.done) == 12
+    assert manager.dispatch_wait > 1.0
+    assert manager.discovery_time < 0.5
@@ -0,0 +1,32 @@
+'''Pool sizing from measured load.
+'''
+import subprocess
+import sys
+import time
+import pytest
+import pngpool
+from pngpool import PoolTuner, choose_pool_size
+
+def test_own_work_is_not_outside_load():
+    #eight busy pngouts on an otherwise idle eight core box
+    assert choose_pool_size(8, 8, 8, 8.0, 8.0) == 8
+
+def test_outside_load_shrinks_pool():
+    assert choose_pool_size(8, 8, 8, 12.0, 8.0) == 7
+
+@pytest.mark.skipif(pngpool.running_children_cpu_time() is None, reason='needs /proc')
+def test_running_children_are_measured():
+    child = subprocess.Popen([sys.executable, '-c', 'while True: pass'])
+    try:
+        before = PoolTuner.own_cpu_time()
+        time.sleep(1.0)
+        after = PoolTuner.own_cpu_time()
+    finally:
+        child.kill()
+        child.wait()
+    assert before is not None and after is not None
+    #still running, so child rusage alone would have seen nothing
+    assert after - before > 0.3
+    #reaping moves its time to the rusage total without losing any
+    reaped = PoolTuner.own_cpu_time()
+    assert reaped is not None and reaped >= after
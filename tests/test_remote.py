@@ -0,0 +1,86 @@
+'''A coordinator on localhost with real pngremote worker processes.
+'''
+from collections import Counter
+from pathlib import Path
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import pytest
+import pngthreads as pt
+from pngremote import RemoteManager
+from conftest import wait_for_end, temp_files
+
+ROOT = Path(__file__).resolve().parent.parent
+TOKEN = 'test-token'
+
+def start_remote(address: str, pngout: Path, token: str = TOKEN, slots: int = 2) -> subprocess.Popen:
+    env = dict(os.environ, OUTFRONT_TOKEN=token)
+    return subprocess.Popen([sys.executable, str(ROOT / 'pngremote.py'), address, '--slots', str(slots),
+                             '--pngout', str(pngout), '--connect-timeout', '10'], env=env, cwd=ROOT)
+
+@pytest.fixture
+def remote_order(order, tmp_path: Path):
+    def make(**options):
+        return order(threads=0, listen='127.0.0.1:0', listen_token=TOKEN, journal_path=tmp_path / 'journal.jsonl',
+                     cache_path=tmp_path / 'cache.sqlite3', **options)
+    return make
+
+def test_remote_workers_process_each_unit_once(remote_order, pngout: Path, tree: Path, tmp_path: Path,
+                                               monkeypatch: pytest.MonkeyPatch):
+    open_journal = pt.Manager.open_journal
+    def slow_open_journal(self):
+        #long enough for the workers to connect while the session is still opening
+        time.sleep(3)
+        open_journal(self)
+    monkeypatch.setattr(pt.Manager, 'open_journal', slow_open_journal)
+    manager = RemoteManager(remote_order(), daemon=True)
+    host, port = manager.listener.getsockname()[:2]
+    remotes = [ start_remote(f'{host}:{port}', pngout) for _ in range(2) ]
+    try:
+        manager.start()
+        session = wait_for_end(manager)
+    finally:
+        for remote in remotes:
+            assert remote.wait(30) == 0
+    assert session.end is not None and session.end.error == ''
+    files = len(session.queued)
+    assert files == 12
+    #the converted BMPs are done too, their output is the new png
+    assert session.errors == {}
+    assert session.done == { id: 1 for id in session.queued }
+
+    records = [ json.loads(line) for line in (tmp_path / 'journal.jsonl').read_text().splitlines() ]
+    done = Counter( record['path'] for record in records if record['state'] == 'done' )
+    assert len(done) == files and set(done.values()) == {1}
+
+    with sqlite3.connect(tmp_path / 'cache.sqlite3') as connection:
+        results = connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+    assert results == files
+    assert temp_files(tree) == []
+
+def test_remote_resume_skips_finished_units(remote_order, order, run_session, pngout: Path, tree: Path, tmp_path: Path):
+    manager = RemoteManager(remote_order(), daemon=True)
+    host, port = manager.listener.getsockname()[:2]
+    remote = start_remote(f'{host}:{port}', pngout)
+    manager.start()
+    wait_for_end(manager)
+    assert remote.wait(30) == 0
+    #a local session resuming the remote one finds everything finished
+    session = run_session(order(journal_path=tmp_path / 'journal.jsonl', resume=True))
+    assert session.done == {} and session.errors == {}
+    assert set(session.skipped) == set(session.queued)
+
+def test_remote_with_wrong_token_is_refused(remote_order, pngout: Path):
+    manager = RemoteManager(remote_order(), daemon=True)
+    host, port = manager.listener.getsockname()[:2]
+    manager.start()
+    try:
+        remote = start_remote(f'{host}:{port}', pngout, token='wrong', slots=1)
+        assert remote.wait(30) != 0
+    finally:
+        manager.stop()
+    session = wait_for_end(manager)
+    assert session.done == {}
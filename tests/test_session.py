@@ -0,0 +1,169 @@
+'''Whole sessions: the cache, the journal, deduplication, the resource budget and stopping.
+'''
+from pathlib import Path
+import json
+import os
+import shutil
+import threading
+import pytest
+import benchmark
+import pngthreads as pt
+from pngpool import running_children_stats
+from pngunit import Engine, PngUnitCanceled
+from conftest import Session, wait_for_end, image_files, temp_files
+
+ENGINES = [Engine.THREADS, Engine.ASYNC]
+
+def start(order) -> pt.Manager:
+    manager = pt.create_manager(order, daemon=True)
+    manager.start()
+    return manager
+
+def remove_bmps(root: Path) -> Path:
+    for path in root.rglob('*.bmp'):
+        path.unlink()
+    return root
+
+@pytest.fixture
+def png_tree(tree: Path) -> Path:
+    '''The tree without its BMPs, so a second session sees the same files as the first.
+    '''
+    return remove_bmps(tree)
+
+@pytest.fixture
+def runs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    '''Log of every fake pngout run, see benchmark.read_runs.
+    '''
+    log = tmp_path / 'runs.log'
+    monkeypatch.setenv('FAKE_PNGOUT_LOG', str(log))
+    return log
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_cached_files_are_skipped(engine: Engine, order, run_session, png_tree: Path, runs: Path, tmp_path: Path):
+    cache = tmp_path / 'cache.sqlite3'
+    first = run_session(order(engine=engine, cache_path=cache))
+    assert first.errors == {} and len(first.done) == len(first.queued)
+    runs.unlink()
+    second = run_session(order(engine=engine, cache_path=cache))
+    assert second.done == {} and second.errors == {}
+    assert set(second.skipped) == set(second.queued)
+    assert all( reasons[0].startswith('Already optimized') for reasons in second.skipped.values() )
+    assert not runs.exists()
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resumed_session_finishes_the_rest(engine: Engine, order, png_tree: Path, tmp_path: Path,
+                                           monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('FAKE_PNGOUT_LATENCY', '0.05')
+    journal = tmp_path / 'journal.jsonl'
+    manager = start(order(engine=engine, journal_path=journal))
+    first = Session()
+    #stopped once a few files are finished
+    while len(first.done) < 3:
+        first.handle_event(manager.EVENT_QUEUE.get(timeout=60))
+    manager.stop()
+    wait_for_end(manager, first)
+    assert 0 < len(first.done) < len(first.queued)
+    monkeypatch.setenv('FAKE_PNGOUT_LATENCY', '0')
+    second = wait_for_end(start(order(engine=engine, journal_path=journal, resume=True)))
+    finished = { second.queued[id] for id, reasons in second.skipped.items() if reasons == ['Finished in a previous session'] }
+    assert finished == { first.queued[id] for id in first.done }
+    #every file is done exactly once over both sessions
+    assert second.errors == {}
+    assert finished.isdisjoint( second.queued[id] for id in second.done )
+    assert len(finished) + len(second.done) == len(second.queued)
+    assert temp_files(png_tree) == []
+
+@pytest.mark.parametrize('link', [False, True])
+def test_duplicates_get_the_result_without_running_again(link: bool, order, run_session, png_tree: Path, runs: Path,
+                                                         tmp_path: Path):
+    #the same images again without copies, the fake pngout runs the same way on each
+    baseline = tmp_path / 'baseline'
+    benchmark.generate_tree(baseline, 1, 12, 1, 2, 2000, 6000, [2, 3, 6], 0.25)
+    run_session(order(paths=[remove_bmps(baseline)]))
+    expected = len(runs.read_text().splitlines())
+    runs.unlink()
+    originals = image_files(png_tree)[:3]
+    copies = [ original.with_name(f'copy-{original.name}') for original in originals ]
+    for original, copy in zip(originals, copies):
+        shutil.copyfile(original, copy)
+    files = len(image_files(png_tree))
+    session = run_session(order(dedup=True, dedup_link=link))
+    assert session.errors == {} and len(session.done) == files
+    #none for the copies
+    assert len(runs.read_text().splitlines()) == expected
+    for original, copy in zip(originals, copies):
+        assert copy.read_bytes() == original.read_bytes()
+        assert os.path.samefile(original, copy) == link
+
+def test_budget_admits_in_order_while_demand_fits():
+    budget = pt.ResourceBudget(memory=100)
+    budget.acquire(60, 1)
+    admitted = threading.Event()
+    def second():
+        budget.acquire(60, 1)
+        admitted.set()
+    thread = threading.Thread(target=second, daemon=True)
+    thread.start()
+    assert not admitted.wait(0.2)
+    budget.release(60, 1)
+    assert admitted.wait(5)
+    thread.join(5)
+
+def test_budget_runs_an_oversized_unit_alone():
+    budget = pt.ResourceBudget(cores=2)
+    budget.acquire(0, 5)
+    assert budget.running == 1
+    assert not budget.try_acquire(0, 1)
+    budget.release(0, 5)
+    assert budget.try_acquire(0, 1)
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_core_budget_limits_processes(engine: Engine, order, run_session, runs: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('FAKE_PNGOUT_LATENCY', '0.02')
+    session = run_session(order(engine=engine, threads=4, parallel_filters=True, core_budget=2))
+    assert session.errors == {} and len(session.done) == len(session.queued)
+    #two filters per unit, so one unit at a time
+    assert benchmark.peak_concurrency(benchmark.read_runs(runs), 0.0) <= 2
+
+def test_canceled_budget_wait_raises():
+    budget = pt.ResourceBudget(memory=10)
+    budget.acquire(10, 1)
+    errors = []
+    def waiting():
+        try:
+            budget.acquire(10, 1)
+        except PngUnitCanceled as e:
+            errors.append(e)
+    thread = threading.Thread(target=waiting, daemon=True)
+    thread.start()
+    budget.cancel()
+    thread.join(5)
+    assert len(errors) == 1
+
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('engine', ENGINES)
+def test_stop_cancels_running_units(engine: Engine, parallel: bool, order, tree: Path, tmp_path: Path,
+                                    monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv('FAKE_PNGOUT_LATENCY', '2')
+    before = { path: path.read_bytes() for path in image_files(tree) }
+    journal = tmp_path / 'journal.jsonl'
+    manager = start(order(engine=engine, parallel_filters=parallel, journal_path=journal))
+    session = Session()
+    #stopped with pngout running
+    while True:
+        event = manager.EVENT_QUEUE.get(timeout=60)
+        session.handle_event(event)
+        if isinstance(event, pt.PngUpdateEvent):
+            break
+    manager.stop()
+    wait_for_end(manager, session)
+    assert session.end is not None and session.end.error == ''
+    assert session.done == {}
+    canceled = [ id for id, errors in session.errors.items() if errors == ['Canceled'] ]
+    assert len(canceled) and len(canceled) == len(session.errors)
+    records = [ json.loads(line) for line in journal.read_text().splitlines() ]
+    assert [ record['error'] for record in records if record['state'] == 'error' ] == ['Canceled'] * len(canceled)
+    #nothing was changed, left behind or left running
+    assert { path: path.read_bytes() for path in image_files(tree) } == before
+    assert temp_files(tree) == []
+    assert not running_children_stats()
@@ -0,0 +1,60 @@
+'''Staged passes and cleaning up after sessions that were killed.
+'''
+from pathlib import Path
+import os
+import signal
+import subprocess
+import sys
+import time
+import pngthreads as pt
+from conftest import temp_files
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def test_staged_session_leaves_nothing_behind(order, run_session, tree: Path, tmp_path: Path):
+    stage = tmp_path / 'stage'
+    stage.mkdir()
+    session = run_session(order(staging_dir=stage))
+    assert session.errors == {} and len(session.done) == 12
+    assert list(stage.iterdir()) == []
+    assert temp_files(tree) == []
+
+def test_stale_staging_is_removed_at_start(order, run_session, tmp_path: Path):
+    stage = tmp_path / 'stage'
+    stale = stage / f'{pt.STAGING_PREFIX}{dead_pid()}-abc123'
+    stale.mkdir(parents=True)
+    (stale / '.outfront-img0-work-abcdefgh.png').write_bytes(b'left over')
+    #another session that is still running
+    live = stage / f'{pt.STAGING_PREFIX}{os.getppid()}-def456'
+    live.mkdir()
+    unrelated = stage / 'something-else'
+    unrelated.mkdir()
+    run_session(order(staging_dir=stage))
+    assert not stale.exists()
+    assert live.exists() and unrelated.exists()
+
+def test_killed_session_staging_is_removed_on_resume(order, run_session, pngout: Path, tree: Path, tmp_path: Path):
+    stage = tmp_path / 'stage'
+    stage.mkdir()
+    journal = tmp_path / 'journal.jsonl'
+    env = dict(os.environ, FAKE_PNGOUT_LATENCY='0.5')
+    process = subprocess.Popen([sys.executable, str(ROOT / 'cli.py'), str(tree), '-r', '-q', '--pngout', str(pngout),
+                                '--stage', str(stage), '--journal', str(journal)], env=env, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while not any( path.is_file() for path in stage.rglob('*') ):
+            assert time.monotonic() < deadline and process.poll() is None
+            time.sleep(0.05)
+    finally:
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+    assert any( path.is_file() for path in stage.rglob('*') )
+    session = run_session(order(staging_dir=stage, journal_path=journal, resume=True))
+    assert session.errors == {}
+    assert list(stage.iterdir()) == []
+    assert temp_files(tree) == []
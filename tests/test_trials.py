@@ -0,0 +1,25 @@
+'''Parallel filter trials.
+'''
+from pathlib import Path
+import random
+import pytest
+import benchmark
+import pngthreads as pt
+from pngunit import Engine, WorkOrder
+from conftest import wait_for_end
+
+@pytest.mark.parametrize('engine', [Engine.THREADS, Engine.ASYNC])
+def test_trials_share_the_color_pngout_asks_for(engine: Engine, pngout: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    log = tmp_path / 'runs.log'
+    monkeypatch.setenv('FAKE_PNGOUT_LOG', str(log))
+    image = tmp_path / 'true-color.png'
+    #true color, so nothing short of pngout can tell which /c it takes
+    image.write_bytes(benchmark.make_png(random.Random(1), 4000, 2))
+    order = WorkOrder(threads=1, paths=[image], filters=[0, 1, 2, 5], recursive=False, extra_switches=[],
+                         parallel_filters=True, engine=engine)
+    manager = pt.create_manager(order, daemon=True)
+    manager.start()
+    session = wait_for_end(manager)
+    assert session.errors == {} and len(session.done) == 1
+    #the first trial is retried with the color pngout named, the other three start with it
+    assert len(log.read_text().splitlines()) == 5
@@ -0,0 +1,36 @@
+'''A single unit's passes, without a session around it.
+'''
+from pathlib import Path
+import random
+import benchmark
+from pngunit import PngUnit, FilterRanking
+
+def finished_unit(tmp_path: Path, shrink: int) -> tuple[PngUnit, FilterRanking]:
+    '''A unit whose last pass ends with filter 5 having made its working copy shrink bytes smaller.
+    '''
+    image = tmp_path / 'image.png'
+    image.write_bytes(benchmark.make_png(random.Random(1), 3000, 0))
+    ranking = FilterRanking()
+    unit = PngUnit(image, [0, 5], ranking=ranking)
+    unit.start_stats()
+    unit.work_path = unit.make_temp('work')
+    with open(unit.work_path, 'r+b') as fp:
+        fp.truncate(image.stat().st_size - shrink)
+    unit.filters_left.clear()
+    unit.handle_result(5, 0, '')
+    unit.end_stats()
+    return unit, ranking
+
+def test_committed_pass_records_its_filter(tmp_path: Path):
+    unit, ranking = finished_unit(tmp_path, 100)
+    assert unit.final_size == unit.size - 100
+    assert unit.best_filter == 5
+    assert ranking.totals == {5: 1}
+
+def test_discarded_pass_records_no_filter(tmp_path: Path):
+    #pngout wrote the copy, but it's no smaller than the original, so the original stays
+    unit, ranking = finished_unit(tmp_path, 0)
+    assert unit.final_size == unit.size
+    assert unit.best_filter is None
+    assert ranking.totals == {}
+    assert '/f' not in unit.final_switches